@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Benchmarks of the loop and vectorized allocation of a buy across
+baskets of coins.
+
+Run with:
+
+    $ pip install pytest-benchmark numpy
+    $ pytest benchmarks/bench_allocation.py"""
+
+import random
+import pytest
+
+from optimal_buy_cbpro.allocation import allocate_loop, allocate_vectorized
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("numpy")
+
+
+@pytest.fixture(params=[10, 100, 1000], ids=lambda n: "{}coins".format(n))
+def basket(request):
+    rng = random.Random(request.param)
+    coins = {"C{:04d}".format(i): {} for i in range(request.param)}
+    fiat_balances = {"USD": 10000.0}
+    market_caps = {}
+    for c in coins:
+        fiat_balances[c] = rng.uniform(0, 5000)
+        market_caps[c] = rng.lognormvariate(20, 2)
+    total = sum(market_caps.values())
+    weights = {c: market_caps[c] / total for c in coins}
+    return coins, fiat_balances, weights, 9985.0
+
+
+def test_allocate_loop(benchmark, basket):
+    benchmark.group = "allocate {} coins".format(len(basket[0]))
+    benchmark(allocate_loop, *basket)
+
+
+def test_allocate_vectorized(benchmark, basket):
+    benchmark.group = "allocate {} coins".format(len(basket[0]))
+    result = benchmark(allocate_vectorized, *basket)
+    assert result == allocate_loop(*basket)
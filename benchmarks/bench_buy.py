@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""End-to-end benchmarks of buy() against a local mock exchange.
+
+Run with:
+
+    $ pip install pytest-benchmark
+    $ pytest benchmarks/bench_buy.py
+
+Besides timings, each benchmark records the API calls made per run (by
+endpoint) and the number of DB commits in its extra_info."""
+
+import cbpro
+import pytest
+from sqlalchemy import event
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.history import get_session
+from mock_exchange import MockExchange
+
+pytest.importorskip("pytest_benchmark")
+
+LATENCY = 0.002
+
+
+def get_coins(count):
+    if count == 3:
+        return ["BTC", "ETH", "LTC"]
+    return ["C{:03d}".format(i) for i in range(count)]
+
+
+@pytest.fixture(params=[3, 30, 300], ids=lambda n: "{}coins".format(n))
+def exchange(request):
+    exchange = MockExchange(get_coins(request.param), latency=LATENCY).start()
+    yield exchange
+    exchange.stop()
+
+
+def get_args(exchange, *extra):
+    return optimal_buy_cbpro.get_parser().parse_args(
+        [
+            "--mode",
+            "buy",
+            "--key",
+            "key",
+            "--b64secret",
+            "c2VjcmV0",
+            "--passphrase",
+            "passphrase",
+            "--api-url",
+            exchange.url,
+            "--coincap-url",
+            exchange.coincap_url,
+            "--api-rate-limit",
+            "0",
+            "--max-retries",
+            "1",
+        ]
+        + list(extra)
+    )
+
+
+def bench_buy(benchmark, exchange, args, rerun=False):
+    runs = []
+
+    def setup():
+        exchange.reset()
+        if rerun:
+            # Time a second run, with the first run's orders still open
+            optimal_buy_cbpro.buy(
+                args,
+                {c: {"name": c} for c in exchange.coins},
+                cbpro.AuthenticatedClient(
+                    args.key, args.b64secret, args.passphrase, args.api_url
+                ),
+                get_session("sqlite://"),
+            )
+            exchange.calls.clear()
+        coins = {c: {"name": c} for c in exchange.coins}
+        cbpro_client = cbpro.AuthenticatedClient(
+            args.key, args.b64secret, args.passphrase, args.api_url
+        )
+        optimal_buy_cbpro.share_connection_pool(
+            cbpro_client.session, args.api_concurrency
+        )
+        db_session = get_session("sqlite://")
+        commits = []
+        event.listen(db_session, "after_commit", lambda s: commits.append(s))
+        runs.append(commits)
+        return (args, coins, cbpro_client, db_session), {}
+
+    benchmark.pedantic(optimal_buy_cbpro.buy, setup=setup, rounds=3, iterations=1)
+    benchmark.extra_info["api_calls"] = dict(exchange.calls)
+    benchmark.extra_info["total_api_calls"] = sum(exchange.calls.values())
+    benchmark.extra_info["db_commits"] = len(runs[-1])
+    if not rerun:
+        assert exchange.calls["POST /orders"] > 0
+
+
+def test_buy(benchmark, exchange):
+    bench_buy(benchmark, exchange, get_args(exchange))
+
+
+def test_buy_serial(benchmark, exchange):
+    bench_buy(benchmark, exchange, get_args(exchange, "--api-concurrency", "1"))
+
+
+def test_buy_rerun(benchmark, exchange):
+    bench_buy(benchmark, exchange, get_args(exchange), rerun=True)
+
+
+def test_buy_rerun_amend(benchmark, exchange):
+    bench_buy(benchmark, exchange, get_args(exchange, "--amend-orders"), rerun=True)
+
+
+def test_buy_book_snap(benchmark, exchange):
+    bench_buy(benchmark, exchange, get_args(exchange, "--book-snap"))
+
+
+def test_buy_async(benchmark, exchange):
+    pytest.importorskip("aiohttp")
+    from optimal_buy_cbpro.aio import run_async
+
+    args = get_args(exchange, "--client", "async")
+
+    def setup():
+        exchange.reset()
+        coins = {c: {"name": c} for c in exchange.coins}
+        return (args, coins, get_session("sqlite://")), {}
+
+    benchmark.pedantic(run_async, setup=setup, rounds=3, iterations=1)
+    benchmark.extra_info["api_calls"] = dict(exchange.calls)
+    benchmark.extra_info["total_api_calls"] = sum(exchange.calls.values())
+    assert exchange.calls["POST /orders"] > 0
+
+
+def test_buy_rate_limited(benchmark):
+    # The exchange allows fewer requests than the client sends, so calls
+    # are rejected with 429s and retried one by one
+    exchange = MockExchange(get_coins(30), latency=LATENCY, rate_limit=40).start()
+    try:
+        bench_buy(benchmark, exchange, get_args(exchange, "--api-concurrency", "8"))
+    finally:
+        exchange.stop()
+    client_oids = [o["client_oid"] for o in exchange.orders.values()]
+    assert len(client_oids) == len(set(client_oids))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Benchmarks of writing history rows to a SQLite DB on disk, committing
+each row as it's made or all of them at once, under SQLite's default
+journal settings and under the WAL settings the history DB now uses.
+
+Run with:
+
+    $ pip install pytest-benchmark
+    $ pytest benchmarks/bench_history.py
+
+Point --basetemp at a slow disk (such as a network volume) to see the
+difference fsync makes."""
+
+import datetime
+import itertools
+import pytest
+
+from optimal_buy_cbpro.history import Order, batch_commits, commit, get_session
+
+pytest.importorskip("pytest_benchmark")
+
+ROWS = 100
+
+PRAGMAS = {"default": (None, None), "wal": ("WAL", "NORMAL")}
+
+
+@pytest.fixture(params=sorted(PRAGMAS))
+def db_session(request, tmp_path):
+    journal_mode, synchronous = PRAGMAS[request.param]
+    db_session = get_session(
+        "sqlite:///" + str(tmp_path / "history.db"), journal_mode, synchronous
+    )
+    yield db_session
+    db_session.close()
+
+
+def write_orders(db_session, ids):
+    for i in ids:
+        db_session.add(
+            Order(
+                currency="BTC",
+                price=100.0,
+                size=0.1,
+                cbpro_order_id="order{}".format(i),
+                created_at=datetime.datetime(2019, 1, 1),
+            )
+        )
+        commit(db_session)
+
+
+def test_commit_per_row(benchmark, db_session):
+    ids = itertools.count()
+    benchmark(lambda: write_orders(db_session, itertools.islice(ids, ROWS)))
+    benchmark.extra_info["rows"] = ROWS
+
+
+def test_commit_batched(benchmark, db_session):
+    ids = itertools.count()
+
+    def write():
+        with batch_commits(db_session):
+            write_orders(db_session, itertools.islice(ids, ROWS))
+
+    benchmark(write)
+    benchmark.extra_info["rows"] = ROWS
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+import datetime
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockExchange:
+    """A local stand-in for the Coinbase Pro REST API and the coincap assets
+    API, serving enough of each for deposit and buy runs.
+
+    Every request is delayed by `latency` seconds, and once more than
+    `rate_limit` requests arrive within a second, the rest get a 429 like
+    the real exchange returns, with a Retry-After of the rest of the second.
+    Requests are counted by endpoint in `calls`."""
+
+    def __init__(
+        self,
+        coins,
+        fiat_currency="USD",
+        fiat_balance=100000.0,
+        latency=0.0,
+        rate_limit=None,
+    ):
+        self.coins = coins
+        self.fiat_currency = fiat_currency
+        self.fiat_balance = fiat_balance
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.prices = {c: 10.0 * (i + 1) for i, c in enumerate(self.coins)}
+            self.market_caps = {c: 1e9 / (i + 1) for i, c in enumerate(self.coins)}
+            self.balances = {c: 0.0 for c in self.coins}
+            self.balances[self.fiat_currency] = self.fiat_balance
+            self.holds = {c: 0.0 for c in self.balances}
+            self.orders = {}
+            self.calls = {}
+            self.window_start = time.time()
+            self.window_count = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    @property
+    def coincap_url(self):
+        return self.url + "/v2/assets"
+
+    def start(self):
+        exchange = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes, which otherwise
+            # stall on delayed ACKs and swamp the latency being measured
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def handle_method(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, response = exchange.handle(
+                    method,
+                    url.path,
+                    {k: v[0] for k, v in parse_qs(url.query).items()},
+                    json.loads(body) if body else {},
+                )
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header(
+                        "Retry-After", "{:.3f}".format(exchange.retry_after())
+                    )
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.handle_method("GET")
+
+            def do_POST(self):
+                self.handle_method("POST")
+
+            def do_DELETE(self):
+                self.handle_method("DELETE")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def rate_limited(self):
+        if self.rate_limit is None:
+            return False
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count > self.rate_limit
+
+    def retry_after(self):
+        with self.lock:
+            return max(0.0, 1 - (time.time() - self.window_start))
+
+    def handle(self, method, path, params, body):
+        parts = path.strip("/").split("/")
+        # Count calls by endpoint, without the product or order IDs
+        names = parts[:1] + parts[2:] if parts[0] in ("products", "orders") else parts
+        endpoint = "{} /{}".format(method, "/".join(names))
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limited():
+            return 429, {"message": "Rate limit exceeded"}
+
+        with self.lock:
+            if parts == ["v2", "assets"]:
+                return 200, {
+                    "data": [
+                        {"symbol": c, "marketCapUsd": str(self.market_caps[c])}
+                        for c in self.coins
+                    ]
+                }
+            if parts == ["products"]:
+                return 200, [self.product(c) for c in self.coins]
+            if len(parts) == 3 and parts[0] == "products" and parts[2] == "ticker":
+                coin = parts[1].split("-")[0]
+                if coin not in self.prices:
+                    return 404, {"message": "NotFound"}
+                price = self.prices[coin]
+                return 200, {
+                    "price": "{:.2f}".format(price),
+                    "bid": "{:.2f}".format(price - 0.01),
+                    "ask": "{:.2f}".format(price + 0.01),
+                    "time": self.now(),
+                }
+            if len(parts) == 3 and parts[0] == "products" and parts[2] == "book":
+                coin = parts[1].split("-")[0]
+                if coin not in self.prices:
+                    return 404, {"message": "NotFound"}
+                return 200, self.book(self.prices[coin])
+            if parts == ["accounts"]:
+                return 200, [
+                    {
+                        "id": c,
+                        "currency": c,
+                        "balance": str(b),
+                        "available": str(b - self.holds[c]),
+                        "hold": str(self.holds[c]),
+                    }
+                    for c, b in self.balances.items()
+                ]
+            if parts == ["orders"] and method == "GET":
+                return 200, [o for o in self.orders.values() if o["status"] == "open"]
+            if parts == ["orders"] and method == "DELETE":
+                return 200, self.cancel(params.get("product_id"))
+            if len(parts) == 2 and parts[0] == "orders" and method == "GET":
+                order = self.find_order(parts[1])
+                if order is None:
+                    return 404, {"message": "NotFound"}
+                return 200, order
+            if len(parts) == 2 and parts[0] == "orders" and method == "DELETE":
+                if self.orders.get(parts[1], {}).get("status") != "open":
+                    return 404, {"message": "NotFound"}
+                return 200, self.cancel(order_id=parts[1])
+            if parts == ["orders"] and method == "POST":
+                return self.place_order(body)
+            if parts == ["withdrawals", "crypto"]:
+                self.balances[body["currency"]] -= float(body["amount"])
+                return 200, {"id": str(uuid.uuid4())}
+            if parts == ["deposits", "payment-method"]:
+                self.balances[body["currency"]] += float(body["amount"])
+                return 200, {"id": str(uuid.uuid4()), "payout_at": self.now()}
+        return 404, {"message": "NotFound"}
+
+    def now(self):
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def product(self, coin):
+        return {
+            "id": "{}-{}".format(coin, self.fiat_currency),
+            "base_currency": coin,
+            "quote_currency": self.fiat_currency,
+            "base_min_size": "0.001",
+            "base_increment": "0.00000001",
+            "quote_increment": "0.01",
+            "min_market_funds": "10",
+        }
+
+    def book(self, price, levels=50, step=0.05):
+        # A level2 book with a cent wide spread around the last price
+        return {
+            "sequence": 1,
+            "bids": [
+                ["{:.2f}".format(price - 0.01 - i * step), "1.0", 1]
+                for i in range(levels)
+            ],
+            "asks": [
+                ["{:.2f}".format(price + 0.01 + i * step), "1.0", 1]
+                for i in range(levels)
+            ],
+        }
+
+    def find_order(self, order_id):
+        if order_id.startswith("client:"):
+            client_oid = order_id[len("client:") :]
+            for o in self.orders.values():
+                if o["client_oid"] == client_oid:
+                    return o
+            return None
+        return self.orders.get(order_id)
+
+    def cancel(self, product_id=None, order_id=None):
+        cancelled = []
+        for o in self.orders.values():
+            if order_id is not None and o["id"] != order_id:
+                continue
+            if o["status"] == "open" and o["product_id"] in (product_id, None):
+                o["status"] = "done"
+                self.holds[self.fiat_currency] -= float(o["price"]) * float(o["size"])
+                cancelled.append(o["id"])
+        return cancelled
+
+    def place_order(self, body):
+        coin = body["product_id"].split("-")[0]
+        if body.get("post_only") and float(body["price"]) >= self.prices[coin] + 0.01:
+            return 400, {"message": "Post only mode"}
+        cost = float(body["price"]) * float(body["size"])
+        available = self.balances[self.fiat_currency] - self.holds[self.fiat_currency]
+        if cost > available:
+            return 400, {"message": "Insufficient funds"}
+        self.holds[self.fiat_currency] += cost
+        order = {
+            "id": str(uuid.uuid4()),
+            "client_oid": body.get("client_oid"),
+            "product_id": body["product_id"],
+            "side": body["side"],
+            "type": body.get("type", "limit"),
+            "price": body["price"],
+            "size": body["size"],
+            "filled_size": "0",
+            "post_only": body.get("post_only"),
+            "status": "open",
+            "created_at": self.now(),
+        }
+        self.orders[order["id"]] = order
+        return 200, order
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import cbpro
+import copy
+import json
+import threading
+import time
+from .coins import copy_coin_configs, load_coin_configs
+from .history import get_session
+from .metrics import METRICS
+from .optimal_buy_cbpro import buy, deposit, get_prices, run_with_retries
+from .throttle import run_concurrently, share_connection_pool
+
+
+class SharedMarketData:
+    """Market data fetched once per run and shared by every account in it.
+
+    Stands in for ReferenceCache in buy(), so market caps and product
+    metadata are only downloaded by the first account that asks for them,
+    and the same price snapshot is used for every account."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.prices = {}
+        self.price_fetch_times = {}
+
+    def get(self, key, fetch):
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = fetch()
+            return self.values[key]
+
+    def get_prices(
+        self,
+        cbpro_client,
+        coins,
+        fiat_currency,
+        max_workers=1,
+        rate_limiter=None,
+        fetch_times=None,
+    ):
+        with self.lock:
+            missing = [c for c in coins if (c, fiat_currency) not in self.prices]
+            if missing:
+                times = {}
+                prices = get_prices(
+                    cbpro_client,
+                    missing,
+                    fiat_currency,
+                    max_workers=max_workers,
+                    rate_limiter=rate_limiter,
+                    fetch_times=times,
+                )
+                for c in missing:
+                    self.prices[(c, fiat_currency)] = prices[c]
+                    self.price_fetch_times[(c, fiat_currency)] = times.get(c)
+        if fetch_times is not None:
+            for c in coins:
+                fetch_times[c] = self.price_fetch_times[(c, fiat_currency)]
+        return {c: self.prices[(c, fiat_currency)] for c in coins}
+
+
+def load_accounts(path):
+    with open(path) as f:
+        accounts = json.load(f)
+    for i, account in enumerate(accounts):
+        account.setdefault("name", "account{}".format(i))
+        for field in ["key", "b64secret", "passphrase"]:
+            if not account.get(field):
+                raise (
+                    Exception("account {} is missing {}".format(account["name"], field))
+                )
+        if "coins" in account:
+            try:
+                account["coins"] = load_coin_configs(account["coins"])
+            except Exception as e:
+                raise (Exception("account {}: {}".format(account["name"], e)))
+    return accounts
+
+
+def get_account_args(args, account):
+    account_args = copy.copy(args)
+    for k, v in account.get("args", {}).items():
+        setattr(account_args, k.replace("-", "_"), v)
+    return account_args
+
+
+def get_account_db_engine(account):
+    return account.get(
+        "db_engine", "sqlite:///cbpro_history-{}.db".format(account["name"])
+    )
+
+
+def run_account(args, default_coins, account, market_data, create_client=None):
+    name = account["name"]
+    account_args = get_account_args(args, account)
+    coins = copy_coin_configs(account.get("coins", default_coins))
+    if create_client is not None:
+        cbpro_client = create_client(account)
+    else:
+        cbpro_client = cbpro.AuthenticatedClient(
+            account["key"],
+            account["b64secret"],
+            account["passphrase"],
+            account_args.api_url,
+        )
+        share_connection_pool(cbpro_client.session, account_args.api_concurrency)
+        METRICS.instrument_http(cbpro_client.session, "cbpro")
+    db_session = get_session(
+        get_account_db_engine(account),
+        account_args.db_journal_mode,
+        account_args.db_synchronous,
+    )
+    METRICS.instrument_db(db_session)
+
+    def run():
+        print("running {} for account {}".format(account_args.mode, name))
+        if account_args.mode == "deposit":
+            deposit(account_args, cbpro_client, db_session)
+        elif account_args.mode == "buy":
+            buy(account_args, coins, cbpro_client, db_session, market_data)
+        elif account_args.mode == "sync":
+            from .sync import sync
+
+            sync(account_args, coins, cbpro_client, db_session)
+
+    start = time.time()
+    try:
+        ok = run_with_retries(run, account_args.max_retries)
+    finally:
+        db_session.close()
+    elapsed = time.time() - start
+    METRICS.record_run(account_args.mode, ok, elapsed, account=name)
+    return {"name": name, "ok": ok, "elapsed": elapsed}
+
+
+def run_accounts(args, default_coins, accounts, create_client=None, market_data=None):
+    """Run the deposit, buy or sync for each account, up to
+    args.account_concurrency at a time, and report how each one went."""
+    if market_data is None:
+        market_data = SharedMarketData()
+    results = run_concurrently(
+        lambda account: run_account(
+            args, default_coins, account, market_data, create_client
+        ),
+        accounts,
+        args.account_concurrency,
+    )
+    print("account results:")
+    for r in results:
+        print(
+            "  {} {} in {:.3f}s".format(
+                r["name"], "succeeded" if r["ok"] else "failed", r["elapsed"]
+            )
+        )
+    return results
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import time
+import uuid
+from urllib.parse import urlencode
+
+from cbpro.cbpro_auth import get_auth_headers
+
+from .cache import ReferenceCache
+from .metrics import METRICS, endpoint_name
+from .retry import get_backoff, get_retry_after
+from .optimal_buy_cbpro import (
+    check_cancelled,
+    check_deposit_args,
+    diff_all_orders,
+    finish_buy_orders,
+    get_amend_report,
+    get_fiat_balances,
+    get_market_cap_weights,
+    get_withdrawal_amount,
+    get_withdrawals,
+    get_withdrawn_balances,
+    plan_buy_orders,
+    record_deposit,
+    record_withdrawal,
+    set_minimum_order_sizes,
+)
+
+# Coinbase Pro's published limits for public endpoints, in requests per
+# second and burst size. Private endpoints are limited by --api-rate-limit.
+PUBLIC_RATE = 3
+PUBLIC_BURST = 6
+
+
+class AsyncRateLimiter:
+    """The token bucket from RateLimiter, for coroutines."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        if not self.rate or self.rate <= 0:
+            return
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        if not self.rate or self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def get_request_headers(key, b64secret, passphrase, method, path_url, body=""):
+    """Sign a request as cbpro.CBProAuth does."""
+    timestamp = str(time.time())
+    message = "".join([timestamp, method.upper(), path_url, body])
+    return get_auth_headers(timestamp, message, key, b64secret, passphrase)
+
+
+class AsyncClient:
+    """An asyncio counterpart to cbpro.AuthenticatedClient, covering the
+    calls made by a deposit or buy. Like cbpro, each call returns the decoded
+    JSON response whatever its status, so the same checks apply to both.
+
+    At most `concurrency` requests are in flight at once, and private and
+    public endpoints each have their own rate limit. A rate of 0 disables
+    the limit.
+
+    GET and DELETE requests, and orders, are retried as RetryingClient
+    retries them, up to `max_attempts` times."""
+
+    def __init__(
+        self,
+        key,
+        b64secret,
+        passphrase,
+        api_url="https://api.pro.coinbase.com",
+        concurrency=3,
+        rate=5,
+        public_rate=PUBLIC_RATE,
+        session=None,
+        max_attempts=4,
+        backoff=0.5,
+    ):
+        try:
+            import aiohttp
+        except ImportError:
+            raise (Exception("the async client requires aiohttp"))
+        self.aiohttp = aiohttp
+        self.key = key
+        self.b64secret = b64secret
+        self.passphrase = passphrase
+        self.api_url = api_url.rstrip("/")
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.private_limiter = AsyncRateLimiter(rate, 2 * rate if rate else None)
+        self.public_limiter = AsyncRateLimiter(public_rate, PUBLIC_BURST)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.session = session or aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max(1, concurrency))
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def close(self):
+        await self.session.close()
+
+    async def request(
+        self, method, path, params=None, data=None, public=False, find_result=None
+    ):
+        """Make a request, returning the decoded response and its headers.
+        Other than GETs and DELETEs, a request is only retried if given
+        `find_result`, which may return the result of an earlier attempt
+        that succeeded after all."""
+        retry = method in ("GET", "DELETE") or find_result is not None
+        attempts = self.max_attempts if retry else 1
+        limiter = self.public_limiter if public else self.private_limiter
+        for attempt in range(1, attempts + 1):
+            try:
+                result, headers, status = await self.attempt(
+                    method, path, params, data, limiter
+                )
+            except (
+                self.aiohttp.ClientError,
+                asyncio.TimeoutError,
+                ValueError,
+            ) as e:
+                if attempt == attempts:
+                    raise e
+                reason = type(e).__name__
+                wait = get_backoff(attempt, self.backoff)
+            else:
+                if attempt == attempts or (status != 429 and status < 500):
+                    return result, headers
+                reason = str(status)
+                wait = get_backoff(attempt, self.backoff)
+                if status == 429:
+                    wait = max(wait, get_retry_after(headers.get("Retry-After")))
+
+            call = endpoint_name(method, path)
+            METRICS.observe_retry("cbpro", call, reason)
+            print(
+                "{} failed ({}) on attempt {} of {}, retrying in {:.2f}s".format(
+                    call, reason, attempt, attempts, wait
+                )
+            )
+            if reason == "429":
+                limiter.pause(wait)
+            await asyncio.sleep(wait)
+            if find_result is not None:
+                found = await find_result()
+                if found is not None:
+                    return found, {}
+
+    async def attempt(self, method, path, params, data, limiter):
+        path_url = path + ("?" + urlencode(params) if params else "")
+        body = json.dumps(data) if data is not None else ""
+        await limiter.acquire()
+        async with self.semaphore:
+            # Signed only once it's about to be sent, as CBProAuth does, so a
+            # request that queued behind the rest of a ladder isn't rejected
+            # for a timestamp that's too old
+            headers = get_request_headers(
+                self.key, self.b64secret, self.passphrase, method, path_url, body
+            )
+            start = time.time()
+            async with self.session.request(
+                method,
+                self.api_url + path_url,
+                data=body or None,
+                headers=headers,
+                timeout=self.aiohttp.ClientTimeout(total=30),
+            ) as r:
+                result = await r.json(content_type=None)
+                METRICS.observe_call(
+                    "cbpro", endpoint_name(method, path), r.status, time.time() - start
+                )
+                return result, r.headers, r.status
+
+    async def send(self, method, path, params=None, data=None, public=False):
+        result, _ = await self.request(method, path, params, data, public)
+        return result
+
+    async def fetch_json(self, url, api="coincap"):
+        start = time.time()
+        async with self.session.get(
+            url, timeout=self.aiohttp.ClientTimeout(total=30)
+        ) as r:
+            METRICS.observe_call(
+                api, endpoint_name("GET", r.url.path), r.status, time.time() - start
+            )
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+    async def get_products(self):
+        return await self.send("GET", "/products", public=True)
+
+    async def get_product_ticker(self, product_id):
+        return await self.send(
+            "GET", "/products/{}/ticker".format(product_id), public=True
+        )
+
+    async def get_accounts(self):
+        return await self.send("GET", "/accounts")
+
+    async def get_orders(self):
+        # Follow the cb-after cursor through every page, as cbpro does
+        orders = []
+        params = {}
+        while True:
+            result, headers = await self.request("GET", "/orders", params)
+            if not isinstance(result, list):
+                return result
+            orders.extend(result)
+            if not headers.get("cb-after"):
+                return orders
+            params = {"after": headers["cb-after"]}
+
+    async def cancel_all(self, product_id):
+        return await self.send("DELETE", "/orders", {"product_id": product_id})
+
+    async def cancel_order(self, order_id):
+        return await self.send("DELETE", "/orders/{}".format(order_id))
+
+    async def get_order(self, order_id):
+        return await self.send("GET", "/orders/{}".format(order_id))
+
+    async def buy(self, product_id, order_type, **kwargs):
+        data = {"product_id": product_id, "side": "buy", "type": order_type}
+        data.update(kwargs)
+        data.setdefault("client_oid", str(uuid.uuid4()))
+
+        async def find_order():
+            try:
+                order = await self.get_order("client:{}".format(data["client_oid"]))
+            except (self.aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                return None
+            if isinstance(order, dict) and "id" in order:
+                print("order {} was placed after all".format(data["client_oid"]))
+                return order
+            return None
+
+        result, _ = await self.request(
+            "POST", "/orders", data=data, find_result=find_order
+        )
+        return result
+
+    async def crypto_withdraw(self, amount, currency, crypto_address):
+        return await self.send(
+            "POST",
+            "/withdrawals/crypto",
+            data={
+                "amount": amount,
+                "currency": currency,
+                "crypto_address": crypto_address,
+            },
+        )
+
+    async def deposit(self, amount, currency, payment_method_id):
+        return await self.send(
+            "POST",
+            "/deposits/payment-method",
+            data={
+                "amount": amount,
+                "currency": currency,
+                "payment_method_id": payment_method_id,
+            },
+        )
+
+
+async def fetch_products_async(client):
+    products = await client.get_products()
+    if not isinstance(products, list):
+        raise (Exception("unable to fetch products: {}".format(products)))
+    return products
+
+
+async def get_products_async(client, coins, fiat_currency, cache=None):
+    if cache is not None:
+        products = await cache.get_async(
+            "cbpro_products", lambda: fetch_products_async(client)
+        )
+    else:
+        products = await fetch_products_async(client)
+    set_minimum_order_sizes(coins, products, fiat_currency)
+    return products
+
+
+async def get_weights_async(client, coins, url, cache=None):
+    async def fetch_market_caps():
+        assets = await client.fetch_json(url)
+        return {
+            "data": [
+                {"symbol": a["symbol"], "marketCapUsd": a["marketCapUsd"]}
+                for a in assets["data"]
+            ]
+        }
+
+    if cache is not None:
+        assets = await cache.get_async("coincap_assets", fetch_market_caps)
+    else:
+        assets = await fetch_market_caps()
+    return get_market_cap_weights(coins, assets)
+
+
+async def get_prices_async(client, coins, fiat_currency, fetch_times=None):
+    async def fetch_ticker(c):
+        ticker = await client.get_product_ticker("{}-{}".format(c, fiat_currency))
+        if fetch_times is not None:
+            fetch_times[c] = time.time()
+        if "price" not in ticker:
+            raise (Exception("no price available for {} ticker={}".format(c, ticker)))
+        print("{} ticker={}".format(c, ticker))
+        return float(ticker["price"])
+
+    coin_list = list(coins)
+    results = await asyncio.gather(*[fetch_ticker(c) for c in coin_list])
+    return dict(zip(coin_list, results))
+
+
+async def get_open_orders_async(client, product_ids):
+    open_orders = []
+    for o in await client.get_orders():
+        if not isinstance(o, dict):
+            raise (Exception("unable to list open orders: {}".format(o)))
+        if o["product_id"] in product_ids:
+            open_orders.append(o)
+    return open_orders
+
+
+async def cancel_orders_async(args, coins, client):
+    product_ids = ["{}-{}".format(c, args.fiat_currency) for c in coins]
+    if args.cancel_open_only:
+        open_orders = await get_open_orders_async(client, product_ids)
+        open_products = {o["product_id"] for o in open_orders}
+        product_ids = [p for p in product_ids if p in open_products]
+    print("cancelling orders for {}".format(product_ids))
+    await asyncio.gather(*[client.cancel_all(product_id=p) for p in product_ids])
+    await confirm_cancelled_async(args, client, product_ids)
+    return product_ids
+
+
+async def confirm_cancelled_async(args, client, product_ids, order_ids=None):
+    remaining = set()
+    for attempt in range(args.cancel_confirm_attempts):
+        open_orders = await get_open_orders_async(client, product_ids)
+        remaining = {
+            o["product_id"]
+            for o in open_orders
+            if order_ids is None or o["id"] in order_ids
+        }
+        if not remaining or attempt == args.cancel_confirm_attempts - 1:
+            break
+        print("orders still open for {}, waiting".format(sorted(remaining)))
+        await asyncio.sleep(0.5 * (attempt + 1))
+    if remaining:
+        raise (Exception("orders still open after cancel for {}".format(remaining)))
+
+
+async def submit_buy_orders_async(args, buy_orders, client, db_session):
+    async def submit(buy_order):
+        start = time.time()
+        result = {
+            "coin": buy_order["coin"],
+            "price": buy_order["price"],
+            "size": buy_order["size"],
+            "market_price": buy_order.get("market_price"),
+        }
+        print(
+            "placing order coin={0} price={1:.2f} size={2:.8f}".format(
+                buy_order["coin"], buy_order["price"], buy_order["size"]
+            )
+        )
+        try:
+            order = await client.buy(
+                price="{0:.2f}".format(buy_order["price"]),
+                size="{0:.8f}".format(buy_order["size"]),
+                order_type="limit",
+                product_id="{}-{}".format(buy_order["coin"], args.fiat_currency),
+                post_only="true",
+            )
+            print("order={}".format(order))
+            result["order"] = order
+            result["outcome"] = "placed" if "id" in order else "rejected"
+        except Exception as e:
+            result["error"] = e
+            result["outcome"] = "error"
+        result["latency"] = time.time() - start
+        return result
+
+    report = await asyncio.gather(*[submit(b) for b in buy_orders])
+    return finish_buy_orders(list(report), db_session)
+
+
+async def amend_buy_orders_async(args, coins, buy_orders, client, db_session):
+    product_ids = ["{}-{}".format(c, args.fiat_currency) for c in coins]
+    open_orders = await get_open_orders_async(client, product_ids)
+    keep, cancel, place = diff_all_orders(args, coins, buy_orders, open_orders)
+    cancelled = await asyncio.gather(*[client.cancel_order(o["id"]) for o in cancel])
+    check_cancelled(cancel, cancelled)
+    report = []
+    if place:
+        if cancel:
+            # See amend_buy_orders()
+            await confirm_cancelled_async(
+                args, client, product_ids, {o["id"] for o in cancel}
+            )
+        report = await submit_buy_orders_async(args, place, client, db_session)
+    return get_amend_report(coins, buy_orders, keep, cancel, report)
+
+
+async def withdraw_async(coins, accounts, client, db_session):
+    withdrawals = [
+        (coin, get_withdrawal_amount(balance), address)
+        for coin, balance, address in get_withdrawals(coins, accounts)
+    ]
+    for coin, amount, address in withdrawals:
+        print("withdrawing {} {} to {}".format(amount, coin, address))
+    transactions = await asyncio.gather(
+        *[
+            client.crypto_withdraw(amount=amount, currency=coin, crypto_address=address)
+            for coin, amount, address in withdrawals
+        ],
+        return_exceptions=True,
+    )
+    # Every withdrawal that went through is recorded, each in its own
+    # commit as withdraw() does, before the first error is raised
+    errors = []
+    for (coin, amount, address), transaction in zip(withdrawals, transactions):
+        if isinstance(transaction, Exception):
+            errors.append(transaction)
+        else:
+            record_withdrawal(amount, coin, address, transaction, db_session)
+    if errors:
+        raise errors[0]
+
+
+async def deposit_async(args, client, db_session):
+    check_deposit_args(args)
+    deposit = await client.deposit(
+        payment_method_id=args.payment_method_id,
+        amount=args.amount,
+        currency=args.fiat_currency,
+    )
+    record_deposit(args, deposit, db_session)
+
+
+async def buy_async(args, coins, client, db_session, cache=None):
+    """buy() on an AsyncClient. Calls that don't depend on each other are
+    made concurrently: the product listing alongside the cancels, then the
+    accounts, every ticker and the market caps all at once."""
+    print("starting buy and (maybe) withdrawal")
+    if cache is None:
+        cache = ReferenceCache(db_session, args.cache_ttl, args.cache_max_entries)
+
+    async def get_products():
+        with METRICS.phase("get_products"):
+            products = await get_products_async(
+                client, coins, args.fiat_currency, cache
+            )
+        print("products={}".format(products))
+
+    async def cancel_orders():
+        if not args.amend_orders:
+            print("first, cancelling orders")
+            with METRICS.phase("cancel_orders"):
+                await cancel_orders_async(args, coins, client)
+
+    await asyncio.gather(get_products(), cancel_orders())
+
+    # Balances are only read once the cancels have released their holds.
+    # The market caps are fetched alongside, even though a run that ends up
+    # withdrawing won't need them.
+    price_fetch_times = {}
+    with METRICS.phase("get_market_data"):
+        accounts, prices, weights = await asyncio.gather(
+            client.get_accounts(),
+            get_prices_async(client, coins, args.fiat_currency, price_fetch_times),
+            get_weights_async(client, coins, args.coincap_url, cache),
+        )
+    with METRICS.phase("get_withdrawn_balances"):
+        withdrawn_balances = get_withdrawn_balances(db_session)
+    print("accounts={}".format(accounts))
+    print("prices={}".format(prices))
+    if price_fetch_times:
+        print(
+            "price snapshot skew={:.3f}s".format(
+                max(price_fetch_times.values()) - min(price_fetch_times.values())
+            )
+        )
+    print("withdrawn_balances={}".format(withdrawn_balances))
+
+    fiat_balances = get_fiat_balances(args, coins, accounts, withdrawn_balances, prices)
+    print("fiat_balances={}".format(fiat_balances))
+
+    fiat_amount = fiat_balances[args.fiat_currency]
+    fee_amount = args.base_fee * fiat_amount
+    print("reserving {} for fees, base_fee={}".format(fee_amount, args.base_fee))
+    fiat_amount -= fee_amount
+
+    if fiat_amount > args.withdrawal_amount:
+        print(
+            "fiat balance above {} {}, buying more".format(
+                args.withdrawal_amount, args.fiat_currency
+            )
+        )
+        buy_orders = plan_buy_orders(
+            args, coins, prices, fiat_balances, fiat_amount, weights
+        )
+        with METRICS.phase("place_orders"):
+            if args.amend_orders:
+                await amend_buy_orders_async(
+                    args, coins, buy_orders, client, db_session
+                )
+            elif buy_orders:
+                await submit_buy_orders_async(args, buy_orders, client, db_session)
+    else:
+        print(
+            "only {} {} fiat balance remaining, withdrawing"
+            " coins without buying".format(fiat_amount, args.fiat_currency)
+        )
+        if args.amend_orders:
+            with METRICS.phase("cancel_orders"):
+                await cancel_orders_async(args, coins, client)
+        with METRICS.phase("withdraw"):
+            await withdraw_async(coins, accounts, client, db_session)
+
+
+def run_async(args, coins, db_session, create_client=None):
+    """Run the deposit or buy for args.mode on an AsyncClient, from
+    synchronous code."""
+
+    async def run():
+        if create_client is not None:
+            client = create_client()
+        else:
+            client = AsyncClient(
+                args.key,
+                args.b64secret,
+                args.passphrase,
+                args.api_url,
+                args.api_concurrency,
+                args.api_rate_limit,
+                # --api-rate-limit 0 turns off limiting altogether
+                PUBLIC_RATE if args.api_rate_limit else 0,
+                max_attempts=args.call_attempts,
+                backoff=args.call_backoff,
+            )
+        async with client:
+            if args.mode == "deposit":
+                await deposit_async(args, client, db_session)
+            elif args.mode == "buy":
+                await buy_async(args, coins, client, db_session)
+
+    asyncio.run(run())
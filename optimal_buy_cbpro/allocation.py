@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Below this many coins the dict loops beat NumPy's per-call overhead
+VECTORIZE_MIN_COINS = 32
+
+
+def allocate_loop(coins, fiat_balances, weights, fiat_amount):
+    """Split `fiat_amount` across `coins` so as to move each towards its
+    target weight. Returns dicts of each coin's target value, its difference
+    from the current value (rounded to the cent) and the amount to buy."""
+    fiat_balance_sum = sum(fiat_balances.values())
+
+    target_amount_fiat = {}
+    for c in coins:
+        target_amount_fiat[c] = fiat_balance_sum * weights[c]
+
+    balance_differences_fiat = {}
+    for c in coins:
+        balance_differences_fiat[c] = round(target_amount_fiat[c] - fiat_balances[c], 2)
+
+    # Calculate portion of each to buy
+    sum_to_buy = 0
+    for coin in balance_differences_fiat:
+        if balance_differences_fiat[coin] >= 0:
+            sum_to_buy += balance_differences_fiat[coin]
+    amount_to_buy = {}
+    for coin in balance_differences_fiat:
+        amount_to_buy[coin] = (
+            math.floor(
+                100 * (balance_differences_fiat[coin] / sum_to_buy) * fiat_amount
+            )
+            / 100.0
+        )
+    return target_amount_fiat, balance_differences_fiat, amount_to_buy
+
+
+def round_cents(values):
+    """round(v, 2) for an array, to the same result as Python's round().
+
+    NumPy rounds v * 100, which can land exactly on a half when v itself is
+    just below or above one, so those few are redone with round()."""
+    scaled = values * 100
+    rounded = np.round(scaled) / 100
+    ties = np.nonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)[0]
+    for i in ties:
+        rounded[i] = round(float(values[i]), 2)
+    return rounded
+
+
+def allocate_vectorized(coins, fiat_balances, weights, fiat_amount):
+    """allocate_loop() over aligned NumPy arrays of balances and weights,
+    giving identical results."""
+    coin_list = list(coins)
+    # Summed just as allocate_loop() sums them, rather than with NumPy's
+    # pairwise summation, so the totals agree to the last bit: with sum()
+    # (compensated from Python 3.12), then one after another with +=
+    fiat_balance_sum = sum(fiat_balances.values())
+    balances = np.array([fiat_balances[c] for c in coin_list], dtype=np.float64)
+    weight_array = np.array([weights[c] for c in coin_list], dtype=np.float64)
+
+    targets = fiat_balance_sum * weight_array
+    differences = round_cents(targets - balances)
+    to_buy = differences[differences >= 0]
+    sum_to_buy = 0
+    for d in to_buy.tolist():
+        sum_to_buy += d
+    if sum_to_buy == 0:
+        raise (ZeroDivisionError("float division by zero"))
+    amounts = np.floor(100 * (differences / sum_to_buy) * fiat_amount) / 100.0
+
+    return (
+        dict(zip(coin_list, targets.tolist())),
+        dict(zip(coin_list, differences.tolist())),
+        dict(zip(coin_list, amounts.tolist())),
+    )
+
+
+def allocate(coins, fiat_balances, weights, fiat_amount):
+    if np is not None and len(coins) >= VECTORIZE_MIN_COINS:
+        return allocate_vectorized(coins, fiat_balances, weights, fiat_amount)
+    return allocate_loop(coins, fiat_balances, weights, fiat_amount)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+import math
+import numpy as np
+from .coins import DEFAULT_MINIMUM_ORDER_SIZE, get_coin_config
+
+CANDLE_COLUMNS = ["time", "low", "high", "open", "close"]
+
+
+def get_minimum_order_size(coins, coin):
+    # Candles can be given for coins that aren't in --coins
+    if coin not in coins:
+        return DEFAULT_MINIMUM_ORDER_SIZE
+    return get_coin_config(coins, coin).minimum_order_size
+
+
+def load_candles(path):
+    """Load OHLC candles from a CSV (with a header row) or Parquet file into a
+    dict of NumPy arrays keyed by column name, sorted by time."""
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise (Exception("reading {} requires pyarrow".format(path)))
+        table = pq.read_table(path, columns=CANDLE_COLUMNS)
+        candles = {
+            c: table.column(c).to_numpy().astype(np.float64) for c in CANDLE_COLUMNS
+        }
+    else:
+        with open(path) as f:
+            header = [h.strip() for h in f.readline().split(",")]
+            data = np.loadtxt(
+                f,
+                delimiter=",",
+                usecols=[header.index(c) for c in CANDLE_COLUMNS],
+                ndmin=2,
+            )
+        candles = {c: data[:, i] for i, c in enumerate(CANDLE_COLUMNS)}
+    order = np.argsort(candles["time"], kind="stable")
+    return {c: candles[c][order] for c in CANDLE_COLUMNS}
+
+
+def get_cycles(candles, interval):
+    """Split candles into buy cycles of `interval` candles. Returns the price
+    the ladder is placed at for each cycle (the close of its first candle)
+    and the lowest low seen before the next cycle cancels and replaces it."""
+    low = candles["low"]
+    starts = np.arange(0, len(low) - 1, interval)
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0)
+    cycle_prices = candles["close"][starts]
+    window_lows = np.minimum.reduceat(low[1:], starts)
+    return cycle_prices, window_lows
+
+
+def generate_ladders(
+    prices,
+    amount_to_buy,
+    starting_discount,
+    discount_step,
+    order_count,
+    minimum_order_size=0.01,
+):
+    """Vectorized generate_buy_orders() over an array of prices.
+
+    Returns (order_prices, order_sizes), each of shape
+    (len(prices), order_count). Rungs beyond the number of orders that
+    generate_buy_orders() would place have a size of zero."""
+    prices = np.asarray(prices, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        number_of_orders = np.clip(
+            np.floor(amount_to_buy / (minimum_order_size * prices)), 1, order_count
+        )
+        amount = np.floor(100 * amount_to_buy / number_of_orders) / 100
+
+        # Step the discount by repeated subtraction, exactly as
+        # generate_buy_orders() does, so the prices agree to the cent
+        discounts = np.empty(order_count)
+        discount = 1 - starting_discount
+        for i in range(order_count):
+            discounts[i] = discount
+            discount = discount - discount_step
+
+        order_prices = np.floor(100.0 * prices[:, None] * discounts[None, :]) / 100
+        used = np.arange(order_count)[None, :] < number_of_orders[:, None]
+        order_sizes = np.where(
+            used & (order_prices > 0), amount[:, None] / order_prices, 0.0
+        )
+    return order_prices, order_sizes
+
+
+def simulate(
+    cycle_prices,
+    window_lows,
+    amount_to_buy,
+    starting_discount,
+    discount_step,
+    order_count,
+    minimum_order_size=0.01,
+):
+    """Simulate the discounted ladder against a run of buy cycles, compared
+    with spending the same budget on a market buy at the start of each cycle.
+
+    A limit order fills if the price trades below it before the next cycle.
+    Unfilled orders are cancelled and their fiat is reported as unspent
+    rather than carried over, which keeps every cycle independent."""
+    order_prices, order_sizes = generate_ladders(
+        cycle_prices,
+        amount_to_buy,
+        starting_discount,
+        discount_step,
+        order_count,
+        minimum_order_size,
+    )
+    filled = window_lows[:, None] < order_prices
+    coins = float(np.sum(order_sizes * filled))
+    spent = float(np.sum(order_sizes * order_prices * filled))
+
+    valid = cycle_prices > 0
+    budget = amount_to_buy * float(np.count_nonzero(valid))
+    market_coins = float(np.sum(amount_to_buy / cycle_prices[valid]))
+
+    ladder_cost = spent / coins if coins > 0 else float("nan")
+    market_cost = budget / market_coins if market_coins > 0 else float("nan")
+    return {
+        "cycles": len(cycle_prices),
+        "budget": budget,
+        "spent": spent,
+        "unspent": budget - spent,
+        "coins": coins,
+        "fill_rate": spent / budget if budget > 0 else 0.0,
+        "ladder_cost": ladder_cost,
+        "market_cost": market_cost,
+        "discount_captured": 1 - ladder_cost / market_cost,
+    }
+
+
+def parse_backtest_data(values):
+    data = {}
+    for value in values or []:
+        coin, _, path = value.partition("=")
+        if not path:
+            raise (Exception("expected COIN=PATH, got {}".format(value)))
+        data[coin] = path
+    return data
+
+
+def run_backtest(args, coins):
+    data = parse_backtest_data(args.backtest_data)
+    if not data:
+        print("please specify candle data with `--backtest-data COIN=PATH`")
+        return {}
+    results = {}
+    for coin, path in data.items():
+        candles = load_candles(path)
+        cycle_prices, window_lows = get_cycles(candles, args.backtest_interval)
+        results[coin] = simulate(
+            cycle_prices,
+            window_lows,
+            args.backtest_amount,
+            args.starting_discount,
+            args.discount_step,
+            args.order_count,
+            get_minimum_order_size(coins, coin),
+        )
+        print("{} backtest={}".format(coin, results[coin]))
+
+    print("backtest results:")
+    print(
+        "  {:<6} {:>7} {:>10} {:>14} {:>14} {:>10}".format(
+            "coin", "cycles", "fill_rate", "ladder_cost", "market_cost", "discount"
+        )
+    )
+    for coin, r in results.items():
+        print(
+            "  {:<6} {:>7} {:>10.4f} {:>14.2f} {:>14.2f} {:>10.4%}".format(
+                coin,
+                r["cycles"],
+                r["fill_rate"],
+                r["ladder_cost"],
+                r["market_cost"],
+                r["discount_captured"],
+            )
+        )
+    return results
+
+
+def parse_grid(value, type=float):
+    return [type(v) for v in str(value).split(",") if v.strip()]
+
+
+# Per-worker state for sweeps: the memory-mapped candles, and the cycles
+# already cut from them for each interval
+_sweep_candles = {}
+_sweep_cycles = {}
+
+
+def _init_sweep_worker(paths):
+    _sweep_candles.clear()
+    _sweep_cycles.clear()
+    for coin, columns in paths.items():
+        _sweep_candles[coin] = {
+            c: np.load(p, mmap_mode="r") for c, p in columns.items()
+        }
+
+
+def _run_sweep_chunk(task):
+    coin, interval, amount_to_buy, minimum_order_size, params = task
+    if (coin, interval) not in _sweep_cycles:
+        _sweep_cycles[(coin, interval)] = get_cycles(_sweep_candles[coin], interval)
+    cycle_prices, window_lows = _sweep_cycles[(coin, interval)]
+    results = []
+    for starting_discount, discount_step, order_count in params:
+        r = simulate(
+            cycle_prices,
+            window_lows,
+            amount_to_buy,
+            starting_discount,
+            discount_step,
+            order_count,
+            minimum_order_size,
+        )
+        r.update(
+            {
+                "coin": coin,
+                "interval": interval,
+                "starting_discount": starting_discount,
+                "discount_step": discount_step,
+                "order_count": order_count,
+                "savings": r["spent"] * r["discount_captured"],
+            }
+        )
+        results.append(r)
+    return results
+
+
+def sweep(
+    data,
+    intervals,
+    starting_discounts,
+    discount_steps,
+    order_counts,
+    amount_to_buy,
+    coins=None,
+    workers=None,
+    rank_by="savings",
+):
+    """Backtest every combination of the given parameter grids for each coin
+    in `data` (a dict of coin to candle file), spread over a pool of
+    `workers` processes. The candles are written once to .npy files that
+    each worker memory-maps, rather than pickling a copy to every process.
+
+    Returns a list of results, best first according to `rank_by`."""
+    import itertools
+    import os
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    coins = coins or {}
+    workers = workers or os.cpu_count() or 1
+    params = list(itertools.product(starting_discounts, discount_steps, order_counts))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = {}
+        for coin, path in data.items():
+            candles = load_candles(path)
+            paths[coin] = {}
+            for column in ["low", "close"]:
+                paths[coin][column] = os.path.join(
+                    tmpdir, "{}-{}.npy".format(coin, column)
+                )
+                np.save(paths[coin][column], candles[column])
+
+        # Enough chunks to keep every worker busy, but few enough that each
+        # one amortizes its pickling and dispatch overhead
+        chunk_size = max(1, len(params) * len(data) * len(intervals) // (workers * 4))
+        tasks = []
+        for coin in data:
+            minimum_order_size = get_minimum_order_size(coins, coin)
+            for interval in intervals:
+                for i in range(0, len(params), chunk_size):
+                    tasks.append(
+                        (
+                            coin,
+                            interval,
+                            amount_to_buy,
+                            minimum_order_size,
+                            params[i : i + chunk_size],
+                        )
+                    )
+
+        results = []
+        if workers <= 1:
+            _init_sweep_worker(paths)
+            for task in tasks:
+                results.extend(_run_sweep_chunk(task))
+        else:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_sweep_worker,
+                initargs=(paths,),
+            ) as executor:
+                for chunk in executor.map(_run_sweep_chunk, tasks):
+                    results.extend(chunk)
+
+    results.sort(
+        key=lambda r: r[rank_by] if not math.isnan(r[rank_by]) else -math.inf,
+        reverse=True,
+    )
+    return results
+
+
+SWEEP_COLUMNS = [
+    "coin",
+    "interval",
+    "starting_discount",
+    "discount_step",
+    "order_count",
+    "fill_rate",
+    "ladder_cost",
+    "market_cost",
+    "discount_captured",
+    "savings",
+]
+
+
+def run_sweep(args, coins):
+    data = parse_backtest_data(args.backtest_data)
+    if not data:
+        print("please specify candle data with `--backtest-data COIN=PATH`")
+        return []
+    results = sweep(
+        data,
+        parse_grid(args.sweep_interval or args.backtest_interval, int),
+        parse_grid(args.sweep_starting_discount or args.starting_discount),
+        parse_grid(args.sweep_discount_step or args.discount_step),
+        parse_grid(args.sweep_order_count or args.order_count, int),
+        args.backtest_amount,
+        coins=coins,
+        workers=args.sweep_workers,
+        rank_by=args.sweep_rank_by,
+    )
+
+    if args.sweep_output is not None:
+        import csv
+
+        with open(args.sweep_output, "w", newline="") as f:
+            writer = csv.DictWriter(f, SWEEP_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+        print("wrote {} results to {}".format(len(results), args.sweep_output))
+
+    print(
+        "top {} of {} results by {}:".format(
+            min(args.sweep_top, len(results)), len(results), args.sweep_rank_by
+        )
+    )
+    print(
+        "  {:<6} {:>8} {:>8} {:>8} {:>6} {:>10} {:>10} {:>10}".format(
+            "coin",
+            "interval",
+            "start",
+            "step",
+            "orders",
+            "fill_rate",
+            "discount",
+            "savings",
+        )
+    )
+    for r in results[: args.sweep_top]:
+        print(
+            "  {:<6} {:>8} {:>8.4f} {:>8.4f} {:>6} {:>10.4f} {:>10.4%} {:>10.2f}".format(
+                r["coin"],
+                r["interval"],
+                r["starting_discount"],
+                r["discount_step"],
+                r["order_count"],
+                r["fill_rate"],
+                r["discount_captured"],
+                r["savings"],
+            )
+        )
+    return results
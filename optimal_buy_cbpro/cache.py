@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import json
+import time
+from .history import CacheEntry, commit
+
+
+class ReferenceCache:
+    """Caches slow-changing reference data (market caps, product metadata)
+    in the history DB. Entries younger than `ttl` seconds are served without
+    calling upstream; older entries are refreshed, but are still served if
+    the refresh fails. At most `max_entries` entries are kept, evicting the
+    least recently fetched."""
+
+    def __init__(self, db_session, ttl=300, max_entries=100):
+        self.db_session = db_session
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key, fetch):
+        entry, value = self.lookup(key)
+        if value is not None:
+            return value
+        try:
+            value = fetch()
+        except Exception as e:
+            return self.stale(key, entry, e)
+        self.put(key, value, entry)
+        return value
+
+    async def get_async(self, key, fetch):
+        """get(), where `fetch` is a coroutine function."""
+        entry, value = self.lookup(key)
+        if value is not None:
+            return value
+        try:
+            value = await fetch()
+        except Exception as e:
+            return self.stale(key, entry, e)
+        self.put(key, value, entry)
+        return value
+
+    def lookup(self, key):
+        entry = self.db_session.query(CacheEntry).filter_by(key=key).one_or_none()
+        if entry is not None:
+            age = time.time() - entry.fetched_at
+            if age < self.ttl:
+                print("using cached {} (age {:.0f}s)".format(key, age))
+                return entry, json.loads(entry.payload)
+        return entry, None
+
+    def stale(self, key, entry, e):
+        if entry is None:
+            raise e
+        print(
+            "caught exception when refreshing {}, using stale value "
+            "from {:.0f}s ago: {}".format(key, time.time() - entry.fetched_at, e)
+        )
+        return json.loads(entry.payload)
+
+    def put(self, key, value, entry=None):
+        if entry is None:
+            entry = CacheEntry(key=key)
+            self.db_session.add(entry)
+        entry.payload = json.dumps(value)
+        entry.fetched_at = time.time()
+        self.db_session.flush()
+        self.evict()
+        commit(self.db_session)
+
+    def evict(self):
+        stale = (
+            self.db_session.query(CacheEntry)
+            .order_by(CacheEntry.fetched_at.desc())
+            .offset(self.max_entries)
+            .all()
+        )
+        for entry in stale:
+            self.db_session.delete(entry)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import json
+import numbers
+
+# --coins is read from here when it isn't given
+COINS_ENV = "OPTIMAL_BUY_CBPRO_COINS"
+
+# Used until the product metadata has been fetched
+DEFAULT_MINIMUM_ORDER_SIZE = 0.01
+
+
+class CoinConfig:
+    """One coin's settings from --coins, along with the metadata of its
+    product on the exchange once fetched (see update_product()).
+
+    Hot paths read these as attributes. For code written against the raw
+    --coins dicts, settings can also be read with get(), [] and `in`."""
+
+    # Settings that can be given in --coins
+    SETTINGS = ("name", "withdrawal_address", "external_balance")
+    # Filled in from the product, though they can be given in --coins too
+    PRODUCT_FIELDS = ("minimum_order_size", "quote_increment", "base_increment")
+
+    __slots__ = ("symbol",) + SETTINGS + PRODUCT_FIELDS
+
+    def __init__(
+        self,
+        symbol,
+        name=None,
+        withdrawal_address=None,
+        external_balance=0.0,
+        minimum_order_size=DEFAULT_MINIMUM_ORDER_SIZE,
+        quote_increment=None,
+        base_increment=None,
+    ):
+        self.symbol = symbol
+        self.name = name
+        self.withdrawal_address = withdrawal_address
+        self.external_balance = external_balance
+        self.minimum_order_size = minimum_order_size
+        self.quote_increment = quote_increment
+        self.base_increment = base_increment
+
+    @classmethod
+    def from_dict(cls, symbol, config):
+        """Validate a coin's settings from --coins."""
+        if not isinstance(config, dict):
+            raise (Exception("settings for {} must be an object".format(symbol)))
+        unknown = set(config) - set(cls.SETTINGS + cls.PRODUCT_FIELDS)
+        if unknown:
+            raise (
+                Exception(
+                    "unknown settings for {}: {} (expected {})".format(
+                        symbol,
+                        ", ".join(sorted(unknown)),
+                        ", ".join(cls.SETTINGS + cls.PRODUCT_FIELDS),
+                    )
+                )
+            )
+        kwargs = {}
+        for key in ["name", "withdrawal_address"]:
+            value = config.get(key)
+            if value is not None and not isinstance(value, str):
+                raise (Exception("{} for {} must be a string".format(key, symbol)))
+            kwargs[key] = value
+        kwargs["external_balance"] = get_number(
+            symbol, "external_balance", config.get("external_balance", 0), minimum=0
+        )
+        for key in cls.PRODUCT_FIELDS:
+            if config.get(key) is not None:
+                kwargs[key] = get_number(symbol, key, config[key], minimum=0)
+        return cls(symbol, **kwargs)
+
+    def to_dict(self):
+        config = {k: getattr(self, k) for k in self.SETTINGS}
+        if self.minimum_order_size != DEFAULT_MINIMUM_ORDER_SIZE:
+            config["minimum_order_size"] = self.minimum_order_size
+        for k in ["quote_increment", "base_increment"]:
+            if getattr(self, k) is not None:
+                config[k] = getattr(self, k)
+        return config
+
+    def update_product(self, product):
+        """Take the minimum order size and increments from the coin's product
+        (as from /products), returning whether any of them changed."""
+        fields = {"minimum_order_size": float(product["min_market_funds"])}
+        for key in ["quote_increment", "base_increment"]:
+            if key in product:
+                fields[key] = float(product[key])
+        changed = False
+        for key, value in fields.items():
+            if getattr(self, key) != value:
+                setattr(self, key, value)
+                changed = True
+        return changed
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __copy__(self):
+        return CoinConfig(*(getattr(self, k) for k in self.__slots__))
+
+    def __eq__(self, other):
+        return isinstance(other, CoinConfig) and all(
+            getattr(self, k) == getattr(other, k) for k in self.__slots__
+        )
+
+    def __repr__(self):
+        return "CoinConfig({!r}, {})".format(self.symbol, self.to_dict())
+
+
+def get_number(symbol, key, value, minimum=None):
+    # Numbers quoted as strings are taken too, as float() always has
+    if isinstance(value, bool) or not isinstance(value, (numbers.Real, str)):
+        raise (Exception("{} for {} must be a number".format(key, symbol)))
+    try:
+        value = float(value)
+    except ValueError:
+        raise (Exception("{} for {} must be a number".format(key, symbol)))
+    if minimum is not None and value < minimum:
+        raise (Exception("{} for {} must be at least {}".format(key, symbol, minimum)))
+    return value
+
+
+def reject_duplicates(pairs):
+    config = {}
+    for key, value in pairs:
+        if key in config:
+            raise (Exception("{} is given more than once".format(key)))
+        config[key] = value
+    return config
+
+
+def load_coin_configs(source):
+    """Load and validate --coins, given as a JSON string, @path to a JSON
+    file, or an already decoded dict. Returns a dict of CoinConfig by
+    symbol, in the order given."""
+    if isinstance(source, str):
+        try:
+            if source.startswith("@"):
+                with open(source[1:]) as f:
+                    source = json.load(f, object_pairs_hook=reject_duplicates)
+            else:
+                source = json.loads(source, object_pairs_hook=reject_duplicates)
+        except ValueError as e:
+            raise (Exception("--coins isn't valid JSON: {}".format(e)))
+    if not isinstance(source, dict):
+        raise (Exception("--coins must be an object of coin settings by symbol"))
+    return {
+        symbol: (
+            config
+            if isinstance(config, CoinConfig)
+            else CoinConfig.from_dict(symbol, config)
+        )
+        for symbol, config in source.items()
+    }
+
+
+def get_coin_config(coins, coin):
+    """The CoinConfig for `coin`. Where `coins` still holds raw --coins
+    dicts, as library callers may pass, the coin's is converted in place."""
+    config = coins[coin]
+    if not isinstance(config, CoinConfig):
+        config = coins[coin] = CoinConfig.from_dict(coin, config)
+    return config
+
+
+def copy_coin_configs(coins):
+    """A copy of `coins` whose product metadata can be updated separately."""
+    return {
+        c: (
+            config.__copy__()
+            if isinstance(config, CoinConfig)
+            else CoinConfig.from_dict(c, config)
+        )
+        for c, config in coins.items()
+    }
+
+
+def dump_coin_configs(coins):
+    return json.dumps(
+        {
+            c: (config.to_dict() if isinstance(config, CoinConfig) else config)
+            for c, config in coins.items()
+        },
+        separators=(",", ":"),
+    )
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import datetime
+import random
+import signal
+import sys
+import threading
+
+# (minimum, maximum) for each of the cron fields: minute, hour, day of month,
+# month and day of week (0 or 7 is Sunday)
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def parse_cron_field(field, minimum, maximum):
+    values = set()
+    for part in field.split(","):
+        value, _, step = part.partition("/")
+        if value == "*":
+            start, end = minimum, maximum
+        elif "-" in value:
+            start, end = [int(v) for v in value.split("-")]
+        else:
+            start = end = int(value)
+            if step:
+                end = maximum
+        if start < minimum or end > maximum or start > end:
+            raise (Exception("invalid cron field {}".format(field)))
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronSchedule:
+    """A standard five field cron schedule, such as "28 0 * * *"."""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise (
+                Exception("expected 5 fields in cron schedule {}".format(expression))
+            )
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            parse_cron_field(f, *limits) for f, limits in zip(fields, CRON_FIELDS)
+        ]
+        self.weekdays = {d % 7 for d in weekdays}
+        # As in cron, if both the day of month and day of week are restricted,
+        # a day matching either of them will do
+        self.any_day = fields[2] == "*" or fields[4] == "*"
+
+    def matches_day(self, t):
+        day = t.day in self.days
+        weekday = (t.isoweekday() % 7) in self.weekdays
+        if self.any_day:
+            return day and weekday
+        return day or weekday
+
+    def next_run(self, after):
+        """Return the first time matching the schedule that is strictly
+        after `after`, to the minute."""
+        t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Skip forward a month, day or hour at a time where we can, rather
+        # than testing every minute
+        limit = t + datetime.timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)
+                t = t.replace(day=1)
+            elif not self.matches_day(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t = t + datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise (Exception("no upcoming run for schedule {}".format(self.expression)))
+
+
+class Scheduler:
+    """Runs jobs on cron schedules until stopped. Each job is a
+    (name, CronSchedule, callable) tuple. Runs are delayed by a random
+    amount of up to `jitter` seconds, so many instances with the same
+    schedule don't all hit the API at the same moment."""
+
+    def __init__(self, jobs, jitter=0, now=datetime.datetime.now):
+        self.jobs = jobs
+        self.jitter = jitter
+        self.now = now
+        self.stopping = threading.Event()
+
+    def stop(self, *_):
+        print("stopping after any running job finishes")
+        sys.stdout.flush()
+        self.stopping.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def delay(self):
+        return datetime.timedelta(seconds=random.uniform(0, self.jitter))
+
+    def run(self, max_runs=None):
+        runs = 0
+        start = self.now()
+        scheduled = {}
+        upcoming = {}
+        for name, schedule, _ in self.jobs:
+            scheduled[name] = schedule.next_run(start)
+            upcoming[name] = scheduled[name] + self.delay()
+            print("next {} at {}".format(name, upcoming[name]))
+        sys.stdout.flush()
+
+        while not self.stopping.is_set():
+            if max_runs is not None and runs >= max_runs:
+                break
+            name, schedule, fn = min(self.jobs, key=lambda j: upcoming[j[0]])
+            wait = (upcoming[name] - self.now()).total_seconds()
+            if wait > 0 and self.stopping.wait(wait):
+                break
+            print("running {} (scheduled for {})".format(name, scheduled[name]))
+            sys.stdout.flush()
+            fn()
+            runs += 1
+            # Runs missed while this one was going are skipped, not queued
+            scheduled[name] = schedule.next_run(max(self.now(), scheduled[name]))
+            upcoming[name] = scheduled[name] + self.delay()
+            print("next {} at {}".format(name, upcoming[name]))
+            sys.stdout.flush()
+        return runs
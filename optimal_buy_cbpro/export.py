@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+import os
+from sqlalchemy import Boolean, DateTime, Float, Integer
+from .history import Deposit, Order, Withdrawal, get_session
+
+# The tables exported, and the column each is partitioned into months by.
+# Withdrawals aren't timestamped, so they're only partitioned by currency.
+EXPORT_TABLES = [
+    ("orders", Order, "created_at"),
+    ("deposits", Deposit, "payout_at"),
+    ("withdrawals", Withdrawal, None),
+]
+EXPORT_FORMATS = ["parquet", "arrow"]
+
+# What pyarrow's hive partitioning reads back as null
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def get_month(value):
+    return value.strftime("%Y-%m") if value is not None else None
+
+
+def iter_partitions(db_session, model, time_column, chunk_size):
+    """Stream a table out of the DB in chunks of at most `chunk_size` rows,
+    as (currency, month, rows) with the currency left out of the rows. The
+    rows are fetched `chunk_size` at a time from a server-side cursor (where
+    the DB has them) and ordered by partition, so each partition's chunks
+    come one after another and only one chunk is ever held in memory."""
+    table = model.__table__
+    columns = [c for c in table.columns if c.name != "currency"]
+    order_by = [table.c.currency]
+    if time_column is not None:
+        order_by.append(table.c[time_column])
+    order_by.append(table.c.id)
+    query = (
+        db_session.query(table.c.currency, *columns)
+        .order_by(*order_by)
+        .yield_per(chunk_size)
+    )
+    time_index = (
+        [c.name for c in columns].index(time_column)
+        if time_column is not None
+        else None
+    )
+
+    key = None
+    rows = []
+    for row in query:
+        month = get_month(row[time_index + 1]) if time_index is not None else None
+        row_key = (row[0], month)
+        if rows and (row_key != key or len(rows) >= chunk_size):
+            yield key + (rows,)
+            rows = []
+        key = row_key
+        rows.append(tuple(row[1:]))
+    if rows:
+        yield key + (rows,)
+
+
+def get_arrow_schema(pa, model):
+    types = {
+        Integer: pa.int64(),
+        Float: pa.float64(),
+        Boolean: pa.bool_(),
+        DateTime: pa.timestamp("us"),
+    }
+    fields = []
+    for c in model.__table__.columns:
+        if c.name == "currency":
+            continue
+        arrow_type = next(
+            (t for k, t in types.items() if isinstance(c.type, k)), pa.string()
+        )
+        fields.append(pa.field(c.name, arrow_type))
+    return pa.schema(fields)
+
+
+def get_partition_dir(out_dir, name, account, currency, month, time_column):
+    parts = [out_dir, name]
+    if account is not None:
+        parts.append("account={}".format(account))
+    parts.append("currency={}".format(currency or NULL_PARTITION))
+    if time_column is not None:
+        parts.append("month={}".format(month or NULL_PARTITION))
+    return os.path.join(*parts)
+
+
+class PartitionWriter:
+    """Writes one partition's chunks to a single file, one row group (or
+    record batch) per chunk."""
+
+    def __init__(self, path, schema, export_format):
+        import pyarrow as pa
+
+        self.schema = schema
+        if export_format == "parquet":
+            import pyarrow.parquet as pq
+
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            self.writer = pa.ipc.new_file(path, schema)
+
+    def write(self, rows):
+        import pyarrow as pa
+
+        columns = list(zip(*rows))
+        self.writer.write_table(
+            pa.Table.from_arrays(
+                [
+                    pa.array(list(values), type=field.type)
+                    for values, field in zip(columns, self.schema)
+                ],
+                schema=self.schema,
+            )
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+def export_table(
+    db_session,
+    name,
+    model,
+    time_column,
+    out_dir,
+    export_format="parquet",
+    chunk_size=10000,
+    account=None,
+):
+    """Export a history table into `out_dir`/`name`, one file per currency
+    (and month, if the table has a time column) in hive style directories
+    such as orders/currency=BTC/month=2019-01/part-0.parquet. A partition
+    exported before is overwritten. Returns the rows and files written."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise (
+            Exception(
+                "--mode export requires pyarrow "
+                "(pip install optimal-buy-cbpro[parquet])"
+            )
+        )
+
+    schema = get_arrow_schema(pa, model)
+    key = None
+    writer = None
+    rows_written = 0
+    files = 0
+    try:
+        for currency, month, rows in iter_partitions(
+            db_session, model, time_column, chunk_size
+        ):
+            if (currency, month) != key:
+                if writer is not None:
+                    writer.close()
+                    writer = None
+                key = (currency, month)
+                partition_dir = get_partition_dir(
+                    out_dir, name, account, currency, month, time_column
+                )
+                os.makedirs(partition_dir, exist_ok=True)
+                writer = PartitionWriter(
+                    os.path.join(partition_dir, "part-0.{}".format(export_format)),
+                    schema,
+                    export_format,
+                )
+                files += 1
+            writer.write(rows)
+            rows_written += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return {"rows": rows_written, "files": files}
+
+
+def export_history(db_session, out_dir, export_format, chunk_size, account=None):
+    summary = {}
+    for name, model, time_column in EXPORT_TABLES:
+        summary[name] = export_table(
+            db_session,
+            name,
+            model,
+            time_column,
+            out_dir,
+            export_format,
+            chunk_size,
+            account,
+        )
+        print(
+            "exported {} {} rows to {} {} files".format(
+                summary[name]["rows"], name, summary[name]["files"], export_format
+            )
+        )
+    return summary
+
+
+def run_export(args, accounts=None):
+    """Export the history DB, or with `accounts`, every account's history
+    DB, partitioned by account as well."""
+    if accounts is None:
+        targets = [(None, args.db_engine, args)]
+    else:
+        from .accounts import get_account_args, get_account_db_engine
+
+        targets = [
+            (a["name"], get_account_db_engine(a), get_account_args(args, a))
+            for a in accounts
+        ]
+    summaries = {}
+    for account, db_engine, account_args in targets:
+        db_session = get_session(
+            db_engine, account_args.db_journal_mode, account_args.db_synchronous
+        )
+        try:
+            summaries[account] = export_history(
+                db_session,
+                args.export_dir,
+                args.export_format,
+                args.export_chunk_size,
+                account,
+            )
+        finally:
+            db_session.close()
+    return summaries
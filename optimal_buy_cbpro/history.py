@@ -1,47 +1,401 @@
 #!/usr/bin/env python3
+import contextlib
+import datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, Float, DateTime, Integer
-from sqlalchemy import create_engine
+from sqlalchemy import Column, String, Float, DateTime, Integer, Text, Boolean
+from sqlalchemy import UniqueConstraint, create_engine, event, func, inspect, text
 from sqlalchemy.orm import sessionmaker
 
 Base = declarative_base()
 
+# The defaults for SQLite history DBs. In WAL mode a commit appends to the
+# log rather than rewriting the DB, readers don't block the writer, and with
+# synchronous=NORMAL the log is only fsynced at checkpoints. A crash can't
+# corrupt the DB either way; at worst a power cut loses the last commits.
+SQLITE_JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+SQLITE_SYNCHRONOUS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
 
 class Order(Base):
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True)
-    currency = Column(String)
+    currency = Column(String, index=True)
     price = Column(Float)
     size = Column(Float)
-    cbpro_order_id = Column(String)
-    created_at = Column(DateTime)
+    cbpro_order_id = Column(String, index=True)
+    created_at = Column(DateTime, index=True)
+    # Filled in by the sync mode: open, filled or cancelled
+    status = Column(String, index=True)
+    filled_size = Column(Float)
+    # The price the ladder was placed below, for the discount it captured
+    market_price = Column(Float)
 
 
 class Withdrawal(Base):
     __tablename__ = "withdrawals"
 
     id = Column(Integer, primary_key=True)
-    currency = Column(String)
+    currency = Column(String, index=True)
     amount = Column(Float)
     crypto_address = Column(String)
-    cbpro_withdrawal_id = Column(String)
+    cbpro_withdrawal_id = Column(String, index=True)
 
 
 class Deposit(Base):
     __tablename__ = "deposits"
 
     id = Column(Integer, primary_key=True)
-    currency = Column(String)
+    currency = Column(String, index=True)
     amount = Column(Float)
     payment_method_id = Column(String)
-    payout_at = Column(DateTime)
-    cbpro_deposit_id = Column(String)
+    payout_at = Column(DateTime, index=True)
+    cbpro_deposit_id = Column(String, index=True)
 
 
-def get_session(engine):
-    engine = create_engine(engine)
+class Fill(Base):
+    __tablename__ = "fills"
+    __table_args__ = (UniqueConstraint("product_id", "trade_id"),)
+
+    id = Column(Integer, primary_key=True)
+    trade_id = Column(Integer)
+    product_id = Column(String, index=True)
+    cbpro_order_id = Column(String, index=True)
+    side = Column(String)
+    price = Column(Float)
+    size = Column(Float)
+    fee = Column(Float)
+    liquidity = Column(String)
+    settled = Column(Boolean)
+    created_at = Column(DateTime, index=True)
+
+
+class SyncCursor(Base):
+    """The newest trade ID synced into the fills table for each product."""
+
+    __tablename__ = "sync_cursors"
+
+    product_id = Column(String, primary_key=True)
+    trade_id = Column(Integer)
+    synced_at = Column(DateTime)
+
+
+class VolatilityStats(Base):
+    """The running average true range for each product, so that each buy
+    only has to fold in the candles since the last one."""
+
+    __tablename__ = "volatility_stats"
+
+    product_id = Column(String, primary_key=True)
+    granularity = Column(Integer)
+    window = Column(Integer)
+    atr = Column(Float)
+    prev_close = Column(Float)
+    last_time = Column(Integer)
+    count = Column(Integer)
+
+
+class WithdrawnBalance(Base):
+    """Running total of the withdrawals table per currency, kept up to date
+    by add_withdrawal() so that reading it doesn't scan every withdrawal."""
+
+    __tablename__ = "withdrawn_balances"
+
+    currency = Column(String, primary_key=True)
+    amount = Column(Float, nullable=False, default=0.0)
+
+
+class CurrencyStats(Base):
+    """Running totals of the history per currency, kept up to date by
+    add_orders(), add_deposit() and add_fills() so that --mode report reads
+    one row per currency rather than scanning the history."""
+
+    __tablename__ = "currency_stats"
+
+    currency = Column(String, primary_key=True)
+    orders = Column(Integer, nullable=False, default=0)
+    deposited = Column(Float, nullable=False, default=0.0)
+    bought_size = Column(Float, nullable=False, default=0.0)
+    bought_cost = Column(Float, nullable=False, default=0.0)
+    fees = Column(Float, nullable=False, default=0.0)
+    # Fiat saved by buying below the market price the ladder was placed at,
+    # and the market value of the fills it's measured over
+    discount_captured = Column(Float, nullable=False, default=0.0)
+    discount_basis = Column(Float, nullable=False, default=0.0)
+
+
+class CacheEntry(Base):
+    __tablename__ = "cache_entries"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True)
+    payload = Column(Text)
+    fetched_at = Column(Float)
+
+
+def parse_time(timestamp):
+    """Parse an ISO 8601 timestamp from the API. fromisoformat() is much
+    faster than dateutil, but only reads a trailing Z from Python 3.11."""
+    try:
+        return datetime.datetime.fromisoformat(timestamp)
+    except (AttributeError, ValueError):
+        import dateutil.parser
+
+        return dateutil.parser.parse(timestamp)
+
+
+def add_withdrawal(db_session, withdrawal):
+    """Add a withdrawal and apply it to the running balance for its currency.
+    Both are written by the caller's next commit, so they can't disagree."""
+    db_session.add(withdrawal)
+    updated = (
+        db_session.query(WithdrawnBalance)
+        .filter_by(currency=withdrawal.currency)
+        .update(
+            {
+                WithdrawnBalance.amount: WithdrawnBalance.amount
+                + float(withdrawal.amount)
+            },
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        db_session.add(
+            WithdrawnBalance(
+                currency=withdrawal.currency, amount=float(withdrawal.amount)
+            )
+        )
+        # So that the balances can be read without flushing (see
+        # get_withdrawn_balances())
+        db_session.flush()
+
+
+def update_currency_stats(db_session, currency, **amounts):
+    """Add `amounts` to the running totals for `currency`, creating its row
+    if this is the first. Written by the caller's next commit."""
+    amounts = {k: v for k, v in amounts.items() if v}
+    if not amounts:
+        return
+    # Nothing this update touches is pending, so don't flush for it. The
+    # rows these totals are for then go out with the rest of the
+    # transaction's inserts at its commit, rather than in a flush per update
+    table = CurrencyStats.__table__
+    updated = (
+        db_session.connection()
+        .execute(
+            table.update()
+            .where(table.c.currency == currency)
+            .values({table.c[k]: table.c[k] + v for k, v in amounts.items()})
+        )
+        .rowcount
+    )
+    if not updated:
+        db_session.add(CurrencyStats(currency=currency, **amounts))
+        # So that the next update finds it
+        db_session.flush()
+
+
+def add_orders(db_session, orders):
+    """Add orders and count them in the totals for their currencies, with
+    one update per currency."""
+    counts = {}
+    for order in orders:
+        db_session.add(order)
+        counts[order.currency] = counts.get(order.currency, 0) + 1
+    for currency, count in counts.items():
+        update_currency_stats(db_session, currency, orders=count)
+
+
+def add_deposit(db_session, deposit):
+    """Add a deposit and apply it to the total deposited in its currency."""
+    db_session.add(deposit)
+    update_currency_stats(db_session, deposit.currency, deposited=float(deposit.amount))
+
+
+def get_fill_stats(fills, market_prices):
+    """The totals a batch of buy fills (Fill column dicts) adds, given the
+    market price of each fill's order where it's known."""
+    stats = {
+        "bought_size": 0.0,
+        "bought_cost": 0.0,
+        "fees": 0.0,
+        "discount_captured": 0.0,
+        "discount_basis": 0.0,
+    }
+    for f in fills:
+        if f["side"] != "buy":
+            continue
+        stats["bought_size"] += f["size"]
+        stats["bought_cost"] += f["size"] * f["price"]
+        stats["fees"] += f["fee"]
+        market_price = market_prices.get(f["cbpro_order_id"])
+        if market_price is not None:
+            stats["discount_captured"] += f["size"] * (market_price - f["price"])
+            stats["discount_basis"] += f["size"] * market_price
+    return stats
+
+
+def add_fills(db_session, product_id, fills):
+    """Insert fills (Fill column dicts) for `product_id` and apply them to the
+    totals for its base currency."""
+    db_session.bulk_insert_mappings(Fill, fills)
+    order_ids = list({f["cbpro_order_id"] for f in fills})
+    market_prices = {}
+    # Keep well under SQLite's limit on bound parameters
+    for i in range(0, len(order_ids), 500):
+        market_prices.update(
+            db_session.query(Order.cbpro_order_id, Order.market_price).filter(
+                Order.cbpro_order_id.in_(order_ids[i : i + 500]),
+                Order.market_price.isnot(None),
+            )
+        )
+    update_currency_stats(
+        db_session, product_id.split("-")[0], **get_fill_stats(fills, market_prices)
+    )
+
+
+def commit(db_session):
+    """Commit, unless inside batch_commits(), which commits once at its end."""
+    if not db_session.info.get("batch_depth"):
+        db_session.commit()
+
+
+@contextlib.contextmanager
+def batch_commits(db_session):
+    """Write the history rows committed within in one transaction at the end,
+    rather than one transaction (and fsync) per row. Rows are still committed
+    if the block raises, since they record things done on the exchange."""
+    db_session.info["batch_depth"] = db_session.info.get("batch_depth", 0) + 1
+    try:
+        yield db_session
+    finally:
+        db_session.info["batch_depth"] -= 1
+        if not db_session.info["batch_depth"]:
+            try:
+                db_session.commit()
+            except Exception:
+                db_session.rollback()
+                raise
+
+
+def rebuild_withdrawn_balances(db_session):
+    """Recompute the running balances from the full withdrawals table."""
+    db_session.query(WithdrawnBalance).delete()
+    totals = (
+        db_session.query(Withdrawal.currency, func.sum(Withdrawal.amount))
+        .group_by(Withdrawal.currency)
+        .all()
+    )
+    for currency, amount in totals:
+        db_session.add(WithdrawnBalance(currency=currency, amount=amount))
+    db_session.commit()
+
+
+def rebuild_currency_stats(db_session):
+    """Recompute the running totals from the full orders, deposits and fills
+    tables."""
+    db_session.query(CurrencyStats).delete()
+    db_session.flush()
+    for currency, count in (
+        db_session.query(Order.currency, func.count(Order.id))
+        .group_by(Order.currency)
+        .all()
+    ):
+        update_currency_stats(db_session, currency, orders=count)
+    for currency, amount in (
+        db_session.query(Deposit.currency, func.sum(Deposit.amount))
+        .group_by(Deposit.currency)
+        .all()
+    ):
+        update_currency_stats(db_session, currency, deposited=amount)
+    rows = (
+        db_session.query(
+            Fill.product_id,
+            func.sum(Fill.size),
+            func.sum(Fill.size * Fill.price),
+            func.sum(Fill.fee),
+            # NULL for fills of orders without a market price, which SUM skips
+            func.sum(Fill.size * (Order.market_price - Fill.price)),
+            func.sum(Fill.size * Order.market_price),
+        )
+        .outerjoin(Order, Order.cbpro_order_id == Fill.cbpro_order_id)
+        .filter(Fill.side == "buy")
+        .group_by(Fill.product_id)
+        .all()
+    )
+    for product_id, size, cost, fees, captured, basis in rows:
+        update_currency_stats(
+            db_session,
+            product_id.split("-")[0],
+            bought_size=size,
+            bought_cost=cost,
+            fees=fees,
+            discount_captured=captured,
+            discount_basis=basis,
+        )
+    db_session.commit()
+
+
+def migrate(engine, db_session):
+    """Bring a history DB created by an older version up to date. New tables
+    are created, columns and indexes missing from existing tables are added,
+    and the withdrawn balance ledger and currency totals are filled in from
+    past history."""
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
     Base.metadata.create_all(engine)
+    # create_all() skips tables that already exist, columns and indexes
+    # included
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            continue
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name not in columns:
+                    conn.execute(
+                        text(
+                            "ALTER TABLE {} ADD COLUMN {} {}".format(
+                                table.name,
+                                column.name,
+                                column.type.compile(engine.dialect),
+                            )
+                        )
+                    )
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    if "withdrawn_balances" not in existing and "withdrawals" in existing:
+        rebuild_withdrawn_balances(db_session)
+    if "currency_stats" not in existing and existing & {"orders", "deposits", "fills"}:
+        rebuild_currency_stats(db_session)
+
+
+def set_sqlite_pragmas(engine, journal_mode, synchronous):
+    if journal_mode is not None and journal_mode.upper() not in SQLITE_JOURNAL_MODES:
+        raise (Exception("unknown SQLite journal mode {}".format(journal_mode)))
+    if synchronous is not None and synchronous.upper() not in SQLITE_SYNCHRONOUS:
+        raise (Exception("unknown SQLite synchronous level {}".format(synchronous)))
+
+    # Pragmas are per connection, so set them on each one the pool opens
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if journal_mode is not None:
+            # In-memory DBs quietly stay in MEMORY mode
+            cursor.execute("PRAGMA journal_mode={}".format(journal_mode))
+        if synchronous is not None:
+            cursor.execute("PRAGMA synchronous={}".format(synchronous))
+        cursor.close()
+
+
+def get_session(engine, journal_mode="WAL", synchronous="NORMAL"):
+    """Open a session on the history DB at the `engine` URL, bringing its
+    schema up to date. SQLite DBs use `journal_mode` and `synchronous`, or
+    SQLite's own defaults (DELETE and FULL) where these are None."""
+    engine = create_engine(engine)
+    if engine.dialect.name == "sqlite":
+        set_sqlite_pragmas(engine, journal_mode, synchronous)
     Session = sessionmaker(bind=engine)
     session = Session()
+    migrate(engine, session)
     return session
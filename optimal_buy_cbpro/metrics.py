@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Histogram buckets (in seconds) for API call and DB commit latencies
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Path segments following these hold IDs, which are dropped from endpoint
+# names so that every product or order shares one series
+ID_SEGMENTS = {"products", "orders", "accounts", "fills"}
+
+
+def endpoint_name(method, path):
+    parts = [p for p in path.split("?")[0].split("/") if p]
+    for i in range(1, len(parts)):
+        if parts[i - 1] in ID_SEGMENTS:
+            parts[i] = "{id}"
+    return "{} /{}".format(method.upper(), "/".join(parts))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bucket in enumerate(BUCKETS):
+            if value <= bucket:
+                self.counts[i] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip([str(b) for b in BUCKETS], self.counts)),
+        }
+
+
+class Metrics:
+    """Timings collected over a process's runs: phase spans, a count and
+    latency histogram per API endpoint, and DB commit latencies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.api_calls = {}
+            self.api_latency = {}
+            self.retries = {}
+            self.commits = Histogram()
+            # Only the latest run of each mode (and account), so a daemon's
+            # metrics don't grow with every run it makes
+            self.runs = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, {"count": 0, "sum": 0.0})
+                phase["count"] += 1
+                phase["sum"] += elapsed
+
+    def observe_call(self, api, endpoint, status, seconds):
+        with self.lock:
+            key = (api, endpoint, str(status))
+            self.api_calls[key] = self.api_calls.get(key, 0) + 1
+            self.api_latency.setdefault((api, endpoint), Histogram()).observe(seconds)
+
+    def observe_retry(self, api, call, reason):
+        with self.lock:
+            key = (api, call, reason)
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def response_hook(self, api):
+        """A requests response hook recording each call made to `api`."""
+
+        def hook(response, *args, **kwargs):
+            self.observe_call(
+                api,
+                endpoint_name(response.request.method, response.request.path_url),
+                response.status_code,
+                response.elapsed.total_seconds(),
+            )
+
+        return hook
+
+    def instrument_http(self, session, api):
+        session.hooks["response"].append(self.response_hook(api))
+        return session
+
+    def instrument_db(self, db_session):
+        from sqlalchemy import event
+
+        def before_commit(session):
+            self.local.commit_started = time.time()
+
+        def after_commit(session):
+            started = getattr(self.local, "commit_started", None)
+            if started is not None:
+                with self.lock:
+                    self.commits.observe(time.time() - started)
+                self.local.commit_started = None
+
+        event.listen(db_session, "before_commit", before_commit)
+        event.listen(db_session, "after_commit", after_commit)
+        return db_session
+
+    def record_run(self, mode, ok, seconds, account=None):
+        run = {"mode": mode, "ok": ok, "duration": seconds, "finished_at": time.time()}
+        if account is not None:
+            run["account"] = account
+        with self.lock:
+            # Re-inserted, so the runs stay in the order they last finished
+            self.runs.pop((mode, account), None)
+            self.runs[(mode, account)] = run
+
+    def summary(self):
+        with self.lock:
+            return {
+                "runs": list(self.runs.values()),
+                "phases": {k: dict(v) for k, v in self.phases.items()},
+                "api_calls": [
+                    {"api": api, "endpoint": endpoint, "status": status, "count": n}
+                    for (api, endpoint, status), n in sorted(self.api_calls.items())
+                ],
+                "api_latency": [
+                    {"api": api, "endpoint": endpoint, **h.to_dict()}
+                    for (api, endpoint), h in sorted(self.api_latency.items())
+                ],
+                "api_retries": [
+                    {"api": api, "call": call, "reason": reason, "count": n}
+                    for (api, call, reason), n in sorted(self.retries.items())
+                ],
+                "db_commits": self.commits.to_dict(),
+            }
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append("# HELP optimal_buy_cbpro_{} {}".format(name, help_text))
+            lines.append("# TYPE optimal_buy_cbpro_{} {}".format(name, kind))
+
+        def sample(name, labels, value):
+            label_text = ",".join(
+                '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                for k, v in labels
+            )
+            lines.append(
+                "optimal_buy_cbpro_{}{} {}".format(
+                    name, "{" + label_text + "}" if label_text else "", value
+                )
+            )
+
+        def histogram(name, labels, h):
+            for bucket, count in zip(BUCKETS, h.counts):
+                sample(name + "_bucket", labels + [("le", bucket)], count)
+            sample(name + "_bucket", labels + [("le", "+Inf")], h.count)
+            sample(name + "_sum", labels, h.sum)
+            sample(name + "_count", labels, h.count)
+
+        with self.lock:
+            if self.runs:
+                runs = [
+                    ([("mode", mode)] + ([("account", account)] if account else []), r)
+                    for (mode, account), r in sorted(
+                        self.runs.items(), key=lambda i: (i[0][0], i[0][1] or "")
+                    )
+                ]
+                metric("last_run_success", "gauge", "Whether the last run succeeded")
+                for labels, r in runs:
+                    sample("last_run_success", labels, int(r["ok"]))
+                metric("last_run_duration_seconds", "gauge", "Duration of the last run")
+                for labels, r in runs:
+                    sample("last_run_duration_seconds", labels, r["duration"])
+                metric(
+                    "last_run_timestamp_seconds", "gauge", "When the last run finished"
+                )
+                for labels, r in runs:
+                    sample("last_run_timestamp_seconds", labels, r["finished_at"])
+
+            metric("phase_seconds", "summary", "Time spent in each phase of a run")
+            for name, phase in sorted(self.phases.items()):
+                sample("phase_seconds_sum", [("phase", name)], phase["sum"])
+                sample("phase_seconds_count", [("phase", name)], phase["count"])
+
+            metric("api_requests_total", "counter", "API requests made")
+            for (api, endpoint, status), n in sorted(self.api_calls.items()):
+                sample(
+                    "api_requests_total",
+                    [("api", api), ("endpoint", endpoint), ("status", status)],
+                    n,
+                )
+
+            metric("api_request_seconds", "histogram", "API request latency")
+            for (api, endpoint), h in sorted(self.api_latency.items()):
+                histogram(
+                    "api_request_seconds", [("api", api), ("endpoint", endpoint)], h
+                )
+
+            metric("api_retries_total", "counter", "API calls retried")
+            for (api, call, reason), n in sorted(self.retries.items()):
+                sample(
+                    "api_retries_total",
+                    [("api", api), ("call", call), ("reason", reason)],
+                    n,
+                )
+
+            metric("db_commit_seconds", "histogram", "History DB commit latency")
+            histogram("db_commit_seconds", [], self.commits)
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path=None, prometheus_path=None):
+        if json_path is not None:
+            write_atomically(json_path, json.dumps(self.summary(), indent=2))
+        if prometheus_path is not None:
+            write_atomically(prometheus_path, self.prometheus())
+
+
+def write_atomically(path, content):
+    # The node exporter's textfile collector may read the file at any time,
+    # so never leave it half written
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+METRICS = Metrics()
@@ -1,34 +1,56 @@
 #!/usr/bin/env python3
 
-import cbpro
+# cbpro, requests, dateutil, SQLAlchemy (by way of .history) and NumPy are
+# imported where they're used, so that --help and the modes that don't need
+# them start quickly
 import argparse
+import os
 import sys
 import math
 import time
-import dateutil.parser
-import json
-import requests
-from .history import Order, Deposit, Withdrawal, get_session
-from requests.exceptions import HTTPError
+from .coins import COINS_ENV, dump_coin_configs, get_coin_config, load_coin_configs
+from .metrics import METRICS
+from .throttle import RateLimiter, run_concurrently, share_connection_pool
 
+COINCAP_ASSETS_URL = "https://api.coincap.io/v2/assets"
+
+
+def fetch_market_caps(url=COINCAP_ASSETS_URL):
+    import requests
+
+    response = requests.get(url, hooks={"response": METRICS.response_hook("coincap")})
+    response.raise_for_status()
+    assets = response.json()
+    # Only keep what we need, which keeps the cached copy small
+    return {
+        "data": [
+            {"symbol": a["symbol"], "marketCapUsd": a["marketCapUsd"]}
+            for a in assets["data"]
+        ]
+    }
+
+
+def get_weights(coins, fiat_currency, cache=None, url=COINCAP_ASSETS_URL):
+    from requests.exceptions import HTTPError
 
-def get_weights(coins, fiat_currency):
-    market_cap = {}
     try:
-        response = requests.get("https://api.coincap.io/v2/assets")
-        assets = response.json()
-        coin_data = {}
-        for coin in assets["data"]:
-            coin_data[coin["symbol"]] = coin
-        for c in coins:
-            market_cap[c] = float(coin_data[c]["marketCapUsd"])
+        if cache is not None:
+            assets = cache.get("coincap_assets", lambda: fetch_market_caps(url))
+        else:
+            assets = fetch_market_caps(url)
     except HTTPError as e:
-        print(
-            "caught exception when fetching ticker for {} with name={}".format(
-                c, coins[c]["name"]
-            )
-        )
+        print("caught exception when fetching market caps: {}".format(e))
         raise e
+    return get_market_cap_weights(coins, assets)
+
+
+def get_market_cap_weights(coins, assets):
+    market_cap = {}
+    coin_data = {}
+    for coin in assets["data"]:
+        coin_data[coin["symbol"]] = coin
+    for c in coins:
+        market_cap[c] = float(coin_data[c]["marketCapUsd"])
 
     total_market_cap = sum(market_cap.values())
 
@@ -43,6 +65,16 @@ def get_weights(coins, fiat_currency):
 
 
 def deposit(args, cbpro_client, db_session):
+    check_deposit_args(args)
+    deposit = cbpro_client.deposit(
+        payment_method_id=args.payment_method_id,
+        amount=args.amount,
+        currency=args.fiat_currency,
+    )
+    record_deposit(args, deposit, db_session)
+
+
+def check_deposit_args(args):
     if args.amount is None:
         print("please specify deposit amount with `--amount`")
         sys.exit(1)
@@ -50,48 +82,89 @@ def deposit(args, cbpro_client, db_session):
         print("please provide a bank ID with `--payment-method-id`")
         sys.exit(1)
     print("performing deposit, amount={} {}".format(args.amount, args.fiat_currency))
-    deposit = cbpro_client.deposit(
-        payment_method_id=args.payment_method_id,
-        amount=args.amount,
-        currency=args.fiat_currency,
-    )
+
+
+def record_deposit(args, deposit, db_session):
+    from .history import Deposit, add_deposit, commit, parse_time
+
     print("deposit={}".format(deposit))
     if "id" in deposit:
-        db_session.add(
+        add_deposit(
+            db_session,
             Deposit(
                 payment_method_id=args.payment_method_id,
                 amount=args.amount,
                 currency=args.fiat_currency,
-                payout_at=dateutil.parser.parse(deposit["payout_at"]),
+                payout_at=parse_time(deposit["payout_at"]),
                 cbpro_deposit_id=deposit["id"],
-            )
+            ),
         )
-        db_session.commit()
+        commit(db_session)
 
 
-def get_products(cbpro_client, coins, fiat_currency):
+def fetch_products(cbpro_client):
     products = cbpro_client.get_products()
+    if not isinstance(products, list):
+        raise (Exception("unable to fetch products: {}".format(products)))
+    return products
+
+
+def get_products(cbpro_client, coins, fiat_currency, cache=None):
+    if cache is not None:
+        products = cache.get("cbpro_products", lambda: fetch_products(cbpro_client))
+    else:
+        products = fetch_products(cbpro_client)
+    set_minimum_order_sizes(coins, products, fiat_currency)
+    return products
+
+
+def set_minimum_order_sizes(coins, products, fiat_currency):
+    """Update each coin's product metadata, returning the coins whose
+    minimum order size or increments changed."""
+    changed = []
     for p in products:
         if p["base_currency"] in coins and p["quote_currency"] == fiat_currency:
-            coins[p["base_currency"]]["minimum_order_size"] = float(p["min_market_funds"])
-    return products
+            config = get_coin_config(coins, p["base_currency"])
+            if config.update_product(p):
+                print(
+                    "{} product minimum_order_size={} quote_increment={} "
+                    "base_increment={}".format(
+                        config.symbol,
+                        config.minimum_order_size,
+                        config.quote_increment,
+                        config.base_increment,
+                    )
+                )
+                changed.append(config.symbol)
+    return changed
 
 
-def get_prices(cbpro_client, coins, fiat_currency):
-    prices = {}
-    for c in coins:
+def get_prices(
+    cbpro_client,
+    coins,
+    fiat_currency,
+    max_workers=1,
+    rate_limiter=None,
+    fetch_times=None,
+):
+    def fetch_ticker(c):
         ticker = cbpro_client.get_product_ticker(
             product_id="{}-{}".format(c, fiat_currency)
         )
+        if fetch_times is not None:
+            fetch_times[c] = time.time()
         if "price" not in ticker:
             raise (Exception("no price available for {} ticker={}".format(c, ticker)))
         print("{} ticker={}".format(c, ticker))
-        prices[c] = float(ticker["price"])
-    return prices
+        return float(ticker["price"])
+
+    coin_list = list(coins)
+    results = run_concurrently(fetch_ticker, coin_list, max_workers, rate_limiter)
+    return dict(zip(coin_list, results))
 
 
 def get_external_balance(coins, coin):
-    external_balance = float(coins[coin].get("external_balance", 0))
+    external_balance = get_coin_config(coins, coin).external_balance
     if external_balance > 0:
         print("including external balance of {} {}".format(external_balance, coin))
     return external_balance
@@ -119,7 +192,15 @@ def get_account(accounts, currency):
             return a
 
 
-def set_buy_order(args, coin, price, size, cbpro_client, db_session):
+def get_accounts_by_currency(accounts):
+    # Like calling get_account() per currency, in one pass
+    accounts_by_currency = {}
+    for a in accounts:
+        accounts_by_currency.setdefault(a["currency"], a)
+    return accounts_by_currency
+
+
+def submit_buy_order(args, coin, price, size, cbpro_client):
     print("placing order coin={0} price={1:.2f} size={2:.8f}".format(coin, price, size))
     order = cbpro_client.buy(
         price="{0:.2f}".format(price),
@@ -129,21 +210,107 @@ def set_buy_order(args, coin, price, size, cbpro_client, db_session):
         post_only="true",
     )
     print("order={}".format(order))
-    if "id" in order:
-        db_session.add(
-            Order(
-                currency=coin,
-                size=size,
-                price=price,
-                cbpro_order_id=order["id"],
-                created_at=dateutil.parser.parse(order["created_at"]),
+    return order
+
+
+def get_order_row(coin, price, size, order, market_price=None):
+    from .history import Order, parse_time
+
+    return Order(
+        currency=coin,
+        size=size,
+        price=price,
+        cbpro_order_id=order["id"],
+        created_at=parse_time(order["created_at"]),
+        market_price=market_price,
+    )
+
+
+def record_buy_order(coin, price, size, order, db_session, market_price=None):
+    from .history import add_orders
+
+    if "id" not in order:
+        return False
+    add_orders(db_session, [get_order_row(coin, price, size, order, market_price)])
+    return True
+
+
+def set_buy_order(args, coin, price, size, cbpro_client, db_session, market_price=None):
+    from .history import commit
+
+    order = submit_buy_order(args, coin, price, size, cbpro_client)
+    if record_buy_order(coin, price, size, order, db_session, market_price):
+        commit(db_session)
+    return order
+
+
+def submit_buy_orders(args, buy_orders, cbpro_client, db_session, rate_limiter=None):
+    """Submit a batch of buy orders (dicts with `coin`, `price` and `size`)
+    concurrently, then persist every accepted order in one transaction.
+
+    Returns a report with one entry per order, giving its outcome and how
+    long the submission took. If any submission raised, the accepted orders
+    are still recorded before the first error is re-raised."""
+
+    def submit(buy_order):
+        start = time.time()
+        result = {
+            "coin": buy_order["coin"],
+            "price": buy_order["price"],
+            "size": buy_order["size"],
+            "market_price": buy_order.get("market_price"),
+        }
+        try:
+            order = submit_buy_order(
+                args,
+                buy_order["coin"],
+                buy_order["price"],
+                buy_order["size"],
+                cbpro_client,
+            )
+            result["order"] = order
+            result["outcome"] = "placed" if "id" in order else "rejected"
+        except Exception as e:
+            result["error"] = e
+            result["outcome"] = "error"
+        result["latency"] = time.time() - start
+        return result
+
+    report = run_concurrently(submit, buy_orders, args.api_concurrency, rate_limiter)
+    return finish_buy_orders(report, db_session)
+
+
+def finish_buy_orders(report, db_session):
+    """Record the accepted orders from a submission report in one
+    transaction, print the report and re-raise the first error in it."""
+    from .history import add_orders, commit
+
+    add_orders(
+        db_session,
+        [
+            get_order_row(
+                r["coin"], r["price"], r["size"], r["order"], r.get("market_price")
+            )
+            for r in report
+            if r["outcome"] == "placed"
+        ],
+    )
+    commit(db_session)
+
+    print("order report:")
+    for r in report:
+        print(
+            "  {0} price={1:.2f} size={2:.8f} outcome={3} latency={4:.3f}s".format(
+                r["coin"], r["price"], r["size"], r["outcome"], r["latency"]
             )
         )
-        db_session.commit()
-    return order
+    for r in report:
+        if r["outcome"] == "error":
+            raise r["error"]
+    return report
 
 
-def generate_buy_orders(coins, coin, args, amount_to_buy, price):
+def generate_buy_orders(coins, coin, args, amount_to_buy, price, discount_step=None):
     from decimal import Decimal, getcontext, ROUND_DOWN
 
     getcontext().prec = 8
@@ -152,7 +319,7 @@ def generate_buy_orders(coins, coin, args, amount_to_buy, price):
 
     # If the size is <= minimum * 5, set a single buy order, because otherwise
     # it will get rejected
-    minimum_order_size = coins[coin].get("minimum_order_size", 0.01)
+    minimum_order_size = get_coin_config(coins, coin).minimum_order_size
     number_of_orders = min(
         [
             args.order_count,
@@ -163,152 +330,446 @@ def generate_buy_orders(coins, coin, args, amount_to_buy, price):
     # Set 5 buy orders
     amount = Decimal(math.floor(100 * amount_to_buy / number_of_orders)) / Decimal(100)
     discount = 1 - args.starting_discount
+    if discount_step is None:
+        discount_step = args.discount_step
 
     for _ in range(0, number_of_orders):
         discounted_price = Decimal(math.floor(100.0 * price * discount)) / Decimal(100)
         size = amount / discounted_price
 
         buy_orders.append({"price": float(discounted_price), "size": float(size)})
-        discount = discount - args.discount_step
+        discount = discount - discount_step
     return buy_orders
 
 
-def place_buy_orders(args, amount_to_buy, coins, coin, price, cbpro_client, db_session):
+def get_buy_orders(args, amount_to_buy, coins, coin, price, discount_step=None):
     if amount_to_buy <= 0.01:
         print(
             "{}: balance_difference_fiat={}, not buying {}".format(
                 coin, amount_to_buy, coin
             )
         )
-        return
+        return []
     if price <= 0:
         print("price={}, not buying {}".format(price, coin))
-        return
+        return []
 
-    buy_orders = generate_buy_orders(coins, coin, args, amount_to_buy, price)
+    buy_orders = generate_buy_orders(
+        coins, coin, args, amount_to_buy, price, discount_step
+    )
     for order in buy_orders:
-        set_buy_order(
-            args, coin, order["price"], order["size"], cbpro_client, db_session
+        order["coin"] = coin
+        order["market_price"] = price
+    return buy_orders
+
+
+def place_buy_orders(
+    args,
+    amount_to_buy,
+    coins,
+    coin,
+    price,
+    cbpro_client,
+    db_session,
+    rate_limiter=None,
+):
+    buy_orders = get_buy_orders(args, amount_to_buy, coins, coin, price)
+    if buy_orders:
+        return submit_buy_orders(
+            args, buy_orders, cbpro_client, db_session, rate_limiter
         )
+    return []
 
 
 def start_buy_orders(
-    args, coins, accounts, prices, fiat_balances, fiat_amount, cbpro_client, db_session
+    args,
+    coins,
+    accounts,
+    prices,
+    fiat_balances,
+    fiat_amount,
+    cbpro_client,
+    db_session,
+    rate_limiter=None,
+    cache=None,
+    discount_steps=None,
+    books=None,
 ):
-    weights = get_weights(coins, args.fiat_currency)
+    with METRICS.phase("get_weights"):
+        weights = get_weights(coins, args.fiat_currency, cache, args.coincap_url)
+
+    buy_orders = plan_buy_orders(
+        args, coins, prices, fiat_balances, fiat_amount, weights, discount_steps
+    )
+    if args.book_snap and buy_orders:
+        from .orderbook import fetch_order_books, snap_buy_orders
+
+        with METRICS.phase("get_order_books"):
+            books = fetch_order_books(
+                cbpro_client,
+                {o["coin"] for o in buy_orders},
+                args.fiat_currency,
+                max_workers=args.api_concurrency,
+                rate_limiter=rate_limiter,
+            )
+        buy_orders = snap_buy_orders(args, coins, buy_orders, books)
+    elif books and buy_orders:
+        from .orderbook import snap_buy_orders
+
+        # Kept below the streamed best asks
+        buy_orders = snap_buy_orders(args, coins, buy_orders, books)
+    if args.amend_orders:
+        with METRICS.phase("place_orders"):
+            amend_buy_orders(
+                args, coins, buy_orders, cbpro_client, db_session, rate_limiter
+            )
+    elif buy_orders:
+        with METRICS.phase("place_orders"):
+            submit_buy_orders(args, buy_orders, cbpro_client, db_session, rate_limiter)
+
+
+def plan_buy_orders(
+    args, coins, prices, fiat_balances, fiat_amount, weights, discount_steps=None
+):
+    """The ladders to place for every coin, given the current balances and
+    the fiat available to spend."""
+    from .allocation import allocate
 
     # Determine amount of each coin, in fiat, to buy
     fiat_balance_sum = sum(fiat_balances.values())
     print("fiat_balance_sum={}".format(fiat_balance_sum))
 
-    target_amount_fiat = {}
-    for c in coins:
-        target_amount_fiat[c] = fiat_balance_sum * weights[c]
+    target_amount_fiat, balance_differences_fiat, amount_to_buy = allocate(
+        coins, fiat_balances, weights, fiat_amount
+    )
     print("target_amount_fiat={}".format(target_amount_fiat))
-
-    balance_differences_fiat = {}
-    for c in coins:
-        balance_differences_fiat[c] = round(target_amount_fiat[c] - fiat_balances[c], 2)
     print("balance_differences_fiat={}".format(balance_differences_fiat))
-
-    # Calculate portion of each to buy
-    sum_to_buy = 0
-    for coin in balance_differences_fiat:
-        if balance_differences_fiat[coin] >= 0:
-            sum_to_buy += balance_differences_fiat[coin]
-    amount_to_buy = {}
-    for coin in balance_differences_fiat:
-        amount_to_buy[coin] = (
-            math.floor(
-                100 * (balance_differences_fiat[coin] / sum_to_buy) * fiat_amount
-            )
-            / 100.0
-        )
-
     print("amount_to_buy={}".format(amount_to_buy))
 
+    # Submit the ladders for every coin as one batch, so orders go out
+    # concurrently and are persisted in a single transaction
+    discount_steps = discount_steps or {}
+    buy_orders = []
     for c in coins:
-        place_buy_orders(
-            args, amount_to_buy[c], coins, c, prices[c], cbpro_client, db_session
+        buy_orders.extend(
+            get_buy_orders(
+                args, amount_to_buy[c], coins, c, prices[c], discount_steps.get(c)
+            )
         )
+    return buy_orders
 
 
-def execute_withdrawal(cbpro_client, amount, currency, crypto_address, db_session):
+def get_withdrawal_amount(amount):
     # The cbpro API does something goofy where the account balance
     # has more decimal places than the withdrawal API supports, so
     # we have to account for that here. Plus, the format()
     # function will round the float, so we have to do some
     # janky flooring.
-    amount = "{0:.9f}".format(float(amount))[0:-1]
+    return "{0:.9f}".format(float(amount))[0:-1]
+
+
+def execute_withdrawal(cbpro_client, amount, currency, crypto_address, db_session):
+    amount = get_withdrawal_amount(amount)
     print("withdrawing {} {} to {}".format(amount, currency, crypto_address))
     transaction = cbpro_client.crypto_withdraw(
         amount=amount, currency=currency, crypto_address=crypto_address
     )
+    record_withdrawal(amount, currency, crypto_address, transaction, db_session)
+
+
+def record_withdrawal(amount, currency, crypto_address, transaction, db_session):
+    from .history import Withdrawal, add_withdrawal, commit
+
     print("transaction={}".format(transaction))
     if "id" in transaction:
-        db_session.add(
+        add_withdrawal(
+            db_session,
             Withdrawal(
                 amount=amount,
                 currency=currency,
                 crypto_address=crypto_address,
                 cbpro_withdrawal_id=transaction["id"],
-            )
+            ),
         )
-        db_session.commit()
+        commit(db_session)
 
 
 def withdraw(coins, accounts, cbpro_client, db_session):
+    # Each withdrawal is committed as soon as it's made, as the coins have
+    # already left the account, so a crash can't lose it from the ledger
+    for coin, balance, address in get_withdrawals(coins, accounts):
+        execute_withdrawal(cbpro_client, balance, coin, address, db_session)
+
+
+def get_withdrawals(coins, accounts):
+    """The (coin, balance, address) of each coin that should be withdrawn."""
+    withdrawals = []
+    accounts_by_currency = get_accounts_by_currency(accounts)
     for coin in coins:
-        if (
-            "withdrawal_address" not in coins[coin]
-            or coins[coin]["withdrawal_address"] is None
-            or len(coins[coin]["withdrawal_address"]) < 1
-        ):
+        address = get_coin_config(coins, coin).withdrawal_address
+        if not address:
             print("no {} withdraw address specified, " "not withdrawing".format(coin))
             continue
-        account = get_account(accounts, coin)
+        account = accounts_by_currency.get(coin)
         if float(account["balance"]) < 0.01:
             print(
                 "{} balance only {}, not withdrawing".format(coin, account["balance"])
             )
         else:
-            execute_withdrawal(
-                cbpro_client,
-                account["balance"],
-                coin,
-                coins[coin]["withdrawal_address"],
-                db_session,
+            withdrawals.append((coin, account["balance"], address))
+    return withdrawals
+
+
+def get_open_orders(cbpro_client, product_ids):
+    open_orders = []
+    for o in cbpro_client.get_orders():
+        if not isinstance(o, dict):
+            raise (Exception("unable to list open orders: {}".format(o)))
+        if o["product_id"] in product_ids:
+            open_orders.append(o)
+    return open_orders
+
+
+def get_open_order_products(cbpro_client, product_ids):
+    return {o["product_id"] for o in get_open_orders(cbpro_client, product_ids)}
+
+
+def cancel_orders(args, coins, cbpro_client, rate_limiter=None):
+    product_ids = ["{}-{}".format(c, args.fiat_currency) for c in coins]
+    if args.cancel_open_only:
+        # One listing of open orders tells us which products need a cancel
+        open_products = get_open_order_products(cbpro_client, product_ids)
+        product_ids = [p for p in product_ids if p in open_products]
+    print("cancelling orders for {}".format(product_ids))
+    run_concurrently(
+        lambda p: cbpro_client.cancel_all(product_id=p),
+        product_ids,
+        args.api_concurrency,
+        rate_limiter,
+    )
+
+    # Don't read balances until the cancels have actually released the holds
+    confirm_cancelled(args, cbpro_client, product_ids)
+    return product_ids
+
+
+def confirm_cancelled(args, cbpro_client, product_ids, order_ids=None):
+    """Wait for the open orders for `product_ids` (only those in `order_ids`,
+    if given) to be gone, checking up to --cancel-confirm-attempts times with
+    a growing pause in between."""
+    remaining = set()
+    for attempt in range(args.cancel_confirm_attempts):
+        remaining = {
+            o["product_id"]
+            for o in get_open_orders(cbpro_client, product_ids)
+            if order_ids is None or o["id"] in order_ids
+        }
+        if not remaining or attempt == args.cancel_confirm_attempts - 1:
+            break
+        print("orders still open for {}, waiting".format(sorted(remaining)))
+        time.sleep(0.5 * (attempt + 1))
+    if remaining:
+        raise (Exception("orders still open after cancel for {}".format(remaining)))
+
+
+def within_tolerance(value, target, tolerance):
+    return abs(value - target) <= tolerance * abs(target)
+
+
+def diff_orders(buy_orders, open_orders, tolerance):
+    """Match the desired ladder for a product against its open orders.
+
+    An open buy order is kept if its price and remaining size are both
+    within `tolerance` (relative) of a desired rung. Returns the open
+    orders to keep, the open orders to cancel, and the rungs to place."""
+    remaining = []
+    for o in open_orders:
+        size = float(o["size"]) - float(o.get("filled_size") or 0)
+        remaining.append((o, float(o["price"]), size))
+
+    keep = []
+    place = []
+    for buy_order in sorted(buy_orders, key=lambda b: -b["price"]):
+        match = None
+        for i, (o, price, size) in enumerate(remaining):
+            if (
+                o.get("side", "buy") == "buy"
+                and within_tolerance(price, buy_order["price"], tolerance)
+                and within_tolerance(size, buy_order["size"], tolerance)
+            ):
+                match = i
+                break
+        if match is None:
+            place.append(buy_order)
+        else:
+            keep.append(remaining.pop(match)[0])
+    cancel = [o for o, _, _ in remaining]
+    return keep, cancel, place
+
+
+def amend_buy_orders(
+    args, coins, buy_orders, cbpro_client, db_session, rate_limiter=None
+):
+    """Bring the open orders in line with the desired ladders, rather than
+    cancelling everything and placing it all again. Only orders that have
+    drifted beyond --amend-tolerance are cancelled, and only missing rungs
+    are placed."""
+    product_ids = ["{}-{}".format(c, args.fiat_currency) for c in coins]
+    open_orders = get_open_orders(cbpro_client, product_ids)
+    keep, cancel, place = diff_all_orders(args, coins, buy_orders, open_orders)
+
+    cancelled = run_concurrently(
+        lambda o: cbpro_client.cancel_order(o["id"]),
+        cancel,
+        args.api_concurrency,
+        rate_limiter,
+    )
+    check_cancelled(cancel, cancelled)
+
+    report = []
+    if place:
+        if cancel:
+            # The new orders need the fiat the cancelled ones were holding
+            confirm_cancelled(
+                args, cbpro_client, product_ids, {o["id"] for o in cancel}
+            )
+        report = submit_buy_orders(args, place, cbpro_client, db_session, rate_limiter)
+    return get_amend_report(coins, buy_orders, keep, cancel, report)
+
+
+def diff_all_orders(args, coins, buy_orders, open_orders):
+    """diff_orders() for each coin's ladder."""
+    keep = []
+    cancel = []
+    place = []
+    for coin in coins:
+        product_id = "{}-{}".format(coin, args.fiat_currency)
+        k, c, p = diff_orders(
+            [b for b in buy_orders if b["coin"] == coin],
+            [o for o in open_orders if o["product_id"] == product_id],
+            args.amend_tolerance,
+        )
+        keep.extend(k)
+        cancel.extend(c)
+        place.extend(p)
+    for o in cancel:
+        print(
+            "cancelling order {} price={} size={}".format(
+                o["id"], o["price"], o["size"]
             )
+        )
+    return keep, cancel, place
+
+
+# What a cancel returns for an order that's no longer open, as when an
+# earlier attempt at a retried cancel got through
+CANCEL_DONE_MESSAGES = ["notfound", "not found", "already done"]
+
+
+def check_cancelled(cancel, cancelled):
+    for o, result in zip(cancel, cancelled):
+        if isinstance(result, dict) and "message" in result:
+            message = str(result["message"]).lower()
+            if any(m in message for m in CANCEL_DONE_MESSAGES):
+                continue
+            raise (Exception("unable to cancel order {}: {}".format(o["id"], result)))
+
+
+def get_amend_report(coins, buy_orders, keep, cancel, report):
+    # What cancelling and replacing everything would have cost: a cancel per
+    # product, a listing to confirm them, and every order placed again
+    replace_calls = len(coins) + 1 + len(buy_orders)
+    # A listing, the cancels, a listing to confirm them if anything's placed
+    # after them, and the orders placed
+    amend_calls = 1 + len(cancel) + (1 if cancel and report else 0) + len(report)
+    print(
+        "kept {} orders, cancelled {}, placed {}, saving {} API calls".format(
+            len(keep), len(cancel), len(report), replace_calls - amend_calls
+        )
+    )
+    return {
+        "kept": keep,
+        "cancelled": cancel,
+        "placed": report,
+        "api_calls_saved": replace_calls - amend_calls,
+    }
 
 
 def get_withdrawn_balances(db_session):
-    from sqlalchemy import func
+    from .history import WithdrawnBalance
 
+    # add_withdrawal() keeps every change to these in the DB already, so
+    # the rest of the transaction's rows needn't be flushed to read them
     withdrawn_balances = {}
-    withdrawals = (
-        db_session.query(func.sum(Withdrawal.amount), Withdrawal.currency)
-        .group_by(Withdrawal.currency)
-        .all()
-    )
-    for w in withdrawals:
-        withdrawn_balances[w[1]] = w[0]
+    with db_session.no_autoflush:
+        for currency, amount in db_session.query(
+            WithdrawnBalance.currency, WithdrawnBalance.amount
+        ):
+            withdrawn_balances[currency] = amount
     return withdrawn_balances
 
 
-def buy(args, coins, cbpro_client, db_session):
+def buy(args, coins, cbpro_client, db_session, market_data=None, price_book=None):
+    from .cache import ReferenceCache
+    from .retry import RetryingClient
+
     print("starting buy and (maybe) withdrawal")
     print("first, cancelling orders")
-    products = get_products(cbpro_client, coins, args.fiat_currency)
+    rate_limiter = RateLimiter(args.api_rate_limit)
+    if not isinstance(cbpro_client, RetryingClient):
+        cbpro_client = RetryingClient(
+            cbpro_client, args.call_attempts, args.call_backoff, rate_limiter
+        )
+    if market_data is not None:
+        # Reference data and prices are shared with other accounts in this run
+        cache = market_data
+        fetch_prices = market_data.get_prices
+    else:
+        cache = ReferenceCache(db_session, args.cache_ttl, args.cache_max_entries)
+        fetch_prices = get_prices
+    if price_book is not None:
+        fetch_prices = price_book.get_prices
+    with METRICS.phase("get_products"):
+        products = get_products(cbpro_client, coins, args.fiat_currency, cache)
     print("products={}".format(products))
-    for c in coins:
-        cbpro_client.cancel_all(product_id="{}-{}".format(c, args.fiat_currency))
+    if not args.amend_orders:
+        with METRICS.phase("cancel_orders"):
+            cancel_orders(args, coins, cbpro_client, rate_limiter)
     # Check if there's any fiat available to execute a buy
-    accounts = cbpro_client.get_accounts()
-    prices = get_prices(cbpro_client, coins, args.fiat_currency)
-    withdrawn_balances = get_withdrawn_balances(db_session)
+    with METRICS.phase("get_accounts"):
+        accounts = cbpro_client.get_accounts()
+    price_fetch_times = {}
+    with METRICS.phase("get_prices"):
+        prices = fetch_prices(
+            cbpro_client,
+            coins,
+            args.fiat_currency,
+            max_workers=args.api_concurrency,
+            rate_limiter=rate_limiter,
+            fetch_times=price_fetch_times,
+        )
+    with METRICS.phase("get_withdrawn_balances"):
+        withdrawn_balances = get_withdrawn_balances(db_session)
     print("accounts={}".format(accounts))
     print("prices={}".format(prices))
+    if price_fetch_times:
+        print(
+            "price snapshot skew={:.3f}s".format(
+                max(price_fetch_times.values()) - min(price_fetch_times.values())
+            )
+        )
     print("withdrawn_balances={}".format(withdrawn_balances))
+    books = None
+    if price_book is not None:
+        books = price_book.get_books(coins, args.fiat_currency)
+    discount_steps = None
+    if args.ladder_mode == "volatility":
+        from .volatility import get_discount_steps
+
+        with METRICS.phase("get_volatility"):
+            discount_steps = get_discount_steps(
+                args, coins, prices, cbpro_client, db_session, rate_limiter
+            )
 
     fiat_balances = get_fiat_balances(args, coins, accounts, withdrawn_balances, prices)
     print("fiat_balances={}".format(fiat_balances))
@@ -333,17 +794,48 @@ def buy(args, coins, cbpro_client, db_session):
             fiat_amount,
             cbpro_client,
             db_session,
+            rate_limiter=rate_limiter,
+            cache=cache,
+            discount_steps=discount_steps,
+            books=books,
         )
     else:
         print(
             "only {} {} fiat balance remaining, withdrawing"
             " coins without buying".format(fiat_amount, args.fiat_currency)
         )
-        withdraw(coins, accounts, cbpro_client, db_session)
+        if args.amend_orders:
+            # Nothing is being bought, so none of the open orders are wanted
+            with METRICS.phase("cancel_orders"):
+                cancel_orders(args, coins, cbpro_client, rate_limiter)
+        with METRICS.phase("withdraw"):
+            withdraw(coins, accounts, cbpro_client, db_session)
 
 
-def main():
-    default_coins = """
+def run_with_retries(fn, max_retries):
+    retry = 0
+    backoff = 5
+    while retry < max_retries:
+        retry += 1
+        print("attempt {} of {}".format(retry, max_retries))
+        try:
+            fn()
+            sys.stdout.flush()
+            return True
+        except Exception as e:
+            print("caught an exception: ", e)
+            import traceback
+
+            traceback.print_exc()
+            sys.stderr.flush()
+            sys.stdout.flush()
+            print("sleeping for {}s".format(backoff))
+            time.sleep(backoff)
+            backoff = backoff * 2
+    return False
+
+
+DEFAULT_COINS = """
     {
       "BTC":{
         "name":"Bitcoin",
@@ -363,16 +855,24 @@ def main():
     }
     """
 
+
+def get_parser():
     parser = argparse.ArgumentParser(
         description="Buy coins!",
-        epilog="Default coins are as follows: {}".format(default_coins),
+        epilog="Default coins are as follows: {}".format(DEFAULT_COINS),
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser.add_argument("--mode", help="mode (deposit or buy)", required=True)
+    parser.add_argument(
+        "--mode",
+        help="mode (deposit, buy, sync, daemon, backtest, sweep, export or report)",
+        required=True,
+    )
     parser.add_argument("--amount", type=float, help="amount to deposit")
-    parser.add_argument("--key", help="API key", required=True)
-    parser.add_argument("--b64secret", help="API secret", required=True)
-    parser.add_argument("--passphrase", help="API passphrase", required=True)
+    parser.add_argument("--key", help="API key (required for deposit and buy)")
+    parser.add_argument("--b64secret", help="API secret (required for deposit and buy)")
+    parser.add_argument(
+        "--passphrase", help="API passphrase (required for deposit and buy)"
+    )
     parser.add_argument(
         "--api-url",
         help="API URL (default: https://api.pro.coinbase.com)",
@@ -396,6 +896,48 @@ def main():
     parser.add_argument(
         "--order-count", type=int, help="number of orders (default: 5)", default=5
     )
+    parser.add_argument(
+        "--ladder-mode",
+        help="How to space the ladder: fixed uses --discount-step, volatility "
+        "scales the step with each coin's recent average true range "
+        "(default: fixed)",
+        choices=["fixed", "volatility"],
+        default="fixed",
+    )
+    parser.add_argument(
+        "--book-snap",
+        help="Fetch each coin's level2 order book and snap the ladder onto "
+        "it: below the best ask, so post-only orders aren't rejected, and onto "
+        "nearby bid levels",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--book-snap-tolerance",
+        help="How far below its ladder price, as a fraction of it, an order "
+        "may be moved to sit on a bid level (default: 0.001)",
+        type=float,
+        default=0.001,
+    )
+    parser.add_argument(
+        "--volatility-window",
+        help="Number of candles to average the true range over (default: 14)",
+        type=int,
+        default=14,
+    )
+    parser.add_argument(
+        "--volatility-granularity",
+        help="Candle length in seconds for the average true range " "(default: 3600)",
+        type=int,
+        choices=[60, 300, 900, 3600, 21600, 86400],
+        default=3600,
+    )
+    parser.add_argument(
+        "--volatility-multiplier",
+        help="Discount step as a multiple of the average true range, relative "
+        "to the price (default: 0.5)",
+        type=float,
+        default=0.5,
+    )
     parser.add_argument(
         "--fiat-currency", help="Fiat currency (default: USD)", default="USD"
     )
@@ -410,6 +952,21 @@ def main():
         help="SQLAlchemy DB engine " "(default: sqlite:///cbpro_history.db)",
         default="sqlite:///cbpro_history.db",
     )
+    parser.add_argument(
+        "--db-journal-mode",
+        help="Journal mode for a SQLite history DB: DELETE, TRUNCATE, PERSIST, "
+        "MEMORY, WAL or OFF (default: WAL)",
+        type=str.upper,
+        default="WAL",
+    )
+    parser.add_argument(
+        "--db-synchronous",
+        help="How often a SQLite history DB syncs to disk: OFF, NORMAL, FULL "
+        "or EXTRA. NORMAL is durable through crashes in WAL mode, only "
+        "fsyncing at checkpoints (default: NORMAL)",
+        type=str.upper,
+        default="NORMAL",
+    )
     parser.add_argument(
         "--max-retries",
         help="Maximum number of times to "
@@ -422,8 +979,14 @@ def main():
         "--coins",
         help="Coins to trade, minimum trade size,"
         " withdrawal addresses and external balances. "
-        "Accepts a JSON string.",
-        default=default_coins,
+        "Accepts a JSON string, or @path to a JSON file. Defaults to "
+        "${} if set.".format(COINS_ENV),
+        default=os.environ.get(COINS_ENV, DEFAULT_COINS),
+    )
+    parser.add_argument(
+        "--coincap-url",
+        help="coincap assets API URL (default: {})".format(COINCAP_ASSETS_URL),
+        default=COINCAP_ASSETS_URL,
     )
     parser.add_argument(
         "--base-fee",
@@ -431,38 +994,432 @@ def main():
         type=float,
         default=0.0015,
     )
+    parser.add_argument(
+        "--client",
+        help="API client to use: sync makes calls from a thread pool, async "
+        "makes them from an asyncio event loop (requires aiohttp) "
+        "(default: sync)",
+        choices=["sync", "async"],
+        default="sync",
+    )
+    parser.add_argument(
+        "--api-concurrency",
+        help="Maximum number of concurrent API requests (default: 3)",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--api-rate-limit",
+        help="Maximum API requests per second, 0 to disable (default: 5)",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--cancel-open-only",
+        help="Only cancel orders for products that have open orders, "
+        "found from a single listing of open orders",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cancel-confirm-attempts",
+        help="Number of times to check that all orders are cancelled "
+        "before reading balances (default: 5)",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--amend-orders",
+        help="Keep open orders that still match the ladder, cancelling and "
+        "placing only what changed, instead of cancelling every order and "
+        "placing the whole ladder again",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--amend-tolerance",
+        help="How far (relative) an open order's price and size may be from "
+        "the ladder's and still be kept with --amend-orders (default: 0.002)",
+        type=float,
+        default=0.002,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds to reuse cached market caps and product metadata "
+        "before fetching them again (default: 300)",
+        type=float,
+        default=300,
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        help="Maximum number of cached reference data entries to keep "
+        "(default: 100)",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--backtest-data",
+        help="Historical candles to backtest for a coin, as COIN=PATH to a CSV "
+        "or Parquet file with time, low, high, open and close columns. "
+        "May be given more than once.",
+        action="append",
+    )
+    parser.add_argument(
+        "--backtest-interval",
+        help="Number of candles between buy runs when backtesting "
+        "(default: 1440, daily for minute candles)",
+        type=int,
+        default=1440,
+    )
+    parser.add_argument(
+        "--backtest-amount",
+        help="Fiat amount to buy of each coin per run when backtesting "
+        "(default: 100)",
+        type=float,
+        default=100,
+    )
+    parser.add_argument(
+        "--sweep-starting-discount",
+        help="Comma separated starting discounts to sweep "
+        "(default: --starting-discount)",
+    )
+    parser.add_argument(
+        "--sweep-discount-step",
+        help="Comma separated discount steps to sweep (default: --discount-step)",
+    )
+    parser.add_argument(
+        "--sweep-order-count",
+        help="Comma separated order counts to sweep (default: --order-count)",
+    )
+    parser.add_argument(
+        "--sweep-interval",
+        help="Comma separated backtest intervals to sweep "
+        "(default: --backtest-interval)",
+    )
+    parser.add_argument(
+        "--sweep-workers",
+        help="Number of worker processes for sweeps (default: number of CPUs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--sweep-rank-by",
+        help="Result to rank sweeps by (default: savings)",
+        choices=["savings", "discount_captured", "fill_rate"],
+        default="savings",
+    )
+    parser.add_argument(
+        "--sweep-top",
+        help="Number of top sweep results to print (default: 20)",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--sweep-output", help="Write the full ranked sweep results to this CSV file"
+    )
+    parser.add_argument(
+        "--accounts-config",
+        help="JSON file listing accounts to run the deposit or buy for in one "
+        "process. Each account needs a key, b64secret and passphrase, and may "
+        "set its own name, coins, db_engine and other options in args.",
+    )
+    parser.add_argument(
+        "--account-concurrency",
+        help="Maximum number of accounts to run at once (default: 4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--buy-schedule",
+        help="Cron schedule for buys in daemon mode (default: '28 0 * * *')",
+        default="28 0 * * *",
+    )
+    parser.add_argument(
+        "--deposit-schedule",
+        help="Cron schedule for deposits in daemon mode, such as '0 0 * * 1' "
+        "(default: no deposits)",
+    )
+    parser.add_argument(
+        "--schedule-jitter",
+        help="Delay each run in daemon mode by a random amount of up to this "
+        "many seconds (default: 0)",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--price-feed",
+        help="Where daemon mode gets prices from: rest fetches a ticker per "
+        "coin on every run, websocket streams them (default: rest)",
+        choices=["rest", "websocket"],
+        default="rest",
+    )
+    parser.add_argument(
+        "--websocket-url",
+        help="Websocket feed URL (default: wss://ws-feed.pro.coinbase.com)",
+        default="wss://ws-feed.pro.coinbase.com",
+    )
+    parser.add_argument(
+        "--price-max-age",
+        help="Seconds before a streamed price is too old to use (default: 60)",
+        type=float,
+        default=60,
+    )
+    parser.add_argument(
+        "--price-feed-record",
+        help="Append every websocket message to this file, for replaying later",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Write a JSON summary of phase timings, API calls and DB "
+        "commits to this file after each run",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write the same metrics in the Prometheus text format to this "
+        "file (for the node exporter's textfile collector) after each run",
+    )
+    parser.add_argument(
+        "--call-attempts",
+        help="Maximum attempts for each API call that fails with a connection "
+        "error, timeout, 429 or 5xx (default: 4)",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--call-backoff",
+        help="Seconds to back off before the first retry of an API call, "
+        "doubling (with jitter) on each retry after (default: 0.5)",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "--dry-run",
+        help="Buy on an in-process paper exchange, kept in memory, rather "
+        "than Coinbase Pro. No API keys are needed, and unless --db-engine "
+        "is given, the history DB is in memory too",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--paper-prices",
+        help="With --dry-run, replay the prices in this --price-feed-record "
+        "recording, one per cycle, rather than fetching live tickers",
+    )
+    parser.add_argument(
+        "--paper-market-caps",
+        help="With --dry-run, weight coins by the market caps in this saved "
+        "response from --coincap-url, rather than fetching them",
+    )
+    parser.add_argument(
+        "--paper-balance",
+        help="With --dry-run, the fiat balance to start the paper account "
+        "with (default: 10000)",
+        type=float,
+        default=10000,
+    )
+    parser.add_argument(
+        "--paper-cycles",
+        help="With --dry-run, how many buy cycles to run, moving to the next "
+        "prices after each (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--export-dir",
+        help="Directory --mode export writes the history tables to "
+        "(default: export)",
+        default="export",
+    )
+    parser.add_argument(
+        "--export-format",
+        help="File format --mode export writes: parquet, or arrow for Arrow "
+        "IPC files that can be memory-mapped (default: parquet)",
+        choices=["parquet", "arrow"],
+        default="parquet",
+    )
+    parser.add_argument(
+        "--export-chunk-size",
+        help="Rows --mode export reads from the DB at a time, and writes to "
+        "each row group (default: 10000)",
+        type=int,
+        default=10000,
+    )
+    return parser
+
 
+def run_with_metrics(args, mode, fn):
+    start = time.time()
+    ok = run_with_retries(fn, args.max_retries)
+    METRICS.record_run(mode, ok, time.time() - start)
+    METRICS.export(args.metrics_json, args.metrics_prom)
+    return ok
+
+
+def main():
+    parser = get_parser()
     args = parser.parse_args()
-    coins = json.loads(args.coins)
-    print("--coins='{}'".format(json.dumps(coins, separators=(",", ":"))))
+    try:
+        coins = load_coin_configs(args.coins)
+    except Exception as e:
+        parser.error(str(e))
+    print("--coins='{}'".format(dump_coin_configs(coins)))
+
+    if args.mode == "backtest":
+        from .backtest import run_backtest
+
+        run_backtest(args, coins)
+        sys.stdout.flush()
+        sys.exit(0)
+    if args.mode == "sweep":
+        from .backtest import run_sweep
+
+        run_sweep(args, coins)
+        sys.stdout.flush()
+        sys.exit(0)
+    if args.mode == "export":
+        from .export import run_export
+
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error(
+                "--mode export requires pyarrow "
+                "(pip install optimal-buy-cbpro[parquet])"
+            )
+        accounts = None
+        if args.accounts_config is not None:
+            from .accounts import load_accounts
+
+            accounts = load_accounts(args.accounts_config)
+        ok = run_with_metrics(args, "export", lambda: run_export(args, accounts))
+        sys.stdout.flush()
+        sys.exit(0 if ok else 1)
+    if args.mode == "report":
+        from .report import run_report
+
+        accounts = None
+        if args.accounts_config is not None:
+            from .accounts import load_accounts
+
+            accounts = load_accounts(args.accounts_config)
+        ok = run_with_metrics(args, "report", lambda: run_report(args, coins, accounts))
+        sys.stdout.flush()
+        sys.exit(0 if ok else 1)
+    if args.dry_run:
+        from .history import get_session
+        from .paper import run_paper
+
+        if args.mode != "buy" or args.client == "async" or args.accounts_config:
+            parser.error("--dry-run supports --mode buy, for one account")
+        db_engine = args.db_engine
+        if db_engine == parser.get_default("db_engine"):
+            db_engine = "sqlite://"
+        db_session = get_session(db_engine, args.db_journal_mode, args.db_synchronous)
+        METRICS.instrument_db(db_session)
+        ok = run_with_metrics(args, "paper", lambda: run_paper(args, coins, db_session))
+        sys.stdout.flush()
+        sys.exit(0 if ok else 1)
+    if args.accounts_config is not None:
+        from .accounts import load_accounts, run_accounts
+
+        if args.client == "async":
+            parser.error("--client async can't be used with --accounts-config")
+        if args.mode == "daemon":
+            parser.error("--mode daemon can't be used with --accounts-config")
+
+        results = run_accounts(args, coins, load_accounts(args.accounts_config))
+        METRICS.export(args.metrics_json, args.metrics_prom)
+        sys.stdout.flush()
+        sys.exit(0 if all(r["ok"] for r in results) else 1)
+    if args.key is None or args.b64secret is None or args.passphrase is None:
+        parser.error("--key, --b64secret and --passphrase are required")
+    if args.client == "async" and (
+        args.mode not in ("deposit", "buy")
+        or args.ladder_mode != "fixed"
+        or args.book_snap
+    ):
+        parser.error(
+            "--client async supports deposit and buy with a fixed ladder, "
+            "without --book-snap"
+        )
+
+    import cbpro
+    from .history import get_session
 
     cbpro_client = cbpro.AuthenticatedClient(
         args.key, args.b64secret, args.passphrase, args.api_url
     )
-    db_session = get_session(args.db_engine)
+    share_connection_pool(cbpro_client.session, args.api_concurrency)
+    METRICS.instrument_http(cbpro_client.session, "cbpro")
+    db_session = get_session(args.db_engine, args.db_journal_mode, args.db_synchronous)
+    METRICS.instrument_db(db_session)
 
-    retry = 0
-    backoff = 5
-    while retry < args.max_retries:
-        retry += 1
-        print("attempt {} of {}".format(retry, args.max_retries))
-        try:
-            if args.mode == "deposit":
-                deposit(args, cbpro_client, db_session)
-            elif args.mode == "buy":
-                buy(args, coins, cbpro_client, db_session)
-            sys.stdout.flush()
-            sys.exit(0)
-        except Exception as e:
-            print("caught an exception: ", e)
-            import traceback
+    if args.mode == "daemon":
+        from .daemon import CronSchedule, Scheduler
 
-            traceback.print_exc()
-            sys.stderr.flush()
-            sys.stdout.flush()
-            print("sleeping for {}s".format(backoff))
-            time.sleep(backoff)
-            backoff = backoff * 2
+        if args.deposit_schedule is not None and (
+            args.amount is None or args.payment_method_id is None
+        ):
+            parser.error("--deposit-schedule needs --amount and --payment-method-id")
+
+        # The client, its connection pool and the DB engine stay warm between
+        # runs, rather than being set up from scratch every time
+        def job(mode, fn):
+            def run_job():
+                # Discard anything a previously failed run left uncommitted
+                db_session.rollback()
+                run_with_metrics(args, mode, fn)
+
+            return run_job
+
+        price_book = None
+        price_feed = None
+        if args.price_feed == "websocket":
+            from .pricebook import PriceBook, PriceFeed
+
+            price_book = PriceBook(args.price_max_age)
+            price_feed = PriceFeed(
+                price_book,
+                ["{}-{}".format(c, args.fiat_currency) for c in coins],
+                args.websocket_url,
+                args.price_feed_record,
+            )
+            price_feed.ensure_running()
+
+        def run_buy():
+            if price_feed is not None:
+                price_feed.ensure_running()
+            buy(args, coins, cbpro_client, db_session, price_book=price_book)
+
+        jobs = [("buy", CronSchedule(args.buy_schedule), job("buy", run_buy))]
+        if args.deposit_schedule is not None:
+            jobs.append(
+                (
+                    "deposit",
+                    CronSchedule(args.deposit_schedule),
+                    job("deposit", lambda: deposit(args, cbpro_client, db_session)),
+                )
+            )
+        scheduler = Scheduler(jobs, args.schedule_jitter)
+        scheduler.install_signal_handlers()
+        scheduler.run()
+        if price_feed is not None:
+            price_feed.shutdown()
+        sys.stdout.flush()
+        sys.exit(0)
+
+    def run():
+        if args.client == "async":
+            from .aio import run_async
+
+            run_async(args, coins, db_session)
+        elif args.mode == "deposit":
+            deposit(args, cbpro_client, db_session)
+        elif args.mode == "buy":
+            buy(args, coins, cbpro_client, db_session)
+        elif args.mode == "sync":
+            from .sync import sync
+
+            sync(args, coins, cbpro_client, db_session)
+
+    if run_with_metrics(args, args.mode, run):
+        sys.exit(0)
 
 
 if __name__ == "main":
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import bisect
+import math
+from array import array
+from .coins import get_coin_config
+from .throttle import run_concurrently
+
+# Prices are sent to the exchange with 2 decimal places, so a ladder can't be
+# snapped any finer than this
+MIN_QUOTE_INCREMENT = 0.01
+
+
+class OrderBookSnapshot:
+    """The price levels of a level2 order book, each side held as a sorted
+    array of floats. Sizes aren't kept, since only where the levels sit
+    matters to the ladder."""
+
+    def __init__(self, bids, asks):
+        self.bids = array("d", sorted(bids))
+        self.asks = array("d", sorted(asks))
+
+    @classmethod
+    def from_level2(cls, book):
+        return cls(
+            [float(level[0]) for level in book.get("bids", [])],
+            [float(level[0]) for level in book.get("asks", [])],
+        )
+
+    @property
+    def best_bid(self):
+        return self.bids[-1] if self.bids else None
+
+    @property
+    def best_ask(self):
+        return self.asks[0] if self.asks else None
+
+    def bid_at_or_below(self, price):
+        i = bisect.bisect_right(self.bids, price)
+        return self.bids[i - 1] if i else None
+
+
+def fetch_order_books(
+    cbpro_client, coins, fiat_currency, max_workers=1, rate_limiter=None
+):
+    """Fetch a level2 snapshot of every coin's book concurrently. Coins whose
+    book can't be fetched are left out, and their ladders left as they are."""
+
+    def fetch_book(c):
+        book = cbpro_client.get_product_order_book(
+            "{}-{}".format(c, fiat_currency), level=2
+        )
+        if "bids" not in book or "asks" not in book:
+            print("no order book for {} book={}".format(c, book))
+            return None
+        return OrderBookSnapshot.from_level2(book)
+
+    coin_list = list(coins)
+    books = run_concurrently(fetch_book, coin_list, max_workers, rate_limiter)
+    return {c: b for c, b in zip(coin_list, books) if b is not None}
+
+
+def floor_to_increment(price, increment):
+    # The small nudge keeps prices that are already on the increment from
+    # being floored a whole increment down by float error
+    return round(math.floor(price / increment + 1e-9) * increment, 8)
+
+
+def snap_price(price, book, increment, tolerance):
+    """Move a buy price onto the book. It's kept at least one increment
+    below the best ask, so a post-only order can't cross the spread and be
+    rejected. Then it's moved down onto the nearest bid level within
+    `tolerance` (a fraction of the price), to join the queue there, and
+    floored to the increment."""
+    if book.best_ask is not None:
+        price = min(price, book.best_ask - increment)
+    level = book.bid_at_or_below(price)
+    if level is not None and price - level <= tolerance * price:
+        price = level
+    return floor_to_increment(price, increment)
+
+
+def snap_buy_orders(args, coins, buy_orders, books):
+    """Snap every order in the batch to its coin's book, keeping the fiat
+    spent on each the same. Orders for coins with no book are unchanged."""
+    snapped = []
+    for order in buy_orders:
+        book = books.get(order["coin"])
+        if book is None:
+            snapped.append(order)
+            continue
+        increment = max(
+            get_coin_config(coins, order["coin"]).quote_increment
+            or MIN_QUOTE_INCREMENT,
+            MIN_QUOTE_INCREMENT,
+        )
+        price = snap_price(order["price"], book, increment, args.book_snap_tolerance)
+        if price <= 0:
+            print("no room below the {} ask, not placing order".format(order["coin"]))
+            continue
+        if price != order["price"]:
+            print(
+                "snapped {} order from {:.2f} to {:.2f}".format(
+                    order["coin"], order["price"], price
+                )
+            )
+        snapped.append(
+            dict(order, price=price, size=order["price"] * order["size"] / price)
+        )
+    return snapped
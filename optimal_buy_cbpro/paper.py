@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+import copy
+import datetime
+import itertools
+import json
+import threading
+import time
+from array import array
+
+# The paper exchange quotes a cent either side of the last price
+SPREAD = 0.01
+# Cycles whose history rows are flushed to the DB together. Nothing in a
+# cycle flushes them, so without this they'd all be held until the end
+FLUSH_CYCLES = 100
+
+
+class RecordedPrices:
+    """Ticker prices replayed from a PriceFeed recording (see
+    --price-feed-record). Each advance() moves every product on to its next
+    recorded price, starting over once they run out."""
+
+    def __init__(self, path):
+        prices = {}
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                msg = json.loads(line)
+                if msg.get("type") == "ticker" and "price" in msg:
+                    prices.setdefault(msg["product_id"], array("d")).append(
+                        float(msg["price"])
+                    )
+        if not prices:
+            raise (Exception("no ticker messages in {}".format(path)))
+        self.prices = prices
+        self.tick = 0
+
+    def price(self, product_id):
+        prices = self.prices.get(product_id)
+        if not prices:
+            return None
+        return prices[self.tick % len(prices)]
+
+    def advance(self):
+        self.tick += 1
+
+
+class LivePrices:
+    """Ticker prices fetched from the public API, once per product per
+    cycle."""
+
+    def __init__(self, public_client):
+        self.public_client = public_client
+        self.prices = {}
+
+    def price(self, product_id):
+        if product_id not in self.prices:
+            ticker = self.public_client.get_product_ticker(product_id=product_id)
+            self.prices[product_id] = (
+                float(ticker["price"]) if "price" in ticker else None
+            )
+        return self.prices[product_id]
+
+    def advance(self):
+        self.prices = {}
+
+
+class PaperExchange:
+    """An in-process stand-in for cbpro.AuthenticatedClient, covering the
+    calls made by a deposit, buy or sync. Balances, holds, orders and fills
+    are kept in memory, and nothing is sent anywhere.
+
+    Prices come from `prices` (RecordedPrices or LivePrices). Open buy orders
+    fill when advance() moves the price to or below theirs, paying
+    `maker_fee` as a fraction of the order's value. Like cbpro, calls return
+    the decoded response whatever happened, errors included."""
+
+    def __init__(
+        self, coins, prices, fiat_currency="USD", fiat_balance=0.0, maker_fee=0
+    ):
+        self.coins = list(coins)
+        self.prices = prices
+        self.fiat_currency = fiat_currency
+        self.maker_fee = maker_fee
+        self.lock = threading.Lock()
+        self.balances = {c: 0.0 for c in self.coins}
+        self.balances[fiat_currency] = float(fiat_balance)
+        self.holds = {c: 0.0 for c in self.balances}
+        self.orders = {}
+        self.fills = []
+        self.ids = itertools.count(1)
+
+    def now(self):
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def next_id(self, kind):
+        return "paper-{}-{}".format(kind, next(self.ids))
+
+    def product_id(self, coin):
+        return "{}-{}".format(coin, self.fiat_currency)
+
+    def get_products(self):
+        return [
+            {
+                "id": self.product_id(c),
+                "base_currency": c,
+                "quote_currency": self.fiat_currency,
+                "base_min_size": "0.001",
+                "base_increment": "0.00000001",
+                "quote_increment": "0.01",
+                "min_market_funds": "10",
+            }
+            for c in self.coins
+        ]
+
+    def get_product_ticker(self, product_id):
+        price = self.prices.price(product_id)
+        if price is None:
+            return {"message": "NotFound"}
+        return {
+            "price": "{:.2f}".format(price),
+            "bid": "{:.2f}".format(price - SPREAD),
+            "ask": "{:.2f}".format(price + SPREAD),
+            "time": self.now(),
+        }
+
+    def get_product_order_book(self, product_id, level=1):
+        price = self.prices.price(product_id)
+        if price is None:
+            return {"message": "NotFound"}
+        return {
+            "sequence": next(self.ids),
+            "bids": [["{:.2f}".format(price - SPREAD), "1.0", 1]],
+            "asks": [["{:.2f}".format(price + SPREAD), "1.0", 1]],
+        }
+
+    def get_product_historic_rates(self, product_id, **kwargs):
+        # No candles, so a volatility ladder keeps to --discount-step
+        return []
+
+    def get_accounts(self):
+        with self.lock:
+            return [
+                {
+                    "id": c,
+                    "currency": c,
+                    "balance": str(b),
+                    "available": str(b - self.holds[c]),
+                    "hold": str(self.holds[c]),
+                }
+                for c, b in self.balances.items()
+            ]
+
+    def get_orders(self, product_id=None, status=None):
+        with self.lock:
+            return [
+                copy.copy(o)
+                for o in self.orders.values()
+                if o["status"] == "open" and product_id in (None, o["product_id"])
+            ]
+
+    def get_order(self, order_id):
+        with self.lock:
+            if order_id.startswith("client:"):
+                client_oid = order_id[len("client:") :]
+                for o in self.orders.values():
+                    if o.get("client_oid") == client_oid:
+                        return copy.copy(o)
+            elif order_id in self.orders:
+                return copy.copy(self.orders[order_id])
+        return {"message": "NotFound"}
+
+    def release(self, order):
+        order["status"] = "done"
+        order["done_reason"] = "canceled"
+        self.holds[self.fiat_currency] -= float(order["price"]) * float(order["size"])
+
+    def cancel_all(self, product_id=None):
+        with self.lock:
+            cancelled = []
+            for o in self.orders.values():
+                if o["status"] == "open" and product_id in (None, o["product_id"]):
+                    self.release(o)
+                    cancelled.append(o["id"])
+            return cancelled
+
+    def cancel_order(self, order_id):
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None or order["status"] != "open":
+                return {"message": "NotFound"}
+            self.release(order)
+            return order_id
+
+    def buy(self, product_id, order_type, **kwargs):
+        if order_type != "limit":
+            return {"message": "paper exchange only takes limit orders"}
+        price = float(kwargs["price"])
+        size = float(kwargs["size"])
+        last = self.prices.price(product_id)
+        if last is None:
+            return {"message": "NotFound"}
+        if kwargs.get("post_only") in (True, "true") and price >= last + SPREAD:
+            return {"message": "Post only mode"}
+        with self.lock:
+            fiat = self.fiat_currency
+            if price * size > self.balances[fiat] - self.holds[fiat]:
+                return {"message": "Insufficient funds"}
+            self.holds[fiat] += price * size
+            order = {
+                "id": self.next_id("order"),
+                "client_oid": kwargs.get("client_oid"),
+                "product_id": product_id,
+                "side": "buy",
+                "type": "limit",
+                "price": kwargs["price"],
+                "size": kwargs["size"],
+                "filled_size": "0",
+                "post_only": kwargs.get("post_only"),
+                "status": "open",
+                "created_at": self.now(),
+            }
+            self.orders[order["id"]] = order
+            return copy.copy(order)
+
+    def crypto_withdraw(self, amount, currency, crypto_address):
+        with self.lock:
+            amount = float(amount)
+            if amount > self.balances.get(currency, 0) - self.holds.get(currency, 0):
+                return {"message": "Insufficient funds"}
+            self.balances[currency] -= amount
+            return {"id": self.next_id("withdrawal"), "amount": str(amount)}
+
+    def deposit(self, amount, currency, payment_method_id):
+        with self.lock:
+            self.balances[currency] = self.balances.get(currency, 0) + float(amount)
+            self.holds.setdefault(currency, 0.0)
+            return {"id": self.next_id("deposit"), "payout_at": self.now()}
+
+    def get_fills(self, product_id=None, order_id=None, before=None, limit=100):
+        """Fills newest first. With `before`, only the `limit` fills
+        following that trade ID, as the exchange pages forwards."""
+        with self.lock:
+            fills = [
+                f
+                for f in self.fills
+                if product_id in (None, f["product_id"])
+                and order_id in (None, f["order_id"])
+            ]
+        if before is not None:
+            fills = [f for f in fills if f["trade_id"] > int(before)][:limit]
+        return [copy.copy(f) for f in reversed(fills)]
+
+    def advance(self):
+        """Move on to the next prices, filling the open orders they reach."""
+        self.prices.advance()
+        filled = 0
+        with self.lock:
+            for o in self.orders.values():
+                if o["status"] != "open":
+                    continue
+                last = self.prices.price(o["product_id"])
+                price = float(o["price"])
+                if last is None or last > price:
+                    continue
+                size = float(o["size"])
+                fee = price * size * self.maker_fee
+                coin = o["product_id"].split("-")[0]
+                self.holds[self.fiat_currency] -= price * size
+                self.balances[self.fiat_currency] -= price * size + fee
+                self.balances[coin] += size
+                o["status"] = "done"
+                o["done_reason"] = "filled"
+                o["filled_size"] = o["size"]
+                self.fills.append(
+                    {
+                        "trade_id": len(self.fills) + 1,
+                        "product_id": o["product_id"],
+                        "order_id": o["id"],
+                        "side": "buy",
+                        "price": o["price"],
+                        "size": o["size"],
+                        "fee": "{:.16f}".format(fee),
+                        "liquidity": "M",
+                        "settled": True,
+                        "created_at": self.now(),
+                    }
+                )
+                filled += 1
+        return filled
+
+
+class PaperMarketData:
+    """Stands in for ReferenceCache in buy(), keeping market caps and product
+    metadata in memory for the whole paper run, so that cycles don't wait on
+    coincap or the DB. Market caps can be loaded from a saved coincap
+    /v2/assets response instead of being fetched at all."""
+
+    def __init__(self, market_caps_path=None):
+        self.values = {}
+        if market_caps_path is not None:
+            with open(market_caps_path) as f:
+                self.values["coincap_assets"] = json.load(f)
+
+    def get(self, key, fetch):
+        if key not in self.values:
+            self.values[key] = fetch()
+        return self.values[key]
+
+    def get_prices(self, cbpro_client, coins, fiat_currency, **kwargs):
+        # Prices move every cycle, so they're never kept
+        from .optimal_buy_cbpro import get_prices
+
+        return get_prices(cbpro_client, coins, fiat_currency, **kwargs)
+
+
+def create_paper_exchange(args, coins):
+    if args.paper_prices is not None:
+        prices = RecordedPrices(args.paper_prices)
+    else:
+        import cbpro
+
+        prices = LivePrices(cbpro.PublicClient(args.api_url))
+    return PaperExchange(
+        coins, prices, args.fiat_currency, args.paper_balance, args.base_fee
+    )
+
+
+def run_paper(args, coins, db_session, exchange=None, market_data=None):
+    """Run --paper-cycles buy cycles against a paper exchange, depositing
+    --amount before each one if given, then sync the fills into the DB.
+    Between cycles, the exchange moves on to its next prices."""
+    from .history import batch_commits
+    from .optimal_buy_cbpro import buy, deposit
+    from .sync import sync
+
+    exchange = exchange or create_paper_exchange(args, coins)
+    market_data = market_data or PaperMarketData(args.paper_market_caps)
+    # Calls to the paper exchange return at once, so there's no rate limit
+    # to stay under, and nothing for a thread pool to overlap
+    args = copy.copy(args)
+    args.api_rate_limit = 0
+    args.api_concurrency = 1
+    deposit_args = copy.copy(args)
+    if deposit_args.payment_method_id is None:
+        deposit_args.payment_method_id = "paper"
+
+    start = time.time()
+    filled = 0
+    # Nothing outside the process sees the history DB until the run is over,
+    # so its rows are committed once at the end rather than every cycle
+    with batch_commits(db_session):
+        for cycle in range(1, args.paper_cycles + 1):
+            if args.amount is not None:
+                deposit(deposit_args, exchange, db_session)
+            buy(args, coins, exchange, db_session, market_data=market_data)
+            filled += exchange.advance()
+            if cycle % FLUSH_CYCLES == 0:
+                db_session.flush()
+    elapsed = time.time() - start
+    sync(args, coins, exchange, db_session)
+
+    print(
+        "paper trading: {} cycles in {:.3f}s ({:.0f}/s), {} orders placed, "
+        "{} filled".format(
+            args.paper_cycles,
+            elapsed,
+            args.paper_cycles / elapsed if elapsed > 0 else 0,
+            len(exchange.orders),
+            filled,
+        )
+    )
+    print("paper balances:")
+    for currency, balance in exchange.balances.items():
+        print("  {} {}".format(currency, balance))
+    return exchange
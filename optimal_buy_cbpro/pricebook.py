@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import cbpro
+import json
+import threading
+import time
+from .optimal_buy_cbpro import get_prices
+
+
+class PriceBook:
+    """The latest ticker for each product, kept up to date from the
+    websocket feed (or a recording of it). Tickers older than `max_age`
+    seconds are treated as missing, and fetched over REST instead."""
+
+    def __init__(self, max_age=60, clock=time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tickers = {}
+
+    def update(self, msg):
+        if msg.get("type") != "ticker" or "price" not in msg:
+            return
+        product_id = msg["product_id"]
+        sequence = msg.get("sequence", 0)
+        with self.lock:
+            current = self.tickers.get(product_id)
+            # Messages can arrive out of order, so keep the newest one
+            if current is not None and sequence < current["sequence"]:
+                return
+            self.tickers[product_id] = {
+                "price": float(msg["price"]),
+                "best_bid": float(msg["best_bid"]) if msg.get("best_bid") else None,
+                "best_ask": float(msg["best_ask"]) if msg.get("best_ask") else None,
+                "sequence": sequence,
+                "received_at": self.clock(),
+            }
+
+    def get_ticker(self, product_id):
+        with self.lock:
+            ticker = self.tickers.get(product_id)
+        if ticker is None or self.clock() - ticker["received_at"] > self.max_age:
+            return None
+        return ticker
+
+    def get_books(self, coins, fiat_currency):
+        """The streamed best ask of each coin with a fresh one, as a book
+        that snap_buy_orders() can keep the ladder below. Its bids aren't
+        included, so orders are only moved down to stay under the ask."""
+        from .orderbook import OrderBookSnapshot
+
+        books = {}
+        for c in coins:
+            ticker = self.get_ticker("{}-{}".format(c, fiat_currency))
+            if ticker is not None and ticker["best_ask"] is not None:
+                books[c] = OrderBookSnapshot([], [ticker["best_ask"]])
+        return books
+
+    def get_prices(
+        self,
+        cbpro_client,
+        coins,
+        fiat_currency,
+        max_workers=1,
+        rate_limiter=None,
+        fetch_times=None,
+    ):
+        """Same as get_prices(), but reading from the book where it can."""
+        prices = {}
+        missing = []
+        for c in coins:
+            ticker = self.get_ticker("{}-{}".format(c, fiat_currency))
+            if ticker is None:
+                missing.append(c)
+                continue
+            prices[c] = ticker["price"]
+            if fetch_times is not None:
+                fetch_times[c] = ticker["received_at"]
+        if missing:
+            print("no fresh streamed price for {}, fetching them".format(missing))
+            prices.update(
+                get_prices(
+                    cbpro_client,
+                    missing,
+                    fiat_currency,
+                    max_workers=max_workers,
+                    rate_limiter=rate_limiter,
+                    fetch_times=fetch_times,
+                )
+            )
+        return {c: prices[c] for c in coins}
+
+
+class PriceFeed(cbpro.WebsocketClient):
+    """Feeds ticker messages for `products` into a PriceBook, optionally
+    recording every message to a file that replay() can load later."""
+
+    def __init__(self, book, products, url, record=None):
+        super().__init__(
+            url=url, products=products, channels=["ticker"], should_print=False
+        )
+        self.book = book
+        self.record = open(record, "a") if record is not None else None
+
+    def on_message(self, msg):
+        if self.record is not None:
+            self.record.write(json.dumps(msg) + "\n")
+            self.record.flush()
+        self.book.update(msg)
+
+    def _connect(self):
+        # cbpro lets a failed connect kill the feed thread without stopping
+        # the feed, so it would never be restarted
+        try:
+            super()._connect()
+        except Exception as e:
+            self.on_error(e)
+
+    def on_error(self, e, data=None):
+        print("price feed error: {}".format(e))
+        self.error = e
+        self.stop = True
+
+    def ensure_running(self):
+        if self.stop or self.thread is None or not self.thread.is_alive():
+            print("starting price feed for {}".format(self.products))
+            self.start()
+
+    def shutdown(self):
+        self.stop = True
+        # Closing the socket wakes the feed thread from recv()
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+        if self.record is not None:
+            # Let the feed thread finish with it first
+            if self.thread is not None:
+                self.thread.join(5)
+            self.record.close()
+            self.record = None
+
+
+def replay(book, path):
+    """Load a recording made by PriceFeed into `book`."""
+    count = 0
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                book.update(json.loads(line))
+                count += 1
+    return count
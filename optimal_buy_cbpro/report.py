@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+from .history import CurrencyStats, WithdrawnBalance, get_session
+
+
+def get_report(db_session, coins, fiat_currency, prices):
+    """Per coin: what was bought and at what average cost, including fees,
+    what it's worth at `prices` now, and the discount the ladder captured
+    against the market price each filled order was placed below. Read from
+    the running totals, so it takes the same time however long the history
+    is. Fills only count once --mode sync has stored them."""
+    stats = {s.currency: s for s in db_session.query(CurrencyStats).all()}
+    withdrawn = {w.currency: w.amount for w in db_session.query(WithdrawnBalance).all()}
+    report = {}
+    for c in coins:
+        s = stats.get(c)
+        if s is None:
+            continue
+        invested = s.bought_cost + s.fees
+        price = prices.get(c)
+        value = s.bought_size * price if price is not None else None
+        report[c] = {
+            "orders": s.orders,
+            "size": s.bought_size,
+            "withdrawn": withdrawn.get(c, 0.0),
+            "invested": invested,
+            "fees": s.fees,
+            "average_cost": invested / s.bought_size if s.bought_size else None,
+            "price": price,
+            "value": value,
+            "gain": value - invested if value is not None else None,
+            "discount_captured": s.discount_captured,
+            "discount": (
+                s.discount_captured / s.discount_basis if s.discount_basis else None
+            ),
+        }
+    fiat = stats.get(fiat_currency)
+    totals = {
+        "deposited": fiat.deposited if fiat is not None else 0.0,
+        "invested": sum(r["invested"] for r in report.values()),
+        "discount_captured": sum(r["discount_captured"] for r in report.values()),
+    }
+    values = [r["value"] for r in report.values()]
+    totals["value"] = sum(values) if None not in values else None
+    totals["gain"] = (
+        totals["value"] - totals["invested"] if totals["value"] is not None else None
+    )
+    return report, totals
+
+
+def format_amount(value, width=0, precision=2):
+    if value is None:
+        return "{:>{}}".format("-", width)
+    return "{:>{}.{}f}".format(value, width, precision)
+
+
+def print_report(report, totals, fiat_currency):
+    print("report ({}):".format(fiat_currency))
+    print(
+        "  {:<6} {:>7} {:>16} {:>14} {:>14} {:>14} {:>14} {:>12} {:>9}".format(
+            "coin",
+            "orders",
+            "size",
+            "invested",
+            "avg_cost",
+            "value",
+            "gain",
+            "discount",
+            "discount%",
+        )
+    )
+    for c, r in sorted(report.items()):
+        print(
+            "  {:<6} {:>7} {:>16.8f} {:>14.2f} {} {} {} {:>12.2f} {}".format(
+                c,
+                r["orders"],
+                r["size"],
+                r["invested"],
+                format_amount(r["average_cost"], 14),
+                format_amount(r["value"], 14),
+                format_amount(r["gain"], 14),
+                r["discount_captured"],
+                format_amount(
+                    r["discount"] * 100 if r["discount"] is not None else None,
+                    9,
+                    3,
+                ),
+            )
+        )
+    print(
+        "  deposited={:.2f} invested={:.2f} value={} gain={} "
+        "discount_captured={:.2f}".format(
+            totals["deposited"],
+            totals["invested"],
+            format_amount(totals["value"]),
+            format_amount(totals["gain"]),
+            totals["discount_captured"],
+        )
+    )
+
+
+def run_report(args, coins, accounts=None):
+    """Print the report for the history DB, or with `accounts`, for every
+    account's history DB and coins, valued at the current public ticker
+    prices."""
+    import cbpro
+    from .optimal_buy_cbpro import get_prices
+    from .throttle import RateLimiter
+
+    if accounts is None:
+        targets = [(None, args.db_engine, args, coins)]
+    else:
+        from .accounts import get_account_args, get_account_db_engine
+
+        targets = [
+            (
+                a["name"],
+                get_account_db_engine(a),
+                get_account_args(args, a),
+                a.get("coins", coins),
+            )
+            for a in accounts
+        ]
+    # One ticker per coin held by any account
+    all_coins = {}
+    for target in targets:
+        all_coins.update(dict.fromkeys(target[3]))
+    prices = get_prices(
+        cbpro.PublicClient(args.api_url),
+        all_coins,
+        args.fiat_currency,
+        max_workers=args.api_concurrency,
+        rate_limiter=RateLimiter(args.api_rate_limit),
+    )
+    reports = {}
+    for account, db_engine, account_args, account_coins in targets:
+        db_session = get_session(
+            db_engine, account_args.db_journal_mode, account_args.db_synchronous
+        )
+        try:
+            reports[account] = get_report(
+                db_session, account_coins, args.fiat_currency, prices
+            )
+        finally:
+            db_session.close()
+        if account is not None:
+            print("account {}:".format(account))
+        print_report(*reports[account], args.fiat_currency)
+    return reports
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import random
+import threading
+import time
+import types
+import uuid
+import requests
+from .metrics import METRICS
+
+# cbpro calls that can safely be repeated. Anything else (deposits and
+# withdrawals) is made once, as before. Orders are retried by buy() below.
+IDEMPOTENT_CALLS = {
+    "get_products",
+    "get_product_ticker",
+    "get_product_historic_rates",
+    "get_product_order_book",
+    "get_accounts",
+    "get_orders",
+    "get_order",
+    "get_fills",
+    "cancel_all",
+    "cancel_order",
+}
+
+# Failures where the request may never have reached the exchange, or its
+# response was lost (a non-JSON error page fails to decode, for example)
+RETRYABLE_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ValueError,
+)
+
+MAX_BACKOFF = 30
+
+
+def get_backoff(attempt, backoff, max_backoff=MAX_BACKOFF):
+    """Exponential backoff with full jitter: a random wait of up to
+    `backoff` seconds, doubling with each attempt, so that many callers
+    retrying at once spread out rather than all coming back together."""
+    return random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+
+
+def get_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class ResponseRecorder:
+    """A requests response hook remembering the status and Retry-After
+    header of the last response seen by each thread. cbpro hands back the
+    decoded body whatever the status, so this is how a 429 is told apart."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __call__(self, response, *args, **kwargs):
+        self.local.status = response.status_code
+        self.local.retry_after = response.headers.get("Retry-After")
+
+    def reset(self):
+        self.local.status = None
+        self.local.retry_after = None
+
+    @property
+    def status(self):
+        return getattr(self.local, "status", None)
+
+    @property
+    def retry_after(self):
+        return getattr(self.local, "retry_after", None)
+
+
+def get_response_recorder(session):
+    # One per session, however many times the client is wrapped
+    recorder = getattr(session, "response_recorder", None)
+    if recorder is None:
+        recorder = ResponseRecorder()
+        session.hooks["response"].append(recorder)
+        session.response_recorder = recorder
+    return recorder
+
+
+class RetryingClient:
+    """Wraps a cbpro client so that each call is retried by itself, rather
+    than the whole run starting over.
+
+    Connection errors, timeouts and 5xx responses are retried with jittered
+    exponential backoff. A 429 pauses `rate_limiter` for everyone, for at
+    least as long as the exchange's Retry-After asks. Calls are made at most
+    `max_attempts` times, after which the last response is returned (or
+    error raised) as usual.
+
+    Orders are given a client_oid, so that before an order is sent again,
+    the exchange can be asked whether the last attempt got through."""
+
+    def __init__(
+        self,
+        cbpro_client,
+        max_attempts=4,
+        backoff=0.5,
+        rate_limiter=None,
+        sleep=time.sleep,
+    ):
+        self.client = cbpro_client
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.rate_limiter = rate_limiter
+        self.sleep = sleep
+        session = getattr(cbpro_client, "session", None)
+        self.recorder = get_response_recorder(session) if session is not None else None
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name not in IDEMPOTENT_CALLS or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            def attempt():
+                result = attr(*args, **kwargs)
+                # Paginated calls only make their requests when iterated
+                if isinstance(result, types.GeneratorType):
+                    result = list(result)
+                return result
+
+            return self.call(name, attempt)
+
+        return call
+
+    def buy(self, **kwargs):
+        kwargs.setdefault("client_oid", str(uuid.uuid4()))
+
+        def find_order():
+            try:
+                order = self.client.get_order("client:{}".format(kwargs["client_oid"]))
+            except RETRYABLE_EXCEPTIONS:
+                return None
+            if isinstance(order, dict) and "id" in order:
+                print("order {} was placed after all".format(kwargs["client_oid"]))
+                return order
+            return None
+
+        return self.call("buy", lambda: self.client.buy(**kwargs), find_order)
+
+    def call(self, name, fn, find_result=None):
+        """Call `fn`, retrying transient failures. Before each retry,
+        `find_result` (if given) may return the result of an earlier attempt
+        that succeeded after all, which is returned instead."""
+        for attempt in range(1, self.max_attempts + 1):
+            if self.recorder is not None:
+                self.recorder.reset()
+            try:
+                result = fn()
+            except RETRYABLE_EXCEPTIONS as e:
+                if attempt == self.max_attempts:
+                    raise e
+                reason = type(e).__name__
+                wait = get_backoff(attempt, self.backoff)
+            else:
+                status = self.recorder.status if self.recorder is not None else None
+                if (
+                    attempt == self.max_attempts
+                    or status is None
+                    or (status != 429 and status < 500)
+                ):
+                    return result
+                reason = str(status)
+                wait = get_backoff(attempt, self.backoff)
+                if status == 429:
+                    wait = max(wait, get_retry_after(self.recorder.retry_after))
+
+            METRICS.observe_retry("cbpro", name, reason)
+            print(
+                "{} failed ({}) on attempt {} of {}, retrying in {:.2f}s".format(
+                    name, reason, attempt, self.max_attempts, wait
+                )
+            )
+            if reason == "429" and self.rate_limiter is not None:
+                # Hold back every other caller too, not just this one
+                self.rate_limiter.pause(wait)
+            self.sleep(wait)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            if find_result is not None:
+                found = find_result()
+                if found is not None:
+                    return found
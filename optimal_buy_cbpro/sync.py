@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import datetime
+from sqlalchemy import func
+from .history import Fill, Order, SyncCursor, add_fills, parse_time
+from .metrics import METRICS
+from .throttle import RateLimiter, run_concurrently
+
+# Fills per page, which is also the most the API will return
+PAGE_SIZE = 100
+
+
+def check_fills(product_id, fills):
+    # On an error, cbpro yields the keys of the error message rather than
+    # raising, so make sure we actually got fills back
+    for f in fills:
+        if not isinstance(f, dict):
+            raise (Exception("unable to fetch fills for {}: {}".format(product_id, f)))
+    return fills
+
+
+def fetch_new_fills(cbpro_client, product_id, cursor):
+    """Fetch the fills for `product_id` with a trade ID above `cursor`, or
+    every fill if there's no cursor yet."""
+    if cursor is None:
+        return check_fills(
+            product_id, list(cbpro_client.get_fills(product_id=product_id))
+        )
+    # Only one page is returned when paging forwards with `before`, so keep
+    # asking for the fills after the newest one seen until we've caught up
+    fills = []
+    while True:
+        page = check_fills(
+            product_id,
+            list(
+                cbpro_client.get_fills(
+                    product_id=product_id, before=cursor, limit=PAGE_SIZE
+                )
+            ),
+        )
+        fills.extend(page)
+        if len(page) < PAGE_SIZE:
+            return fills
+        cursor = max(int(f["trade_id"]) for f in page)
+
+
+def store_fills(db_session, product_id, fills):
+    """Insert the fills not already stored, and move the product's cursor
+    past them. Returns the number of fills inserted."""
+    cursor = db_session.query(SyncCursor).filter_by(product_id=product_id).one_or_none()
+    if cursor is None:
+        cursor = SyncCursor(product_id=product_id)
+        db_session.add(cursor)
+    cursor.synced_at = datetime.datetime.utcnow()
+    if not fills:
+        return 0
+
+    trade_ids = {int(f["trade_id"]) for f in fills}
+    stored = {
+        t
+        for (t,) in db_session.query(Fill.trade_id).filter(
+            Fill.product_id == product_id, Fill.trade_id >= min(trade_ids)
+        )
+    }
+    rows = {}
+    for f in fills:
+        trade_id = int(f["trade_id"])
+        if trade_id in stored:
+            continue
+        rows[trade_id] = {
+            "trade_id": trade_id,
+            "product_id": product_id,
+            "cbpro_order_id": f["order_id"],
+            "side": f["side"],
+            "price": float(f["price"]),
+            "size": float(f["size"]),
+            "fee": float(f["fee"]),
+            "liquidity": f.get("liquidity"),
+            "settled": f.get("settled"),
+            "created_at": parse_time(f["created_at"]),
+        }
+    add_fills(db_session, product_id, list(rows.values()))
+    cursor.trade_id = max(trade_ids | {cursor.trade_id or 0})
+    return len(rows)
+
+
+def get_pending_orders(db_session, coins):
+    """The orders not yet known to be filled or cancelled."""
+    return (
+        db_session.query(Order)
+        .filter(Order.currency.in_(list(coins)))
+        .filter((Order.status.is_(None)) | (Order.status == "open"))
+        .all()
+    )
+
+
+def get_open_order_ids(cbpro_client):
+    open_order_ids = set()
+    for o in cbpro_client.get_orders():
+        if not isinstance(o, dict):
+            raise (Exception("unable to list open orders: {}".format(o)))
+        open_order_ids.add(o["id"])
+    return open_order_ids
+
+
+def update_order_statuses(cbpro_client, db_session, coins, open_order_ids=None):
+    """Work out whether each order not yet known to be done is still open,
+    filled or was cancelled, from the open orders and the synced fills.
+
+    The open orders must be listed before the fills are synced (as sync()
+    does), or an order filled in between would be neither open nor have
+    its fills, and be taken as cancelled for good."""
+    pending = get_pending_orders(db_session, coins)
+    if not pending:
+        return {}
+
+    if open_order_ids is None:
+        open_order_ids = get_open_order_ids(cbpro_client)
+
+    filled_sizes = {}
+    order_ids = [o.cbpro_order_id for o in pending]
+    # Keep well under SQLite's limit on bound parameters
+    for i in range(0, len(order_ids), 500):
+        filled_sizes.update(
+            db_session.query(Fill.cbpro_order_id, func.sum(Fill.size))
+            .filter(Fill.cbpro_order_id.in_(order_ids[i : i + 500]))
+            .group_by(Fill.cbpro_order_id)
+            .all()
+        )
+
+    statuses = {}
+    for order in pending:
+        order.filled_size = filled_sizes.get(order.cbpro_order_id, 0.0)
+        if order.cbpro_order_id in open_order_ids:
+            order.status = "open"
+        elif order.filled_size >= order.size * (1 - 1e-9):
+            order.status = "filled"
+        else:
+            order.status = "cancelled"
+        statuses[order.status] = statuses.get(order.status, 0) + 1
+    return statuses
+
+
+def get_fill_summary(db_session):
+    """Per product: the number of fills, coins bought, fiat spent and fees
+    paid, and the average price paid."""
+    summary = {}
+    rows = (
+        db_session.query(
+            Fill.product_id,
+            func.count(Fill.id),
+            func.sum(Fill.size),
+            func.sum(Fill.size * Fill.price),
+            func.sum(Fill.fee),
+        )
+        .filter(Fill.side == "buy")
+        .group_by(Fill.product_id)
+        .all()
+    )
+    for product_id, count, size, cost, fees in rows:
+        summary[product_id] = {
+            "fills": count,
+            "size": size,
+            "cost": cost,
+            "fees": fees,
+            "average_price": (cost + fees) / size if size else None,
+        }
+    return summary
+
+
+def sync(args, coins, cbpro_client, db_session):
+    """Bring the fills and order statuses in the history DB up to date,
+    fetching only what has changed since the last sync."""
+    rate_limiter = RateLimiter(args.api_rate_limit)
+    product_ids = ["{}-{}".format(c, args.fiat_currency) for c in coins]
+    cursors = {
+        c.product_id: c.trade_id
+        for c in db_session.query(SyncCursor).filter(
+            SyncCursor.product_id.in_(product_ids)
+        )
+    }
+    # Listed before the fills are fetched (see update_order_statuses())
+    open_order_ids = None
+    if get_pending_orders(db_session, coins):
+        with METRICS.phase("list_open_orders"):
+            open_order_ids = get_open_order_ids(cbpro_client)
+    with METRICS.phase("sync_fills"):
+        fills = run_concurrently(
+            lambda p: fetch_new_fills(cbpro_client, p, cursors.get(p)),
+            product_ids,
+            args.api_concurrency,
+            rate_limiter,
+        )
+        for product_id, product_fills in zip(product_ids, fills):
+            inserted = store_fills(db_session, product_id, product_fills)
+            print("synced {} new fills for {}".format(inserted, product_id))
+    with METRICS.phase("sync_orders"):
+        statuses = update_order_statuses(
+            cbpro_client, db_session, coins, open_order_ids
+        )
+        print("order statuses={}".format(statuses))
+    # Fills, cursors and statuses all land together, so an interrupted sync
+    # just starts again from the previous cursors
+    db_session.commit()
+
+    summary = get_fill_summary(db_session)
+    print("fill summary:")
+    print(
+        "  {:<10} {:>7} {:>16} {:>14} {:>10} {:>14}".format(
+            "product", "fills", "size", "cost", "fees", "avg_price"
+        )
+    )
+    for product_id, s in sorted(summary.items()):
+        print(
+            "  {:<10} {:>7} {:>16.8f} {:>14.2f} {:>10.2f} {:>14.2f}".format(
+                product_id,
+                s["fills"],
+                s["size"],
+                s["cost"],
+                s["fees"],
+                s["average_price"] or 0,
+            )
+        )
+    return summary
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second, with bursts of up to
+    `burst` calls. A rate of None (or <= 0) disables limiting."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Hold back every caller for `seconds`, such as after a 429."""
+        if not self.rate or self.rate <= 0:
+            return
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        if not self.rate or self.rate <= 0:
+            return
+        # Waiters sleep while holding the lock, so they are served in turn
+        # rather than all waking at once and bursting past the limit.
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    time.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+def run_concurrently(fn, items, max_workers=1, rate_limiter=None):
+    """Call `fn` on each item using up to `max_workers` threads, and return
+    the results in the same order as `items`."""
+
+    def call(item):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        return fn(item)
+
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [call(i) for i in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
+
+
+def share_connection_pool(session, pool_size):
+    """Mount a keep-alive adapter on `session` large enough for `pool_size`
+    concurrent requests, so worker threads reuse connections rather than
+    opening (and discarding) their own."""
+    from requests.adapters import HTTPAdapter
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
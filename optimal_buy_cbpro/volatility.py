@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import datetime
+import time
+from .history import VolatilityStats, commit
+from .throttle import run_concurrently
+
+# The most candles the API returns for one request
+MAX_CANDLES = 300
+
+# However volatile a coin, its ladder goes no further than this far below
+# the price, so every rung keeps a positive price
+MAX_DISCOUNT = 0.5
+
+
+class AverageTrueRange:
+    """Wilder's average true range over `window` candles, updated one candle
+    at a time in constant time and space. Until `window` candles have been
+    seen, it's the plain mean of their true ranges."""
+
+    def __init__(self, window, atr=None, prev_close=None, last_time=None, count=0):
+        self.window = window
+        self.atr = atr
+        self.prev_close = prev_close
+        self.last_time = last_time
+        self.count = count
+
+    @property
+    def ready(self):
+        return self.count >= self.window
+
+    def update(self, candle_time, low, high, close):
+        if self.last_time is not None and candle_time <= self.last_time:
+            return
+        true_range = high - low
+        if self.prev_close is not None:
+            true_range = max(
+                true_range, abs(high - self.prev_close), abs(low - self.prev_close)
+            )
+        if self.count == 0:
+            self.atr = true_range
+        else:
+            n = min(self.count + 1, self.window)
+            self.atr = (self.atr * (n - 1) + true_range) / n
+        self.count += 1
+        self.prev_close = close
+        self.last_time = candle_time
+
+
+def fetch_candles(cbpro_client, product_id, granularity, since=None, now=None):
+    """Fetch the completed candles for `product_id` after the candle starting
+    at `since`, oldest first. Without `since`, or if it's further back than
+    one request covers, the latest candles are fetched instead."""
+    now = now if now is not None else time.time()
+    if since is not None and now - since <= (MAX_CANDLES - 1) * granularity:
+        candles = cbpro_client.get_product_historic_rates(
+            product_id,
+            start=datetime.datetime.fromtimestamp(
+                since + granularity, datetime.timezone.utc
+            ).isoformat(),
+            end=datetime.datetime.fromtimestamp(now, datetime.timezone.utc).isoformat(),
+            granularity=granularity,
+        )
+    else:
+        candles = cbpro_client.get_product_historic_rates(
+            product_id, granularity=granularity
+        )
+    if not isinstance(candles, list):
+        raise (
+            Exception("unable to fetch candles for {}: {}".format(product_id, candles))
+        )
+    # Skip the candle still in progress, which would otherwise be counted
+    # before it's complete and never revisited
+    return sorted(c for c in candles if c[0] + granularity <= now)
+
+
+def load_average_true_range(db_session, product_id, granularity, window):
+    stats = (
+        db_session.query(VolatilityStats).filter_by(product_id=product_id).one_or_none()
+    )
+    if stats is None:
+        stats = VolatilityStats(product_id=product_id)
+        db_session.add(stats)
+    if stats.granularity != granularity or stats.window != window:
+        # Settings changed, start over
+        return stats, AverageTrueRange(window)
+    return stats, AverageTrueRange(
+        window, stats.atr, stats.prev_close, stats.last_time, stats.count
+    )
+
+
+def get_max_discount_step(args):
+    """The widest step that keeps the ladder's last rung within
+    MAX_DISCOUNT of the price."""
+    return max(0.0, MAX_DISCOUNT - args.starting_discount) / max(
+        1, args.order_count - 1
+    )
+
+
+def get_discount_steps(
+    args, coins, prices, cbpro_client, db_session, rate_limiter=None, now=None
+):
+    """Work out a discount step for each coin's ladder from its recent
+    average true range, as a fraction of its price, scaled by
+    --volatility-multiplier. Coins without enough candles yet keep the fixed
+    --discount-step."""
+    now = now if now is not None else time.time()
+    product_ids = {c: "{}-{}".format(c, args.fiat_currency) for c in coins}
+    stats = {
+        c: load_average_true_range(
+            db_session,
+            product_ids[c],
+            args.volatility_granularity,
+            args.volatility_window,
+        )
+        for c in coins
+    }
+    # A gap longer than one request covers means the running average is
+    # too stale to carry on from, so start those over
+    for c, (row, atr) in stats.items():
+        if (
+            atr.last_time is not None
+            and now - atr.last_time > (MAX_CANDLES - 1) * args.volatility_granularity
+        ):
+            stats[c] = (row, AverageTrueRange(args.volatility_window))
+
+    coin_list = list(coins)
+    candles = run_concurrently(
+        lambda c: fetch_candles(
+            cbpro_client,
+            product_ids[c],
+            args.volatility_granularity,
+            stats[c][1].last_time,
+            now,
+        ),
+        coin_list,
+        args.api_concurrency,
+        rate_limiter,
+    )
+
+    discount_steps = {}
+    for c, product_candles in zip(coin_list, candles):
+        row, atr = stats[c]
+        for candle_time, low, high, _, close, _ in product_candles:
+            atr.update(candle_time, low, high, close)
+        row.granularity = args.volatility_granularity
+        row.window = args.volatility_window
+        row.atr = atr.atr
+        row.prev_close = atr.prev_close
+        row.last_time = atr.last_time
+        row.count = atr.count
+        if atr.ready and prices[c] > 0:
+            discount_steps[c] = min(
+                args.volatility_multiplier * atr.atr / prices[c],
+                get_max_discount_step(args),
+            )
+        else:
+            discount_steps[c] = args.discount_step
+    commit(db_session)
+    print("discount_steps={}".format(discount_steps))
+    return discount_steps
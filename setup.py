@@ -9,11 +9,14 @@ requires = [
     "python-dateutil>=2.7.5",
     "requests>=2.21.0",
 ]
-test_requires = ["pytest-cov", "pytest>=3.5.0"]
+backtest_requires = ["numpy>=1.16.0"]
+async_requires = ["aiohttp>=3.5.0"]
+test_requires = ["pytest-cov", "pytest>=3.5.0"] + backtest_requires
+bench_requires = test_requires + async_requires + ["pytest-benchmark>=3.2.0"]
 
 setup(
     name="optimal_buy_cbpro",
-    version="1.1.22",
+    version="1.2.0",
     description="Buy the coins, optimally!",
     long_description=readme,
     long_description_content_type="text/markdown",
@@ -34,5 +37,11 @@ setup(
     python_requires=">=3.5",
     install_requires=requires,
     tests_require=test_requires,
-    extras_require={"test": test_requires},
+    extras_require={
+        "test": test_requires,
+        "bench": bench_requires,
+        "backtest": backtest_requires,
+        "parquet": backtest_requires + ["pyarrow>=0.15.0"],
+        "async": async_requires,
+    },
 )
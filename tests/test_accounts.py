@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import json
+import threading
+import pytest
+
+from optimal_buy_cbpro import accounts, optimal_buy_cbpro
+
+
+class FakeExchangeClient:
+    prices = {"BTC": "5000", "ETH": "200"}
+
+    def __init__(self, fiat_balance):
+        self.fiat_balance = fiat_balance
+        self.ticker_calls = 0
+        self.orders = []
+
+    def get_products(self):
+        return [
+            {"base_currency": c, "quote_currency": "USD", "min_market_funds": "10"}
+            for c in self.prices
+        ]
+
+    def get_orders(self):
+        return []
+
+    def cancel_all(self, product_id):
+        return []
+
+    def get_accounts(self):
+        return [{"currency": "USD", "balance": str(self.fiat_balance)}] + [
+            {"currency": c, "balance": "0"} for c in self.prices
+        ]
+
+    def get_product_ticker(self, product_id):
+        self.ticker_calls += 1
+        return {"price": self.prices[product_id.split("-")[0]]}
+
+    def buy(self, price, size, order_type, product_id, post_only, client_oid=None):
+        self.orders.append((product_id, price, size))
+        return {
+            "id": "order{}".format(len(self.orders)),
+            "created_at": "2019-01-01T00:00:00.000000Z",
+        }
+
+
+@pytest.fixture
+def args():
+    return optimal_buy_cbpro.get_parser().parse_args(
+        [
+            "--mode",
+            "buy",
+            "--max-retries",
+            "1",
+            "--api-rate-limit",
+            "0",
+            "--cancel-confirm-attempts",
+            "1",
+            "--account-concurrency",
+            "2",
+        ]
+    )
+
+
+def test_load_accounts(tmp_path):
+    path = tmp_path / "accounts.json"
+    path.write_text(
+        json.dumps(
+            [
+                {"key": "k1", "b64secret": "s1", "passphrase": "p1"},
+                {"name": "bob", "key": "k2", "b64secret": "s2", "passphrase": "p2"},
+            ]
+        )
+    )
+    loaded = accounts.load_accounts(str(path))
+    assert [a["name"] for a in loaded] == ["account0", "bob"]
+
+    path.write_text(json.dumps([{"key": "k1"}]))
+    with pytest.raises(Exception):
+        accounts.load_accounts(str(path))
+
+
+def test_shared_market_data_fetches_once():
+    market_data = accounts.SharedMarketData()
+    calls = []
+
+    def fetch():
+        calls.append(threading.get_ident())
+        return {"data": []}
+
+    for _ in range(3):
+        assert market_data.get("coincap_assets", fetch) == {"data": []}
+    assert len(calls) == 1
+
+
+def test_run_accounts(args):
+    market_data = accounts.SharedMarketData()
+    market_data.values["coincap_assets"] = {
+        "data": [
+            {"symbol": "BTC", "marketCapUsd": "750"},
+            {"symbol": "ETH", "marketCapUsd": "250"},
+        ]
+    }
+    clients = {}
+
+    def create_client(account):
+        clients[account["name"]] = FakeExchangeClient(account["fiat_balance"])
+        return clients[account["name"]]
+
+    account_list = [
+        {
+            "name": name,
+            "key": "k",
+            "b64secret": "s",
+            "passphrase": "p",
+            "fiat_balance": balance,
+            "db_engine": "sqlite://",
+            "args": {"order-count": 2},
+        }
+        for name, balance in [("alice", 1000), ("bob", 2000), ("carol", 10)]
+    ]
+    coins = {"BTC": {"name": "Bitcoin"}, "ETH": {"name": "Ethereum"}}
+    results = accounts.run_accounts(
+        args, coins, account_list, create_client, market_data
+    )
+
+    assert [r["name"] for r in results] == ["alice", "bob", "carol"]
+    assert all(r["ok"] for r in results)
+    # The price snapshot is fetched once for all accounts
+    assert sum(c.ticker_calls for c in clients.values()) == 2
+    assert sorted(o[0] for o in clients["alice"].orders) == ["BTC-USD", "ETH-USD"]
+    assert sorted(o[0] for o in clients["bob"].orders) == ["BTC-USD", "ETH-USD"]
+    assert len(clients["carol"].orders) == 0
+    # Per account options don't leak into the shared args
+    assert args.order_count == 5
+    assert "minimum_order_size" not in coins["BTC"]
+
+
+def test_daemon_rejects_accounts_config(tmp_path, monkeypatch, capsys):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps([{"key": "k", "b64secret": "s", "passphrase": "p"}]))
+    monkeypatch.setattr(
+        "sys.argv",
+        ["optimal-buy-cbpro", "--mode", "daemon", "--accounts-config", str(path)],
+    )
+    with pytest.raises(SystemExit) as e:
+        optimal_buy_cbpro.main()
+    assert e.value.code == 2
+    assert "--mode daemon can't be used with" in capsys.readouterr().err
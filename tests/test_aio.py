@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+
+import cbpro
+import pytest
+import requests
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.aio import (
+    AsyncClient,
+    AsyncRateLimiter,
+    buy_async,
+    deposit_async,
+    get_request_headers,
+    withdraw_async,
+)
+from optimal_buy_cbpro.history import Deposit, Order, Withdrawal, get_session
+
+
+class FakeAsyncClient:
+    """Every call takes `latency` seconds, and the most calls in flight at
+    once is recorded."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self.open_orders = [{"id": "old", "product_id": "BTC-USD"}]
+        self.orders = []
+
+    async def call(self, result):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        return result
+
+    async def get_products(self):
+        return await self.call(
+            [
+                {"base_currency": c, "quote_currency": "USD", "min_market_funds": "10"}
+                for c in ["BTC", "ETH"]
+            ]
+        )
+
+    async def get_product_ticker(self, product_id):
+        price = {"BTC-USD": "5000.00", "ETH-USD": "200.00"}[product_id]
+        return await self.call({"price": price})
+
+    async def get_accounts(self):
+        return await self.call(
+            [
+                {"currency": "USD", "balance": "1000.0"},
+                {"currency": "BTC", "balance": "0.0"},
+                {"currency": "ETH", "balance": "0.0"},
+            ]
+        )
+
+    async def fetch_json(self, url):
+        return await self.call(
+            {
+                "data": [
+                    {"symbol": "BTC", "marketCapUsd": "750"},
+                    {"symbol": "ETH", "marketCapUsd": "250"},
+                ]
+            }
+        )
+
+    async def get_orders(self):
+        return await self.call(list(self.open_orders))
+
+    async def cancel_all(self, product_id):
+        self.open_orders = [
+            o for o in self.open_orders if o["product_id"] != product_id
+        ]
+        return await self.call([])
+
+    async def buy(self, product_id, order_type, **kwargs):
+        order = {
+            "id": "order-{}".format(len(self.orders)),
+            "created_at": "2019-01-01T00:00:00.000000Z",
+        }
+        self.orders.append((product_id, kwargs))
+        return await self.call(order)
+
+    async def deposit(self, amount, currency, payment_method_id):
+        return await self.call(
+            {"id": "deposit", "payout_at": "2019-01-01T00:00:00.000000Z"}
+        )
+
+
+def get_args(*extra):
+    return optimal_buy_cbpro.get_parser().parse_args(
+        ["--mode", "buy", "--client", "async"] + list(extra)
+    )
+
+
+def test_get_request_headers(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 1546300800.0)
+    auth = cbpro.cbpro_auth.CBProAuth("key", "c2VjcmV0", "passphrase")
+    request = requests.Request(
+        "POST",
+        "https://api.pro.coinbase.com/orders",
+        params={"product_id": "BTC-USD"},
+        data='{"size": "1"}',
+    ).prepare()
+    expected = auth(request).headers
+    headers = get_request_headers(
+        "key", "c2VjcmV0", "passphrase", "post", request.path_url, '{"size": "1"}'
+    )
+    for header in ["CB-ACCESS-SIGN", "CB-ACCESS-TIMESTAMP", "CB-ACCESS-KEY"]:
+        assert headers[header] == expected[header]
+
+
+def test_async_rate_limiter():
+    limiter = AsyncRateLimiter(20, burst=1)
+
+    async def acquire_all():
+        await asyncio.gather(*[limiter.acquire() for _ in range(5)])
+
+    start = time.monotonic()
+    asyncio.run(acquire_all())
+    # The first is free, the other 4 wait 1/20s each
+    assert time.monotonic() - start >= 0.19
+
+
+class FakeHTTPResponse:
+    def __init__(self, status, result):
+        self.status = status
+        self.result = result
+        self.headers = {"Retry-After": "0"}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    async def json(self, content_type=None):
+        return self.result
+
+
+class FakeHTTPSession:
+    """Answers each request with the next of `responses`, a list of
+    (status, result) pairs, and remembers the requests made."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.headers = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        self.headers.append(kwargs.get("headers"))
+        return FakeHTTPResponse(*self.responses.pop(0))
+
+    async def close(self):
+        pass
+
+
+def test_async_client_retries():
+    pytest.importorskip("aiohttp")
+
+    async def call(responses, fn):
+        session = FakeHTTPSession(responses)
+        client = AsyncClient(
+            "key", "c2VjcmV0", "passphrase", "http://api", rate=0, session=session
+        )
+        client.backoff = 0.001
+        return await fn(client), session.requests
+
+    result, requests_made = asyncio.run(
+        call([(429, {}), (503, {}), (200, [])], lambda c: c.get_accounts())
+    )
+    assert result == []
+    assert len(requests_made) == 3
+
+    # An order that failed with a 5xx is looked up by its client_oid
+    # before being placed again
+    result, requests_made = asyncio.run(
+        call(
+            [(502, {"message": "bad gateway"}), (200, {"id": "order1"})],
+            lambda c: c.buy("BTC-USD", "limit", price="1.00", size="1"),
+        )
+    )
+    assert result == {"id": "order1"}
+    assert requests_made[0] == ("POST", "http://api/orders")
+    assert requests_made[1][1].startswith("http://api/orders/client:")
+
+    # Deposits are never retried
+    result, requests_made = asyncio.run(
+        call(
+            [(503, {"message": "unavailable"})],
+            lambda c: c.deposit("10", "USD", "bank"),
+        )
+    )
+    assert result == {"message": "unavailable"}
+    assert len(requests_made) == 1
+
+
+def test_async_client_signs_after_rate_limit(monkeypatch):
+    pytest.importorskip("aiohttp")
+    now = [1546300800.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+
+    class SlowLimiter:
+        async def acquire(self):
+            # Queued behind the rest of a ladder for a minute
+            now[0] += 60
+
+    async def call():
+        session = FakeHTTPSession([(200, [])])
+        client = AsyncClient(
+            "key", "c2VjcmV0", "passphrase", "http://api", rate=0, session=session
+        )
+        client.private_limiter = SlowLimiter()
+        await client.get_accounts()
+        return session.headers
+
+    headers = asyncio.run(call())
+    assert headers[0]["CB-ACCESS-TIMESTAMP"] == str(1546300860.0)
+
+
+def test_buy_async():
+    args = get_args()
+    coins = {"BTC": {"name": "Bitcoin"}, "ETH": {"name": "Ethereum"}}
+    db_session = get_session("sqlite://")
+    client = FakeAsyncClient()
+
+    asyncio.run(buy_async(args, coins, client, db_session))
+
+    assert client.open_orders == []
+    # The calls overlap rather than being made one after another
+    assert client.max_in_flight >= 4
+    placed = {}
+    for product_id, kwargs in client.orders:
+        placed[product_id] = placed.get(product_id, 0) + float(kwargs["price"]) * float(
+            kwargs["size"]
+        )
+    assert sorted(placed) == ["BTC-USD", "ETH-USD"]
+    assert placed["BTC-USD"] > placed["ETH-USD"]
+    assert db_session.query(Order).count() == len(client.orders)
+
+
+def test_deposit_async():
+    args = get_args("--amount", "100", "--payment-method-id", "bank")
+    db_session = get_session("sqlite://")
+    asyncio.run(deposit_async(args, FakeAsyncClient(latency=0), db_session))
+    assert db_session.query(Deposit).one().cbpro_deposit_id == "deposit"
+
+
+class FakeWithdrawClient:
+    async def crypto_withdraw(self, amount, currency, crypto_address):
+        if currency == "ETH":
+            raise (Exception("connection reset"))
+        return {"id": "w-{}".format(currency)}
+
+
+def test_withdraw_async_records_successes():
+    coins = {
+        "BTC": {"withdrawal_address": "btc-address"},
+        "ETH": {"withdrawal_address": "eth-address"},
+    }
+    accounts = [
+        {"currency": "BTC", "balance": "0.5"},
+        {"currency": "ETH", "balance": "2.0"},
+    ]
+    db_session = get_session("sqlite://")
+    with pytest.raises(Exception, match="connection reset"):
+        asyncio.run(withdraw_async(coins, accounts, FakeWithdrawClient(), db_session))
+    db_session.rollback()
+    # The BTC withdrawal went through, so it's in the ledger
+    assert [w.currency for w in db_session.query(Withdrawal)] == ["BTC"]
+    assert optimal_buy_cbpro.get_withdrawn_balances(db_session) == {"BTC": 0.5}
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import random
+import pytest
+
+from optimal_buy_cbpro.allocation import allocate_loop, allocate_vectorized
+
+np = pytest.importorskip("numpy")
+
+
+def get_basket(count, seed):
+    rng = random.Random(seed)
+    coins = {"C{:04d}".format(i): {} for i in range(count)}
+    fiat_balances = {"USD": rng.uniform(100, 10000)}
+    market_caps = {}
+    for c in coins:
+        fiat_balances[c] = rng.choice([0, rng.uniform(0, 5000)])
+        market_caps[c] = rng.lognormvariate(20, 2)
+    total = sum(market_caps.values())
+    weights = {c: market_caps[c] / total for c in coins}
+    return coins, fiat_balances, weights, fiat_balances["USD"] * 0.9985
+
+
+@pytest.mark.parametrize("count", [1, 3, 10, 100, 1000])
+def test_allocate_vectorized_matches_loop(count):
+    for seed in range(20):
+        basket = get_basket(count, seed)
+        assert allocate_vectorized(*basket) == allocate_loop(*basket)
+
+
+def test_allocate_vectorized_rounding_ties():
+    # Differences that sit on (or within a hair of) half a cent
+    coins = {c: {} for c in ["A", "B", "C", "D", "E"]}
+    fiat_balances = {"USD": 0.0, "A": 0, "B": 0, "C": 0, "D": 0, "E": 0}
+    weights = {"A": 1.005, "B": 2.675, "C": 0.125, "D": 1.015, "E": 0.285}
+    fiat_balances["USD"] = 1.0
+    basket = (coins, fiat_balances, weights, 100.0)
+    assert allocate_vectorized(*basket) == allocate_loop(*basket)
+
+
+def test_allocate_nothing_to_buy():
+    coins = {"A": {}}
+    basket = (coins, {"USD": 0.0, "A": 0.0}, {"A": 1.0}, 100.0)
+    with pytest.raises(ZeroDivisionError):
+        allocate_loop(*basket)
+    with pytest.raises(ZeroDivisionError):
+        allocate_vectorized(*basket)
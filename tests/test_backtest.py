@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import math
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from optimal_buy_cbpro import backtest, optimal_buy_cbpro  # noqa: E402
+
+
+@pytest.fixture
+def args():
+    class Args:
+        order_count = 5
+        starting_discount = 0.005
+        discount_step = 0.001
+
+    return Args()
+
+
+def test_generate_ladders_matches_generate_buy_orders(args):
+    coins = {"BTC": {}}
+    prices = [5000, 4155.42, 3394.99, 3630.51, 3577.97, 2]
+    order_prices, order_sizes = backtest.generate_ladders(
+        prices, 500.0, args.starting_discount, args.discount_step, args.order_count
+    )
+    for i, price in enumerate(prices):
+        orders = optimal_buy_cbpro.generate_buy_orders(coins, "BTC", args, 500.0, price)
+        assert list(order_prices[i][: len(orders)]) == [o["price"] for o in orders]
+        for size, o in zip(order_sizes[i], orders):
+            assert math.isclose(size, o["size"], rel_tol=1e-7)
+        assert np.count_nonzero(order_sizes[i]) == len(orders)
+
+
+def test_get_cycles():
+    candles = {
+        "low": np.array([10.0, 9.0, 8.0, 7.0, 11.0, 6.0, 12.0]),
+        "close": np.array([10.0, 9.5, 8.5, 7.5, 11.5, 6.5, 12.5]),
+    }
+    cycle_prices, window_lows = backtest.get_cycles(candles, 3)
+    assert list(cycle_prices) == [10.0, 7.5]
+    assert list(window_lows) == [7.0, 6.0]
+
+
+def test_simulate():
+    cycle_prices = np.array([100.0, 100.0])
+    # First cycle dips through the first two rungs, second never dips
+    window_lows = np.array([98.4, 100.0])
+    r = backtest.simulate(cycle_prices, window_lows, 100.0, 0.005, 0.01, 5)
+    assert r["cycles"] == 2
+    assert r["budget"] == 200.0
+    assert math.isclose(r["spent"], 40.0)
+    assert math.isclose(r["coins"], 20 / 99.5 + 20 / 98.5)
+    assert math.isclose(r["fill_rate"], 0.2)
+    assert r["market_cost"] == 100.0
+    assert r["discount_captured"] > 0.005
+
+
+def write_candles(path, count):
+    rows = ["time,low,high,open,close"]
+    for t in range(count):
+        price = 100 + 10 * math.sin(t / 5)
+        rows.append("{},{},{},{},{}".format(t, price - 1, price + 1, price, price))
+    path.write_text("\n".join(rows))
+
+
+def test_run_backtest(tmp_path, args):
+    path = tmp_path / "btc.csv"
+    write_candles(path, 100)
+    args.backtest_data = ["BTC={}".format(path)]
+    args.backtest_interval = 10
+    args.backtest_amount = 100.0
+    results = backtest.run_backtest(args, {"BTC": {}})
+    assert results["BTC"]["cycles"] == 10
+    assert 0 < results["BTC"]["fill_rate"] <= 1
+
+
+def test_sweep(tmp_path):
+    path = tmp_path / "btc.csv"
+    write_candles(path, 500)
+    results = backtest.sweep(
+        {"BTC": str(path)},
+        [10, 20],
+        [0.0, 0.005, 0.01],
+        [0.001, 0.01],
+        [1, 5],
+        100.0,
+        workers=2,
+    )
+    assert len(results) == 24
+    savings = [r["savings"] for r in results if not math.isnan(r["savings"])]
+    assert savings == sorted(savings, reverse=True)
+
+    candles = backtest.load_candles(str(path))
+    best = results[0]
+    expected = backtest.simulate(
+        *backtest.get_cycles(candles, best["interval"]),
+        100.0,
+        best["starting_discount"],
+        best["discount_step"],
+        best["order_count"],
+    )
+    assert math.isclose(best["spent"], expected["spent"])
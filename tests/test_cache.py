@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import pytest
+from sqlalchemy import event
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.cache import ReferenceCache
+from optimal_buy_cbpro.history import CacheEntry, batch_commits, get_session
+
+
+@pytest.fixture
+def db_session():
+    return get_session("sqlite://")
+
+
+def test_cache_hit(db_session):
+    cache = ReferenceCache(db_session, ttl=60)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {"value": len(calls)}
+
+    assert cache.get("key", fetch) == {"value": 1}
+    assert cache.get("key", fetch) == {"value": 1}
+    assert len(calls) == 1
+
+
+def test_cache_expired(db_session):
+    cache = ReferenceCache(db_session, ttl=0)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {"value": len(calls)}
+
+    assert cache.get("key", fetch) == {"value": 1}
+    assert cache.get("key", fetch) == {"value": 2}
+    assert db_session.query(CacheEntry).count() == 1
+
+
+def test_cache_stale_fallback(db_session):
+    cache = ReferenceCache(db_session, ttl=0)
+    cache.get("key", lambda: [1, 2, 3])
+
+    def fail():
+        raise Exception("upstream unavailable")
+
+    assert cache.get("key", fail) == [1, 2, 3]
+    with pytest.raises(Exception):
+        cache.get("other", fail)
+
+
+def test_cache_eviction(db_session):
+    cache = ReferenceCache(db_session, ttl=60, max_entries=2)
+    for key in ["a", "b", "c"]:
+        cache.get(key, lambda: key)
+    keys = sorted(e.key for e in db_session.query(CacheEntry).all())
+    assert keys == ["b", "c"]
+
+
+def test_cache_batch_commits(db_session):
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+    cache = ReferenceCache(db_session, ttl=0)
+    with batch_commits(db_session):
+        for _ in range(3):
+            cache.get("key", lambda: [1, 2, 3])
+    assert len(commits) == 1
+
+
+def test_get_products_cached(db_session):
+    class FakeProductsClient:
+        calls = 0
+
+        def get_products(self):
+            self.calls += 1
+            return [
+                {
+                    "base_currency": "BTC",
+                    "quote_currency": "USD",
+                    "min_market_funds": "10",
+                }
+            ]
+
+    cbpro_client = FakeProductsClient()
+    cache = ReferenceCache(db_session, ttl=60)
+    coins = {"BTC": {}}
+    optimal_buy_cbpro.get_products(cbpro_client, coins, "USD", cache)
+    optimal_buy_cbpro.get_products(cbpro_client, coins, "USD", cache)
+    assert cbpro_client.calls == 1
+    assert coins["BTC"]["minimum_order_size"] == 10.0
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import copy
+import json
+
+import pytest
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.accounts import load_accounts
+from optimal_buy_cbpro.coins import (
+    COINS_ENV,
+    CoinConfig,
+    copy_coin_configs,
+    dump_coin_configs,
+    get_coin_config,
+    load_coin_configs,
+)
+
+
+def test_load_coin_configs(tmp_path):
+    coins = load_coin_configs(optimal_buy_cbpro.DEFAULT_COINS)
+    assert list(coins) == ["BTC", "ETH", "LTC"]
+    assert coins["BTC"].name == "Bitcoin"
+    assert coins["BTC"].withdrawal_address is None
+    assert coins["BTC"].external_balance == 0.0
+    assert coins["BTC"].minimum_order_size == 0.01
+
+    path = tmp_path / "coins.json"
+    path.write_text(json.dumps({"ETH": {"external_balance": "1.5"}}))
+    coins = load_coin_configs("@" + str(path))
+    assert list(coins) == ["ETH"]
+    assert coins["ETH"].external_balance == 1.5
+    assert json.loads(dump_coin_configs(coins)) == {
+        "ETH": {"name": None, "withdrawal_address": None, "external_balance": 1.5}
+    }
+
+
+def test_coins_from_env(monkeypatch):
+    monkeypatch.setenv(COINS_ENV, '{"XLM":{}}')
+    args = optimal_buy_cbpro.get_parser().parse_args(["--mode", "buy"])
+    assert list(load_coin_configs(args.coins)) == ["XLM"]
+
+
+@pytest.mark.parametrize(
+    "coins,error",
+    [
+        ("{", "isn't valid JSON"),
+        ("[]", "must be an object"),
+        ('{"BTC": []}', "settings for BTC must be an object"),
+        ('{"BTC": {"withdrawl_address": "x"}}', "unknown settings for BTC"),
+        ('{"BTC": {"name": 1}}', "name for BTC must be a string"),
+        ('{"BTC": {"external_balance": "lots"}}', "must be a number"),
+        ('{"BTC": {"external_balance": true}}', "must be a number"),
+        ('{"BTC": {"external_balance": -1}}', "must be at least 0"),
+        ('{"BTC": {}, "BTC": {}}', "BTC is given more than once"),
+    ],
+)
+def test_load_coin_configs_invalid(coins, error):
+    with pytest.raises(Exception, match=error):
+        load_coin_configs(coins)
+
+
+def test_update_product():
+    coin = CoinConfig("BTC")
+    product = {
+        "base_currency": "BTC",
+        "min_market_funds": "10",
+        "quote_increment": "0.01",
+        "base_increment": "0.00000001",
+    }
+    assert coin.update_product(product)
+    assert coin.minimum_order_size == 10.0
+    assert coin.quote_increment == 0.01
+    assert coin.base_increment == 1e-8
+    assert not coin.update_product(product)
+    assert coin.update_product(dict(product, min_market_funds="5"))
+    assert coin.minimum_order_size == 5.0
+
+
+def test_set_minimum_order_sizes(capsys):
+    coins = load_coin_configs('{"BTC": {}, "ETH": {}}')
+    products = [
+        {"base_currency": "BTC", "quote_currency": "USD", "min_market_funds": "10"},
+        {"base_currency": "BTC", "quote_currency": "EUR", "min_market_funds": "5"},
+    ]
+    assert optimal_buy_cbpro.set_minimum_order_sizes(coins, products, "USD") == ["BTC"]
+    assert "BTC product minimum_order_size=10.0" in capsys.readouterr().out
+    # Only changes are reported
+    assert optimal_buy_cbpro.set_minimum_order_sizes(coins, products, "USD") == []
+    assert capsys.readouterr().out == ""
+
+
+def test_dict_access():
+    coin = CoinConfig("BTC", name="Bitcoin")
+    assert coin["name"] == "Bitcoin"
+    assert coin.get("withdrawal_address") is None
+    assert coin.get("quote_increment", 0.01) == 0.01
+    assert "name" in coin
+    assert "withdrawal_address" not in coin
+    with pytest.raises(KeyError):
+        coin["nope"]
+
+
+def test_get_coin_config():
+    coins = {"BTC": {"external_balance": 2}}
+    config = get_coin_config(coins, "BTC")
+    assert config.external_balance == 2.0
+    # Converted in place, so product metadata set on it is kept
+    assert coins["BTC"] is config
+    assert optimal_buy_cbpro.get_external_balance(coins, "BTC") == 2.0
+
+
+def test_copy_coin_configs():
+    coins = load_coin_configs('{"BTC": {"name": "Bitcoin"}}')
+    copied = copy_coin_configs(coins)
+    assert copied == coins
+    copied["BTC"].update_product({"min_market_funds": "10"})
+    assert coins["BTC"].minimum_order_size == 0.01
+    assert copy.copy(coins["BTC"]) == coins["BTC"]
+
+
+def test_load_accounts_validates_coins(tmp_path):
+    path = tmp_path / "accounts.json"
+    account = {"name": "alice", "key": "k", "b64secret": "s", "passphrase": "p"}
+    path.write_text(json.dumps([dict(account, coins={"BTC": {"name": "Bitcoin"}})]))
+    accounts = load_accounts(str(path))
+    assert accounts[0]["coins"]["BTC"].name == "Bitcoin"
+
+    path.write_text(json.dumps([dict(account, coins={"BTC": {"adress": "x"}})]))
+    with pytest.raises(Exception, match="account alice: unknown settings for BTC"):
+        load_accounts(str(path))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import datetime
+import pytest
+
+from optimal_buy_cbpro import daemon
+
+
+def test_parse_cron_field():
+    assert daemon.parse_cron_field("*", 0, 5) == {0, 1, 2, 3, 4, 5}
+    assert daemon.parse_cron_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert daemon.parse_cron_field("1-3,7", 0, 23) == {1, 2, 3, 7}
+    assert daemon.parse_cron_field("10/20", 0, 59) == {10, 30, 50}
+    with pytest.raises(Exception):
+        daemon.parse_cron_field("61", 0, 59)
+
+
+def test_next_run():
+    t = datetime.datetime(2019, 1, 1, 0, 28, 0)
+    daily = daemon.CronSchedule("28 0 * * *")
+    assert daily.next_run(t - datetime.timedelta(seconds=1)) == t
+    assert daily.next_run(t) == datetime.datetime(2019, 1, 2, 0, 28)
+
+    # 2019-01-01 was a Tuesday
+    mondays = daemon.CronSchedule("0 0 * * 1")
+    assert mondays.next_run(t) == datetime.datetime(2019, 1, 7, 0, 0)
+    sundays = daemon.CronSchedule("30 12 * * 7")
+    assert sundays.next_run(t) == datetime.datetime(2019, 1, 6, 12, 30)
+
+    # Day of month or day of week, when both are given
+    either = daemon.CronSchedule("0 0 15 * 1")
+    assert either.next_run(datetime.datetime(2019, 1, 8)) == datetime.datetime(
+        2019, 1, 14
+    )
+
+    leap = daemon.CronSchedule("0 0 29 2 *")
+    assert leap.next_run(t) == datetime.datetime(2020, 2, 29)
+
+    with pytest.raises(Exception):
+        daemon.CronSchedule("* * *")
+
+
+class FakeClock:
+    def __init__(self, t):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+class FakeEvent:
+    def __init__(self, clock, stop_at):
+        self.clock = clock
+        self.stop_at = stop_at
+        self.stopped = False
+
+    def is_set(self):
+        return self.stopped
+
+    def set(self):
+        self.stopped = True
+
+    def wait(self, timeout):
+        if self.clock.t + datetime.timedelta(seconds=timeout) >= self.stop_at:
+            self.stopped = True
+            return True
+        self.clock.t += datetime.timedelta(seconds=timeout)
+        return False
+
+
+def test_scheduler():
+    clock = FakeClock(datetime.datetime(2019, 1, 1, 0, 0, 30))
+    runs = []
+    jobs = [
+        ("buy", daemon.CronSchedule("*/10 * * * *"), lambda: runs.append(clock.t)),
+        ("deposit", daemon.CronSchedule("0 * * * *"), lambda: runs.append("deposit")),
+    ]
+    scheduler = daemon.Scheduler(jobs, jitter=5, now=clock)
+    scheduler.stopping = FakeEvent(clock, datetime.datetime(2019, 1, 1, 1, 5))
+    assert scheduler.run() == 7
+
+    buys = [r for r in runs if r != "deposit"]
+    assert len(buys) == 6
+    assert runs.count("deposit") == 1
+    for i, t in enumerate(buys):
+        scheduled = datetime.datetime(2019, 1, 1, 0, 10) + datetime.timedelta(
+            minutes=10 * i
+        )
+        assert scheduled <= t <= scheduled + datetime.timedelta(seconds=5)
+
+
+def test_scheduler_stop():
+    clock = FakeClock(datetime.datetime(2019, 1, 1))
+    jobs = [("buy", daemon.CronSchedule("* * * * *"), lambda: None)]
+    scheduler = daemon.Scheduler(jobs, now=clock)
+    scheduler.stop()
+    assert scheduler.run() == 0
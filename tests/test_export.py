@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import datetime
+import os
+import pytest
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.export import (
+    NULL_PARTITION,
+    export_history,
+    iter_partitions,
+    run_export,
+)
+from optimal_buy_cbpro.history import Deposit, Order, Withdrawal, get_session
+
+
+@pytest.fixture
+def db_session():
+    db_session = get_session("sqlite://")
+    for i in range(5):
+        db_session.add(
+            Order(
+                currency="BTC",
+                price=100.0 + i,
+                size=1.0,
+                cbpro_order_id="btc{}".format(i),
+                created_at=datetime.datetime(2019, 1 + i // 3, 1 + i),
+            )
+        )
+    db_session.add(
+        Order(
+            currency="ETH",
+            price=10.0,
+            size=2.0,
+            cbpro_order_id="eth",
+            created_at=datetime.datetime(2019, 2, 1),
+            status="filled",
+            filled_size=2.0,
+        )
+    )
+    db_session.add(
+        Deposit(
+            currency="USD",
+            amount=100.0,
+            payment_method_id="bank",
+            payout_at=None,
+            cbpro_deposit_id="d1",
+        )
+    )
+    db_session.add(
+        Withdrawal(
+            currency="BTC",
+            amount=1.0,
+            crypto_address="addr",
+            cbpro_withdrawal_id="w1",
+        )
+    )
+    db_session.commit()
+    return db_session
+
+
+def test_iter_partitions(db_session):
+    chunks = list(iter_partitions(db_session, Order, "created_at", 2))
+    assert [(c, m, len(rows)) for c, m, rows in chunks] == [
+        ("BTC", "2019-01", 2),
+        ("BTC", "2019-01", 1),
+        ("BTC", "2019-02", 2),
+        ("ETH", "2019-02", 1),
+    ]
+    # The currency isn't repeated in every row
+    columns = [c.name for c in Order.__table__.columns if c.name != "currency"]
+    eth = dict(zip(columns, chunks[-1][2][0]))
+    assert eth["cbpro_order_id"] == "eth"
+    assert eth["status"] == "filled"
+
+    chunks = list(iter_partitions(db_session, Withdrawal, None, 100))
+    assert [(c, m, len(rows)) for c, m, rows in chunks] == [("BTC", None, 1)]
+
+
+@pytest.mark.parametrize("export_format", ["parquet", "arrow"])
+def test_export_history(db_session, tmp_path, export_format):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.dataset as ds
+
+    out_dir = str(tmp_path)
+    summary = export_history(db_session, out_dir, export_format, 2)
+    assert summary == {
+        "orders": {"rows": 6, "files": 3},
+        "deposits": {"rows": 1, "files": 1},
+        "withdrawals": {"rows": 1, "files": 1},
+    }
+    path = os.path.join(
+        out_dir, "orders", "currency=BTC", "month=2019-01", "part-0." + export_format
+    )
+    assert os.path.exists(path)
+    assert os.path.exists(
+        os.path.join(
+            out_dir,
+            "deposits",
+            "currency=USD",
+            "month=" + NULL_PARTITION,
+            "part-0." + export_format,
+        )
+    )
+
+    orders = ds.dataset(
+        os.path.join(out_dir, "orders"),
+        format="ipc" if export_format == "arrow" else "parquet",
+        partitioning="hive",
+    ).to_table()
+    assert orders.num_rows == 6
+    assert orders.schema.field("price").type == pa.float64()
+    assert orders.schema.field("created_at").type == pa.timestamp("us")
+    rows = sorted(orders.to_pylist(), key=lambda r: r["id"])
+    assert [r["currency"] for r in rows] == ["BTC"] * 5 + ["ETH"]
+    assert rows[0]["created_at"] == datetime.datetime(2019, 1, 1)
+    assert rows[-1]["filled_size"] == 2.0
+
+
+def test_run_export_accounts(tmp_path):
+    pytest.importorskip("pyarrow")
+    out_dir = str(tmp_path / "export")
+    args = optimal_buy_cbpro.get_parser().parse_args(
+        ["--mode", "export", "--export-dir", out_dir]
+    )
+    accounts = []
+    for name in ["alice", "bob"]:
+        db_engine = "sqlite:///{}".format(tmp_path / "{}.db".format(name))
+        db_session = get_session(db_engine)
+        db_session.add(
+            Order(
+                currency="BTC",
+                price=100.0,
+                size=1.0,
+                cbpro_order_id=name,
+                created_at=datetime.datetime(2019, 1, 1),
+            )
+        )
+        db_session.commit()
+        db_session.close()
+        accounts.append({"name": name, "db_engine": db_engine})
+
+    summaries = run_export(args, accounts)
+    assert summaries["alice"]["orders"] == {"rows": 1, "files": 1}
+    for name in ["alice", "bob"]:
+        assert os.path.exists(
+            os.path.join(
+                out_dir,
+                "orders",
+                "account=" + name,
+                "currency=BTC",
+                "month=2019-01",
+                "part-0.parquet",
+            )
+        )
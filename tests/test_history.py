@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import sqlite3
+
+import pytest
+from sqlalchemy import event, inspect, text
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.history import (
+    Order,
+    Withdrawal,
+    WithdrawnBalance,
+    add_withdrawal,
+    batch_commits,
+    get_session,
+    parse_time,
+)
+
+
+class FakeWithdrawClient:
+    def crypto_withdraw(self, amount, currency, crypto_address):
+        return {"id": "w-{}".format(amount)}
+
+
+def test_withdrawn_balances_ledger():
+    db_session = get_session("sqlite://")
+    cbpro_client = FakeWithdrawClient()
+    optimal_buy_cbpro.execute_withdrawal(
+        cbpro_client, "0.5", "BTC", "address", db_session
+    )
+    optimal_buy_cbpro.execute_withdrawal(
+        cbpro_client, "0.25", "BTC", "address", db_session
+    )
+    optimal_buy_cbpro.execute_withdrawal(
+        cbpro_client, "2", "ETH", "address", db_session
+    )
+    assert db_session.query(Withdrawal).count() == 3
+    assert optimal_buy_cbpro.get_withdrawn_balances(db_session) == {
+        "BTC": 0.75,
+        "ETH": 2.0,
+    }
+
+
+def test_withdrawn_balances_rollback():
+    db_session = get_session("sqlite://")
+    add_withdrawal(db_session, Withdrawal(currency="BTC", amount=1.0))
+    db_session.commit()
+    add_withdrawal(db_session, Withdrawal(currency="BTC", amount=1.0))
+    db_session.rollback()
+    assert db_session.query(Withdrawal).count() == 1
+    assert db_session.query(WithdrawnBalance).one().amount == 1.0
+
+
+def test_migrate_existing_db(tmp_path):
+    # A history DB as created by earlier versions: no indexes, no ledger
+    path = str(tmp_path / "history.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, currency VARCHAR,
+            price FLOAT, size FLOAT, cbpro_order_id VARCHAR,
+            created_at DATETIME);
+        CREATE TABLE withdrawals (id INTEGER PRIMARY KEY, currency VARCHAR,
+            amount FLOAT, crypto_address VARCHAR,
+            cbpro_withdrawal_id VARCHAR);
+        CREATE TABLE deposits (id INTEGER PRIMARY KEY, currency VARCHAR,
+            amount FLOAT, payment_method_id VARCHAR, payout_at DATETIME,
+            cbpro_deposit_id VARCHAR);
+        INSERT INTO withdrawals (currency, amount) VALUES
+            ('BTC', 0.5), ('BTC', 0.25), ('ETH', 2);
+        """)
+    conn.close()
+
+    db_session = get_session("sqlite:///" + path)
+    inspector = inspect(db_session.get_bind())
+    assert {"status", "filled_size"} <= {
+        c["name"] for c in inspector.get_columns("orders")
+    }
+    assert {"currency", "cbpro_order_id", "created_at", "status"} <= {
+        i["column_names"][0] for i in inspector.get_indexes("orders")
+    }
+    assert optimal_buy_cbpro.get_withdrawn_balances(db_session) == {
+        "BTC": 0.75,
+        "ETH": 2.0,
+    }
+
+    # Opening it again leaves the ledger alone
+    db_session.close()
+    db_session = get_session("sqlite:///" + path)
+    assert db_session.query(WithdrawnBalance).count() == 2
+
+
+def test_sqlite_pragmas(tmp_path):
+    db_session = get_session("sqlite:///" + str(tmp_path / "history.db"))
+    assert db_session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+    # 1 is NORMAL
+    assert db_session.execute(text("PRAGMA synchronous")).scalar() == 1
+
+    db_session = get_session("sqlite:///" + str(tmp_path / "default.db"), None, None)
+    assert db_session.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+    assert db_session.execute(text("PRAGMA synchronous")).scalar() == 2
+
+    with pytest.raises(Exception):
+        get_session("sqlite://", synchronous="SOMETIMES")
+
+
+def test_batch_commits():
+    db_session = get_session("sqlite://")
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+    cbpro_client = FakeWithdrawClient()
+    with pytest.raises(ZeroDivisionError):
+        with batch_commits(db_session):
+            for amount in ["0.5", "0.25"]:
+                optimal_buy_cbpro.execute_withdrawal(
+                    cbpro_client, amount, "BTC", "address", db_session
+                )
+            1 / 0
+    # Both withdrawals were made, so both are recorded, in one commit
+    assert len(commits) == 1
+    db_session.rollback()
+    assert db_session.query(Withdrawal).count() == 2
+    assert optimal_buy_cbpro.get_withdrawn_balances(db_session) == {"BTC": 0.75}
+
+
+def test_batch_commits_order_rows():
+    db_session = get_session("sqlite://")
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+    report = [
+        {
+            "coin": c,
+            "price": 100.0,
+            "size": 1.0,
+            "order": {"id": c, "created_at": "2019-01-01T00:00:00Z"},
+            "outcome": "placed",
+            "latency": 0.0,
+        }
+        for c in ["BTC", "ETH"]
+    ]
+    with batch_commits(db_session):
+        for r in report:
+            optimal_buy_cbpro.finish_buy_orders([r], db_session)
+        assert commits == []
+    assert len(commits) == 1
+    assert db_session.query(Order).count() == 2
+
+
+@pytest.mark.parametrize(
+    "timestamp",
+    ["2019-01-01T00:00:00.123Z", "2019-01-01T00:00:00.123456+00:00", "2019-01-01"],
+)
+def test_parse_time(timestamp):
+    import dateutil.parser
+
+    assert parse_time(timestamp) == dateutil.parser.parse(timestamp)
+
+
+def test_withdrawn_balances_without_flush():
+    db_session = get_session("sqlite://")
+    cbpro_client = FakeWithdrawClient()
+    flushes = []
+    event.listen(db_session, "after_flush", lambda s, c: flushes.append(s))
+    with batch_commits(db_session):
+        for amount in ["0.5", "0.25"]:
+            optimal_buy_cbpro.execute_withdrawal(
+                cbpro_client, amount, "BTC", "address", db_session
+            )
+            db_session.add(Order(currency="BTC", cbpro_order_id=amount))
+            flushed = len(flushes)
+            balances = optimal_buy_cbpro.get_withdrawn_balances(db_session)
+            # The pending order rows weren't flushed just to read the balances
+            assert len(flushes) == flushed
+        assert balances == {"BTC": 0.75}
+    assert db_session.query(Order).count() == 2
+
+
+def test_withdraw_commits_each_withdrawal():
+    db_session = get_session("sqlite://")
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+    committed_before = []
+
+    class FailingWithdrawClient(FakeWithdrawClient):
+        def crypto_withdraw(self, amount, currency, crypto_address):
+            if currency == "ETH":
+                committed_before.append(len(commits))
+                raise (Exception("connection reset"))
+            return super().crypto_withdraw(amount, currency, crypto_address)
+
+    coins = {
+        "BTC": {"withdrawal_address": "btc-address"},
+        "ETH": {"withdrawal_address": "eth-address"},
+    }
+    accounts = [
+        {"currency": "BTC", "balance": "0.5"},
+        {"currency": "ETH", "balance": "2.0"},
+    ]
+    with pytest.raises(Exception, match="connection reset"):
+        optimal_buy_cbpro.withdraw(coins, accounts, FailingWithdrawClient(), db_session)
+    # The BTC withdrawal was committed before the ETH one was attempted
+    assert committed_before == [1]
+    assert optimal_buy_cbpro.get_withdrawn_balances(db_session) == {"BTC": 0.5}
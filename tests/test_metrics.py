@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import datetime
+import json
+
+from optimal_buy_cbpro.history import Order, get_session
+from optimal_buy_cbpro.metrics import Metrics, endpoint_name
+
+
+class FakeRequest:
+    def __init__(self, method, path_url):
+        self.method = method
+        self.path_url = path_url
+
+
+class FakeResponse:
+    def __init__(self, method, path_url, status_code, seconds):
+        self.request = FakeRequest(method, path_url)
+        self.status_code = status_code
+        self.elapsed = datetime.timedelta(seconds=seconds)
+
+
+def test_endpoint_name():
+    assert endpoint_name("get", "/products/BTC-USD/ticker") == (
+        "GET /products/{id}/ticker"
+    )
+    assert endpoint_name("DELETE", "/orders?product_id=BTC-USD") == "DELETE /orders"
+    assert endpoint_name("POST", "/withdrawals/crypto") == "POST /withdrawals/crypto"
+
+
+def test_api_calls_and_phases():
+    metrics = Metrics()
+    hook = metrics.response_hook("cbpro")
+    with metrics.phase("get_prices"):
+        hook(FakeResponse("GET", "/products/BTC-USD/ticker", 200, 0.02))
+        hook(FakeResponse("GET", "/products/ETH-USD/ticker", 200, 0.2))
+        hook(FakeResponse("GET", "/products/LTC-USD/ticker", 429, 0.001))
+    with metrics.phase("get_prices"):
+        pass
+
+    summary = metrics.summary()
+    assert summary["phases"]["get_prices"]["count"] == 2
+    assert summary["api_calls"] == [
+        {
+            "api": "cbpro",
+            "endpoint": "GET /products/{id}/ticker",
+            "status": "200",
+            "count": 2,
+        },
+        {
+            "api": "cbpro",
+            "endpoint": "GET /products/{id}/ticker",
+            "status": "429",
+            "count": 1,
+        },
+    ]
+    latency = summary["api_latency"][0]
+    assert latency["count"] == 3
+    assert latency["buckets"]["0.025"] == 2
+    assert latency["buckets"]["0.25"] == 3
+
+
+def test_db_commits():
+    metrics = Metrics()
+    db_session = metrics.instrument_db(get_session("sqlite://"))
+    for i in range(3):
+        db_session.add(Order(currency="BTC", price=1, size=i))
+        db_session.commit()
+    assert metrics.summary()["db_commits"]["count"] == 3
+
+
+def test_export(tmp_path):
+    metrics = Metrics()
+    metrics.response_hook("coincap")(FakeResponse("GET", "/v2/assets", 200, 0.3))
+    with metrics.phase("get_weights"):
+        pass
+    metrics.record_run("buy", True, 1.5)
+
+    json_path = tmp_path / "metrics.json"
+    prom_path = tmp_path / "metrics.prom"
+    metrics.export(str(json_path), str(prom_path))
+
+    summary = json.loads(json_path.read_text())
+    assert summary["runs"][0]["mode"] == "buy"
+    prom = prom_path.read_text()
+    assert 'optimal_buy_cbpro_last_run_success{mode="buy"} 1' in prom
+    assert 'optimal_buy_cbpro_phase_seconds_count{phase="get_weights"} 1' in prom
+    assert (
+        'optimal_buy_cbpro_api_requests_total{api="coincap",'
+        'endpoint="GET /v2/assets",status="200"} 1'
+    ) in prom
+    assert (
+        'optimal_buy_cbpro_api_request_seconds_bucket{api="coincap",'
+        'endpoint="GET /v2/assets",le="0.25"} 0'
+    ) in prom
+    assert "optimal_buy_cbpro_db_commit_seconds_count 0" in prom
+    assert {p.name for p in tmp_path.iterdir()} == {"metrics.json", "metrics.prom"}
+
+
+def test_last_runs():
+    metrics = Metrics()
+    metrics.record_run("buy", True, 1.5)
+    metrics.record_run("deposit", False, 0.5)
+    metrics.record_run("buy", True, 1.5, account="alice")
+    for _ in range(100):
+        metrics.record_run("buy", False, 2.0)
+
+    # Only the latest run of each mode and account is kept
+    runs = metrics.summary()["runs"]
+    assert [(r["mode"], r.get("account"), r["ok"]) for r in runs] == [
+        ("deposit", None, False),
+        ("buy", "alice", True),
+        ("buy", None, False),
+    ]
+    prom = metrics.prometheus()
+    assert 'optimal_buy_cbpro_last_run_success{mode="buy"} 0' in prom
+    assert 'optimal_buy_cbpro_last_run_success{mode="deposit"} 0' in prom
+    assert 'optimal_buy_cbpro_last_run_success{mode="buy",account="alice"} 1' in prom
+    assert prom.count("optimal_buy_cbpro_last_run_timestamp_seconds{") == 3
@@ -3,6 +3,8 @@ import pytest
 import math
 import json
 import cbpro
+import threading
+import time
 
 from optimal_buy_cbpro import optimal_buy_cbpro
 
@@ -170,3 +172,269 @@ def test_generate_orders_rounding4(coins, args):
 
     for o in orders:
         assert o["size"] * o["price"] <= 100
+
+
+class FakeTickerClient:
+    """Each ticker call waits until `concurrency` calls are in flight at
+    once, so the calls fail unless they're made concurrently."""
+
+    def __init__(self, prices, concurrency):
+        self.prices = prices
+        self.barrier = threading.Barrier(concurrency, timeout=5)
+
+    def get_product_ticker(self, product_id):
+        self.barrier.wait()
+        return {"price": str(self.prices[product_id.split("-")[0]])}
+
+
+def test_get_prices_concurrent():
+    coins = {"BTC": {}, "ETH": {}, "LTC": {}, "XLM": {}}
+    cbpro_client = FakeTickerClient(
+        {"BTC": 5000, "ETH": 200, "LTC": 50, "XLM": 0.1}, len(coins)
+    )
+    fetch_times = {}
+    prices = optimal_buy_cbpro.get_prices(
+        cbpro_client, coins, "USD", max_workers=4, fetch_times=fetch_times
+    )
+    assert prices == {"BTC": 5000.0, "ETH": 200.0, "LTC": 50.0, "XLM": 0.1}
+    assert list(prices) == list(coins)
+    assert set(fetch_times) == set(coins)
+
+
+class FakeOrderClient:
+    def __init__(self, reject=()):
+        self.reject = reject
+        self.orders = []
+
+    def buy(self, price, size, order_type, product_id, post_only, client_oid=None):
+        time.sleep(0.01)
+        if product_id.split("-")[0] in self.reject:
+            return {"message": "Post only mode"}
+        order = {
+            "id": "order-{}-{}".format(product_id, price),
+            "created_at": "2019-01-01T00:00:00.000000Z",
+        }
+        self.orders.append(order)
+        return order
+
+
+def test_submit_buy_orders_batched(coins, args):
+    from sqlalchemy import event
+    from optimal_buy_cbpro.history import Order, get_session
+
+    coins["ETH"] = {"name": "Ethereum"}
+    args.fiat_currency = "USD"
+    args.api_concurrency = 4
+    db_session = get_session("sqlite://")
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+
+    buy_orders = optimal_buy_cbpro.get_buy_orders(args, 500, coins, "BTC", 5000)
+    buy_orders += optimal_buy_cbpro.get_buy_orders(args, 500, coins, "ETH", 200)
+    cbpro_client = FakeOrderClient(reject=("ETH",))
+    report = optimal_buy_cbpro.submit_buy_orders(
+        args, buy_orders, cbpro_client, db_session
+    )
+
+    assert len(report) == 10
+    assert [r["outcome"] for r in report] == ["placed"] * 5 + ["rejected"] * 5
+    assert all(r["latency"] >= 0.01 for r in report)
+    assert db_session.query(Order).count() == 5
+    assert len(commits) == 1
+
+
+class FakeCancelClient:
+    def __init__(self, open_orders):
+        self.open_orders = open_orders
+        self.cancelled = []
+        self.listings = 0
+
+    def get_orders(self):
+        self.listings += 1
+        return list(self.open_orders)
+
+    def cancel_all(self, product_id):
+        self.cancelled.append(product_id)
+        self.open_orders = [
+            o for o in self.open_orders if o["product_id"] != product_id
+        ]
+        return []
+
+
+def test_cancel_orders(coins, args):
+    coins["ETH"] = {"name": "Ethereum"}
+    args.fiat_currency = "USD"
+    args.api_concurrency = 2
+    args.cancel_open_only = False
+    args.cancel_confirm_attempts = 3
+    cbpro_client = FakeCancelClient([{"product_id": "ETH-USD"}])
+    optimal_buy_cbpro.cancel_orders(args, coins, cbpro_client)
+    assert sorted(cbpro_client.cancelled) == ["BTC-USD", "ETH-USD"]
+    assert cbpro_client.open_orders == []
+
+
+def test_cancel_orders_open_only(coins, args):
+    coins["ETH"] = {"name": "Ethereum"}
+    args.fiat_currency = "USD"
+    args.api_concurrency = 2
+    args.cancel_open_only = True
+    args.cancel_confirm_attempts = 3
+    cbpro_client = FakeCancelClient(
+        [{"product_id": "ETH-USD"}, {"product_id": "LTC-USD"}]
+    )
+    optimal_buy_cbpro.cancel_orders(args, coins, cbpro_client)
+    assert cbpro_client.cancelled == ["ETH-USD"]
+    assert cbpro_client.listings == 2
+
+
+def test_cancel_orders_unconfirmed(coins, args, monkeypatch):
+    args.fiat_currency = "USD"
+    args.api_concurrency = 1
+    args.cancel_open_only = False
+    args.cancel_confirm_attempts = 3
+    cbpro_client = FakeCancelClient([{"product_id": "BTC-USD"}])
+    # The cancel never takes
+    cbpro_client.cancel_all = lambda product_id: []
+    sleeps = []
+    monkeypatch.setattr(optimal_buy_cbpro.time, "sleep", sleeps.append)
+    with pytest.raises(Exception, match="orders still open after cancel"):
+        optimal_buy_cbpro.cancel_orders(args, coins, cbpro_client)
+    assert cbpro_client.listings == 3
+    # No pause after the last check
+    assert sleeps == [0.5, 1.0]
+
+
+def test_diff_orders():
+    buy_orders = [
+        {"coin": "BTC", "price": 4975.0, "size": 0.02},
+        {"coin": "BTC", "price": 4970.0, "size": 0.02},
+        {"coin": "BTC", "price": 4965.0, "size": 0.02},
+    ]
+    open_orders = [
+        # Close enough to the first rung to keep
+        {"id": "a", "price": "4976.00", "size": "0.02", "side": "buy"},
+        # Partially filled, so too little is left on it
+        {"id": "b", "price": "4970.00", "size": "0.02", "filled_size": "0.01"},
+        # Not on the ladder at all
+        {"id": "c", "price": "4900.00", "size": "0.02", "side": "buy"},
+    ]
+    keep, cancel, place = optimal_buy_cbpro.diff_orders(buy_orders, open_orders, 0.001)
+    assert [o["id"] for o in keep] == ["a"]
+    assert [o["id"] for o in cancel] == ["b", "c"]
+    assert [b["price"] for b in place] == [4970.0, 4965.0]
+
+
+def test_check_cancelled():
+    cancel = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    # Already gone, as when a retried cancel's first attempt got through
+    optimal_buy_cbpro.check_cancelled(
+        cancel, ["a", {"message": "NotFound"}, {"message": "Order already done"}]
+    )
+    with pytest.raises(Exception, match="unable to cancel order b"):
+        optimal_buy_cbpro.check_cancelled(
+            cancel, ["a", {"message": "request timestamp expired"}, "c"]
+        )
+
+
+class FakeAmendClient(FakeOrderClient):
+    def __init__(self, open_orders, cancel_delay=0):
+        super().__init__()
+        self.open_orders = open_orders
+        self.cancelled = []
+        # Listings a cancelled order stays open for
+        self.cancel_delay = cancel_delay
+        self.pending_cancels = {}
+        self.open_at_buy = []
+
+    def get_orders(self):
+        for order_id, listings in list(self.pending_cancels.items()):
+            if listings:
+                self.pending_cancels[order_id] -= 1
+            else:
+                self.open_orders = [o for o in self.open_orders if o["id"] != order_id]
+                del self.pending_cancels[order_id]
+        return list(self.open_orders)
+
+    def cancel_order(self, order_id):
+        self.cancelled.append(order_id)
+        self.pending_cancels[order_id] = self.cancel_delay
+        return [order_id]
+
+    def buy(self, *args, **kwargs):
+        self.open_at_buy.append([o["id"] for o in self.open_orders])
+        return super().buy(*args, **kwargs)
+
+
+def test_amend_buy_orders(coins, args):
+    from optimal_buy_cbpro.history import Order, get_session
+
+    coins["ETH"] = {"name": "Ethereum"}
+    args.fiat_currency = "USD"
+    args.api_concurrency = 1
+    args.amend_tolerance = 0.001
+    args.cancel_confirm_attempts = 3
+    db_session = get_session("sqlite://")
+
+    buy_orders = optimal_buy_cbpro.get_buy_orders(args, 500, coins, "BTC", 5000)
+    open_orders = [
+        {
+            "id": "btc-{}".format(i),
+            "product_id": "BTC-USD",
+            "price": "{:.2f}".format(b["price"]),
+            "size": "{:.8f}".format(b["size"]),
+            "side": "buy",
+        }
+        for i, b in enumerate(buy_orders[:4])
+    ]
+    # A stale ETH order, with no ETH wanted this run
+    open_orders.append(
+        {"id": "eth", "product_id": "ETH-USD", "price": "190", "size": "1"}
+    )
+    cbpro_client = FakeAmendClient(open_orders)
+    report = optimal_buy_cbpro.amend_buy_orders(
+        args, coins, buy_orders, cbpro_client, db_session
+    )
+
+    assert len(report["kept"]) == 4
+    assert cbpro_client.cancelled == ["eth"]
+    assert [o["price"] for o in report["placed"]] == [buy_orders[4]["price"]]
+    assert db_session.query(Order).count() == 1
+    # 2 cancel_alls, a confirming listing and 5 orders, against a listing,
+    # a cancel, a confirming listing and an order
+    assert report["api_calls_saved"] == 4
+
+
+def test_amend_buy_orders_confirms_cancels(coins, args, monkeypatch):
+    from optimal_buy_cbpro.history import get_session
+
+    args.fiat_currency = "USD"
+    args.api_concurrency = 1
+    args.amend_tolerance = 0.001
+    args.cancel_confirm_attempts = 5
+    monkeypatch.setattr(optimal_buy_cbpro.time, "sleep", lambda s: None)
+
+    buy_orders = optimal_buy_cbpro.get_buy_orders(args, 500, coins, "BTC", 5000)
+    open_orders = [
+        {"id": "stale", "product_id": "BTC-USD", "price": "4000", "size": "0.1"},
+        {
+            "id": "kept",
+            "product_id": "BTC-USD",
+            "price": "{:.2f}".format(buy_orders[0]["price"]),
+            "size": "{:.8f}".format(buy_orders[0]["size"]),
+        },
+    ]
+    cbpro_client = FakeAmendClient(open_orders, cancel_delay=2)
+    report = optimal_buy_cbpro.amend_buy_orders(
+        args, coins, buy_orders, cbpro_client, get_session("sqlite://")
+    )
+
+    assert len(report["placed"]) == 4
+    # Nothing was placed while the cancelled order still held its funds
+    assert cbpro_client.open_at_buy == [["kept"]] * 4
+
+    cbpro_client = FakeAmendClient(open_orders, cancel_delay=10)
+    with pytest.raises(Exception, match="orders still open after cancel"):
+        optimal_buy_cbpro.amend_buy_orders(
+            args, coins, buy_orders, cbpro_client, get_session("sqlite://")
+        )
+    assert cbpro_client.orders == []
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import pytest
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.orderbook import (
+    OrderBookSnapshot,
+    fetch_order_books,
+    floor_to_increment,
+    snap_buy_orders,
+    snap_price,
+)
+
+
+class FakeBookClient:
+    def get_product_order_book(self, product_id, level=1):
+        assert level == 2
+        if product_id == "ETH-USD":
+            return {"message": "NotFound"}
+        return {
+            "sequence": 1,
+            "bids": [["99.98", "1.0", 2], ["99.50", "3.0", 1], ["98.00", "5.0", 4]],
+            "asks": [["100.01", "1.0", 1], ["100.20", "2.0", 1]],
+        }
+
+
+@pytest.fixture
+def book():
+    return OrderBookSnapshot.from_level2(
+        FakeBookClient().get_product_order_book("BTC-USD", level=2)
+    )
+
+
+def test_order_book_snapshot(book):
+    assert list(book.bids) == [98.0, 99.5, 99.98]
+    assert book.best_bid == 99.98
+    assert book.best_ask == 100.01
+    assert book.bid_at_or_below(99.7) == 99.5
+    assert book.bid_at_or_below(99.5) == 99.5
+    assert book.bid_at_or_below(97) is None
+
+
+def test_floor_to_increment():
+    assert floor_to_increment(99.57, 0.01) == 99.57
+    assert floor_to_increment(99.57, 0.1) == 99.5
+    assert floor_to_increment(0.3, 0.1) == 0.3
+
+
+def test_snap_price(book):
+    # Above the ask, where a post-only order would be rejected. It's moved
+    # under the ask, and from there onto the best bid
+    assert snap_price(100.5, book, 0.01, 0.001) == 99.98
+    assert snap_price(100.5, book, 0.01, 0) == 100.0
+    # Close enough to a bid level to join it
+    assert snap_price(99.55, book, 0.01, 0.001) == 99.5
+    # Too far from any level, so only floored to the increment
+    assert snap_price(99.0, book, 0.5, 0.001) == 99.0
+    assert snap_price(99.3, book, 0.5, 0.001) == 99.0
+
+
+def test_snap_buy_orders(book):
+    args = optimal_buy_cbpro.get_parser().parse_args(["--mode", "buy"])
+    coins = {"BTC": {"quote_increment": 0.01}, "ETH": {}}
+    buy_orders = [
+        {"coin": "BTC", "price": 100.5, "size": 1.0},
+        {"coin": "BTC", "price": 99.55, "size": 2.0},
+        {"coin": "ETH", "price": 200.0, "size": 1.0},
+    ]
+    books = fetch_order_books(FakeBookClient(), coins, "USD")
+    assert list(books) == ["BTC"]
+
+    snapped = snap_buy_orders(args, coins, buy_orders, books)
+    assert [o["price"] for o in snapped] == [99.98, 99.5, 200.0]
+    # The fiat spent on each order doesn't change
+    for before, after in zip(buy_orders, snapped):
+        assert after["price"] * after["size"] == pytest.approx(
+            before["price"] * before["size"]
+        )
+    assert snapped[2] is buy_orders[2]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import json
+import pytest
+from sqlalchemy import event
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.history import Deposit, Fill, Order, get_session
+from optimal_buy_cbpro.paper import (
+    PaperExchange,
+    PaperMarketData,
+    RecordedPrices,
+    run_paper,
+)
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / "feed.jsonl"
+    messages = [
+        {"type": "subscriptions", "channels": []},
+        {"type": "ticker", "product_id": "BTC-USD", "price": "100.00"},
+        {"type": "ticker", "product_id": "ETH-USD", "price": "10.00"},
+        {"type": "ticker", "product_id": "BTC-USD", "price": "90.00"},
+        {"type": "ticker", "product_id": "BTC-USD", "price": "80.00"},
+    ]
+    path.write_text("\n".join(json.dumps(m) for m in messages) + "\n")
+    return str(path)
+
+
+@pytest.fixture
+def market_caps(tmp_path):
+    path = tmp_path / "assets.json"
+    assets = {
+        "data": [
+            {"symbol": "BTC", "marketCapUsd": "9e11"},
+            {"symbol": "ETH", "marketCapUsd": "1e11"},
+        ]
+    }
+    path.write_text(json.dumps(assets))
+    return str(path)
+
+
+def test_recorded_prices(recording):
+    prices = RecordedPrices(recording)
+    assert prices.price("BTC-USD") == 100.0
+    assert prices.price("ETH-USD") == 10.0
+    assert prices.price("LTC-USD") is None
+    prices.advance()
+    assert prices.price("BTC-USD") == 90.0
+    # Products with fewer ticks start over sooner
+    assert prices.price("ETH-USD") == 10.0
+    prices.advance()
+    prices.advance()
+    assert prices.price("BTC-USD") == 100.0
+
+
+def test_recorded_prices_empty(tmp_path):
+    path = tmp_path / "empty.jsonl"
+    path.write_text("")
+    with pytest.raises(Exception):
+        RecordedPrices(str(path))
+
+
+def test_paper_exchange_fills(recording):
+    exchange = PaperExchange(["BTC", "ETH"], RecordedPrices(recording), "USD", 1000)
+    order = exchange.buy(
+        product_id="BTC-USD",
+        order_type="limit",
+        side="buy",
+        price="85.00",
+        size="2.0",
+        post_only=True,
+        client_oid="abc",
+    )
+    assert order["status"] == "open"
+    assert exchange.get_order("client:abc")["id"] == order["id"]
+    accounts = {a["currency"]: a for a in exchange.get_accounts()}
+    assert float(accounts["USD"]["hold"]) == 170.0
+    assert float(accounts["USD"]["available"]) == 830.0
+
+    # 90 is still above the order's price, 80 isn't
+    assert exchange.advance() == 0
+    assert exchange.advance() == 1
+    assert exchange.get_order(order["id"])["status"] == "done"
+    assert exchange.get_orders() == []
+    assert exchange.balances == {"BTC": 2.0, "ETH": 0.0, "USD": 830.0}
+    assert exchange.holds["USD"] == 0
+    fills = exchange.get_fills(product_id="BTC-USD")
+    assert [f["order_id"] for f in fills] == [order["id"]]
+
+
+def test_paper_exchange_rejects(recording):
+    exchange = PaperExchange(["BTC"], RecordedPrices(recording), "USD", 100)
+    # At the ask, so a post-only order would take
+    rejected = exchange.buy(
+        product_id="BTC-USD",
+        order_type="limit",
+        price="100.01",
+        size="0.5",
+        post_only=True,
+    )
+    assert rejected == {"message": "Post only mode"}
+    rejected = exchange.buy(
+        product_id="BTC-USD", order_type="limit", price="99.00", size="2.0"
+    )
+    assert rejected == {"message": "Insufficient funds"}
+
+    order = exchange.buy(
+        product_id="BTC-USD", order_type="limit", price="50.00", size="1.0"
+    )
+    assert exchange.cancel_all(product_id="BTC-USD") == [order["id"]]
+    assert exchange.holds["USD"] == 0
+    assert exchange.cancel_order(order["id"]) == {"message": "NotFound"}
+
+
+def test_paper_exchange_fill_paging(recording):
+    exchange = PaperExchange(["BTC"], RecordedPrices(recording), "USD", 1000)
+    for _ in range(3):
+        exchange.buy(product_id="BTC-USD", order_type="limit", price="95.00", size="1")
+    exchange.advance()
+    assert [f["trade_id"] for f in exchange.get_fills(product_id="BTC-USD")] == [
+        3,
+        2,
+        1,
+    ]
+    page = exchange.get_fills(product_id="BTC-USD", before=1, limit=1)
+    assert [f["trade_id"] for f in page] == [2]
+
+
+def test_run_paper(recording, market_caps, capsys):
+    args = optimal_buy_cbpro.get_parser().parse_args(
+        [
+            "--mode",
+            "buy",
+            "--dry-run",
+            "--paper-prices",
+            recording,
+            "--paper-market-caps",
+            market_caps,
+            "--paper-balance",
+            "0",
+            "--paper-cycles",
+            "3",
+            "--amount",
+            "100",
+        ]
+    )
+    coins = {"BTC": {"name": "Bitcoin"}, "ETH": {"name": "Ethereum"}}
+    db_session = get_session("sqlite://")
+    exchange = PaperExchange(
+        coins, RecordedPrices(args.paper_prices), "USD", args.paper_balance
+    )
+    market_data = PaperMarketData(args.paper_market_caps)
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+
+    run_paper(args, coins, db_session, exchange=exchange, market_data=market_data)
+    # The cycles' rows are committed together, then the synced fills
+    assert len(commits) == 2
+    assert db_session.query(Deposit).count() == 3
+    orders = db_session.query(Order).all()
+    assert len(orders) == len(exchange.orders)
+    assert {o.currency for o in orders} == {"BTC", "ETH"}
+    # Every fill on the paper exchange was synced into the DB
+    assert db_session.query(Fill).count() == len(exchange.fills) > 0
+    # All 300 deposited was either spent or is still held by open orders
+    spent = sum(float(f["price"]) * float(f["size"]) for f in exchange.fills)
+    assert exchange.balances["USD"] == pytest.approx(300 - spent)
+    assert "paper trading: 3 cycles" in capsys.readouterr().out
+
+
+def test_buy_caps_ladder_below_streamed_ask(recording, market_caps):
+    from optimal_buy_cbpro.pricebook import PriceBook
+
+    args = optimal_buy_cbpro.get_parser().parse_args(
+        ["--mode", "buy", "--api-rate-limit", "0"]
+    )
+    coins = {"BTC": {"name": "Bitcoin"}}
+    exchange = PaperExchange(coins, RecordedPrices(recording), "USD", 1000)
+    price_book = PriceBook()
+    # The ask has dropped below where the ladder's first rung would go
+    price_book.update(
+        {
+            "type": "ticker",
+            "product_id": "BTC-USD",
+            "price": "100.00",
+            "best_bid": "98.90",
+            "best_ask": "99.00",
+        }
+    )
+    optimal_buy_cbpro.buy(
+        args,
+        coins,
+        exchange,
+        get_session("sqlite://"),
+        market_data=PaperMarketData(market_caps),
+        price_book=price_book,
+    )
+    prices = [float(o["price"]) for o in exchange.orders.values()]
+    assert max(prices) == 98.99
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import json
+
+import pytest
+
+from optimal_buy_cbpro import optimal_buy_cbpro, pricebook
+from optimal_buy_cbpro.orderbook import snap_buy_orders
+
+
+def ticker(product_id, price, sequence):
+    return {
+        "type": "ticker",
+        "product_id": product_id,
+        "price": str(price),
+        "best_bid": str(price - 0.01),
+        "best_ask": str(price + 0.01),
+        "sequence": sequence,
+    }
+
+
+class FakeTickerClient:
+    def __init__(self):
+        self.calls = []
+
+    def get_product_ticker(self, product_id):
+        self.calls.append(product_id)
+        return {"price": "1.5"}
+
+
+def test_update_keeps_newest():
+    book = pricebook.PriceBook()
+    book.update(ticker("BTC-USD", 5000, 2))
+    book.update(ticker("BTC-USD", 4000, 1))
+    book.update({"type": "subscriptions", "channels": []})
+    assert book.get_ticker("BTC-USD")["price"] == 5000.0
+    assert book.get_ticker("BTC-USD")["best_bid"] == 4999.99
+    assert book.get_ticker("ETH-USD") is None
+
+
+def test_get_prices_falls_back_when_stale():
+    now = [1000.0]
+    book = pricebook.PriceBook(max_age=60, clock=lambda: now[0])
+    book.update(ticker("BTC-USD", 5000, 1))
+    now[0] += 30
+    book.update(ticker("ETH-USD", 200, 1))
+    now[0] += 40
+
+    cbpro_client = FakeTickerClient()
+    fetch_times = {}
+    prices = book.get_prices(
+        cbpro_client, {"BTC": {}, "ETH": {}, "LTC": {}}, "USD", fetch_times=fetch_times
+    )
+    assert prices == {"BTC": 1.5, "ETH": 200.0, "LTC": 1.5}
+    assert list(prices) == ["BTC", "ETH", "LTC"]
+    assert cbpro_client.calls == ["BTC-USD", "LTC-USD"]
+    assert fetch_times["ETH"] == 1030.0
+
+
+def test_replay(tmp_path):
+    coins = {c: {} for c in ["BTC", "ETH", "LTC", "BCH", "XLM"]}
+    path = tmp_path / "feed.jsonl"
+    with open(path, "w") as f:
+        for sequence in range(200):
+            for i, c in enumerate(coins):
+                msg = ticker("{}-USD".format(c), 100 * (i + 1) + sequence, sequence)
+                f.write(json.dumps(msg) + "\n")
+
+    book = pricebook.PriceBook()
+    assert pricebook.replay(book, str(path)) == 1000
+
+    cbpro_client = FakeTickerClient()
+    streamed = book.get_prices(cbpro_client, coins, "USD")
+    # Every price came from the recording, with no ticker fetched
+    assert cbpro_client.calls == []
+    pricebook.get_prices(cbpro_client, coins, "USD")
+
+    assert streamed == {
+        "BTC": 299.0,
+        "ETH": 399.0,
+        "LTC": 499.0,
+        "BCH": 599.0,
+        "XLM": 699.0,
+    }
+    assert len(cbpro_client.calls) == 5
+
+
+def test_price_feed_restarts_after_connect_error():
+    book = pricebook.PriceBook()
+    # Nothing listens on port 1, so the connect is refused
+    feed = pricebook.PriceFeed(book, ["BTC-USD"], "ws://127.0.0.1:1")
+    feed.ensure_running()
+    feed.thread.join(5)
+    assert feed.stop
+    assert feed.error is not None
+
+    starts = []
+    feed.start = lambda: starts.append(True)
+    feed.ensure_running()
+    # Restarted too if the thread died some other way
+    feed.stop = False
+    feed.ensure_running()
+    assert len(starts) == 2
+
+
+def test_get_books_caps_ladder():
+    now = [1000.0]
+    book = pricebook.PriceBook(max_age=60, clock=lambda: now[0])
+    book.update(ticker("BTC-USD", 5000, 1))
+    now[0] += 30
+    book.update(dict(ticker("ETH-USD", 200, 1), best_ask=None))
+    now[0] += 40
+    book.update(ticker("LTC-USD", 50, 1))
+
+    # Stale and ask-less tickers are left out
+    books = book.get_books(["BTC", "ETH", "LTC"], "USD")
+    assert list(books) == ["LTC"]
+    assert books["LTC"].best_ask == 50.01
+
+    args = optimal_buy_cbpro.get_parser().parse_args(["--mode", "buy"])
+    orders = [
+        {"coin": "LTC", "price": 50.5, "size": 1.0},
+        {"coin": "LTC", "price": 49.0, "size": 1.0},
+    ]
+    capped = snap_buy_orders(args, {"LTC": {}}, orders, books)
+    assert [o["price"] for o in capped] == [50.0, 49.0]
+    assert capped[0]["size"] == pytest.approx(50.5 / 50.0)
+
+
+def test_price_feed_closes_recording(tmp_path):
+    path = tmp_path / "feed.jsonl"
+    feed = pricebook.PriceFeed(
+        pricebook.PriceBook(), ["BTC-USD"], "ws://127.0.0.1:1", str(path)
+    )
+    record = feed.record
+    feed.on_message(ticker("BTC-USD", 5000, 1))
+    feed.shutdown()
+    assert record.closed
+    assert len(path.read_text().splitlines()) == 1
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import datetime
+import json
+import sqlite3
+
+import pytest
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.history import (
+    CurrencyStats,
+    Deposit,
+    add_deposit,
+    add_fills,
+    get_session,
+    rebuild_currency_stats,
+)
+from optimal_buy_cbpro.paper import (
+    PaperExchange,
+    PaperMarketData,
+    RecordedPrices,
+    run_paper,
+)
+from optimal_buy_cbpro.report import get_report, print_report
+
+
+def get_fill(trade_id, order_id, price, size, fee=0.0):
+    return {
+        "trade_id": trade_id,
+        "product_id": "BTC-USD",
+        "cbpro_order_id": order_id,
+        "side": "buy",
+        "price": price,
+        "size": size,
+        "fee": fee,
+        "liquidity": "M",
+        "settled": True,
+        "created_at": datetime.datetime(2019, 1, 1),
+    }
+
+
+def get_stats(db_session):
+    return {
+        s.currency: {
+            c.name: getattr(s, c.name)
+            for c in CurrencyStats.__table__.columns
+            if c.name != "currency"
+        }
+        for s in db_session.query(CurrencyStats)
+    }
+
+
+def test_report(capsys):
+    db_session = get_session("sqlite://")
+    order = {"id": "a", "created_at": "2019-01-01T00:00:00Z"}
+    optimal_buy_cbpro.record_buy_order("BTC", 95.0, 2.0, order, db_session, 100.0)
+    optimal_buy_cbpro.record_buy_order(
+        "BTC", 90.0, 1.0, dict(order, id="b"), db_session, 100.0
+    )
+    # Placed before orders recorded their market price
+    optimal_buy_cbpro.record_buy_order(
+        "BTC", 80.0, 1.0, dict(order, id="c"), db_session
+    )
+    add_deposit(db_session, Deposit(currency="USD", amount=500.0))
+    db_session.commit()
+    add_fills(
+        db_session,
+        "BTC-USD",
+        [get_fill(1, "a", 95.0, 2.0, fee=1.0), get_fill(2, "c", 80.0, 1.0)],
+    )
+    db_session.commit()
+
+    report, totals = get_report(db_session, ["BTC", "ETH"], "USD", {"BTC": 110.0})
+    assert list(report) == ["BTC"]
+    btc = report["BTC"]
+    assert btc["orders"] == 3
+    assert btc["size"] == 3.0
+    assert btc["invested"] == 271.0
+    assert btc["average_cost"] == pytest.approx(271.0 / 3)
+    assert btc["value"] == 330.0
+    assert btc["gain"] == 59.0
+    # Only order "a" has a market price to measure the discount against
+    assert btc["discount_captured"] == 10.0
+    assert btc["discount"] == pytest.approx(0.05)
+    assert totals == {
+        "deposited": 500.0,
+        "invested": 271.0,
+        "discount_captured": 10.0,
+        "value": 330.0,
+        "gain": 59.0,
+    }
+
+    # Without a price, what can't be valued is left out
+    report, totals = get_report(db_session, ["BTC"], "USD", {})
+    assert report["BTC"]["value"] is None
+    assert totals["gain"] is None
+    print_report(report, totals, "USD")
+    assert "value=-" in capsys.readouterr().out
+
+
+def test_currency_stats_match_history(tmp_path):
+    path = tmp_path / "feed.jsonl"
+    messages = [
+        {"type": "ticker", "product_id": "BTC-USD", "price": p}
+        for p in ["100.00", "99.00", "97.00", "101.00", "95.00"]
+    ] + [
+        {"type": "ticker", "product_id": "ETH-USD", "price": p}
+        for p in ["10.00", "9.80", "10.10"]
+    ]
+    path.write_text("\n".join(json.dumps(m) for m in messages))
+    caps = tmp_path / "assets.json"
+    caps.write_text(
+        json.dumps(
+            {
+                "data": [
+                    {"symbol": "BTC", "marketCapUsd": "9e11"},
+                    {"symbol": "ETH", "marketCapUsd": "1e11"},
+                ]
+            }
+        )
+    )
+    args = optimal_buy_cbpro.get_parser().parse_args(
+        [
+            "--mode",
+            "buy",
+            "--dry-run",
+            "--paper-cycles",
+            "5",
+            "--amount",
+            "100",
+            "--paper-balance",
+            "0",
+        ]
+    )
+    coins = {"BTC": {}, "ETH": {}}
+    db_session = get_session("sqlite://")
+    exchange = PaperExchange(coins, RecordedPrices(str(path)), "USD", 0)
+    run_paper(
+        args,
+        coins,
+        db_session,
+        exchange=exchange,
+        market_data=PaperMarketData(str(caps)),
+    )
+    incremental = get_stats(db_session)
+    assert incremental["USD"]["deposited"] == 500.0
+    assert incremental["BTC"]["bought_size"] > 0
+    assert incremental["BTC"]["discount_captured"] > 0
+
+    rebuild_currency_stats(db_session)
+    rebuilt = get_stats(db_session)
+    assert rebuilt.keys() == incremental.keys()
+    for currency, stats in rebuilt.items():
+        assert stats == pytest.approx(incremental[currency])
+
+
+def test_migrate_rebuilds_currency_stats(tmp_path):
+    path = str(tmp_path / "history.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, currency VARCHAR,
+            price FLOAT, size FLOAT, cbpro_order_id VARCHAR,
+            created_at DATETIME);
+        CREATE TABLE deposits (id INTEGER PRIMARY KEY, currency VARCHAR,
+            amount FLOAT, payment_method_id VARCHAR, payout_at DATETIME,
+            cbpro_deposit_id VARCHAR);
+        INSERT INTO orders (currency, price, size) VALUES
+            ('BTC', 100, 1), ('BTC', 99, 1), ('ETH', 10, 1);
+        INSERT INTO deposits (currency, amount) VALUES ('USD', 50), ('USD', 25);
+        """)
+    conn.close()
+
+    db_session = get_session("sqlite:///" + path)
+    stats = get_stats(db_session)
+    assert stats["BTC"]["orders"] == 2
+    assert stats["ETH"]["orders"] == 1
+    assert stats["USD"]["deposited"] == 75.0
+
+
+def test_run_report_accounts(tmp_path, monkeypatch, capsys):
+    from optimal_buy_cbpro.report import run_report
+
+    priced = []
+
+    def get_prices(cbpro_client, coins, *args, **kwargs):
+        priced.append(list(coins))
+        return {"BTC": 110.0, "ETH": 10.0}
+
+    monkeypatch.setattr(optimal_buy_cbpro, "get_prices", get_prices)
+    order = {"id": "a", "created_at": "2019-01-01T00:00:00Z"}
+    db_engines = {}
+    for name, size in [("main", 5.0), ("alice", 1.0), ("bob", 2.0)]:
+        db_engines[name] = "sqlite:///{}".format(tmp_path / "{}.db".format(name))
+        db_session = get_session(db_engines[name])
+        optimal_buy_cbpro.record_buy_order("BTC", 100.0, size, order, db_session, 100.0)
+        if name == "bob":
+            optimal_buy_cbpro.record_buy_order(
+                "ETH", 9.0, 3.0, dict(order, id="e"), db_session, 10.0
+            )
+        add_fills(db_session, "BTC-USD", [get_fill(1, "a", 100.0, size)])
+        db_session.commit()
+        db_session.close()
+    args = optimal_buy_cbpro.get_parser().parse_args(
+        ["--mode", "report", "--db-engine", db_engines["main"]]
+    )
+    accounts = [
+        {"name": "alice", "db_engine": db_engines["alice"]},
+        # Holds a coin the other accounts don't
+        {
+            "name": "bob",
+            "db_engine": db_engines["bob"],
+            "coins": {"BTC": {}, "ETH": {}},
+        },
+    ]
+
+    reports = run_report(args, ["BTC"], accounts)
+    # Each account's report comes from its own DB, not --db-engine's
+    assert list(reports) == ["alice", "bob"]
+    assert reports["alice"][0]["BTC"]["size"] == 1.0
+    assert reports["bob"][0]["BTC"]["size"] == 2.0
+    assert reports["bob"][1]["value"] == 220.0
+    # Each account is reported on for its own coins
+    assert list(reports["alice"][0]) == ["BTC"]
+    assert list(reports["bob"][0]) == ["BTC", "ETH"]
+    assert reports["bob"][0]["ETH"]["orders"] == 1
+    # Every account's coins are priced in one fetch
+    assert priced == [["BTC", "ETH"]]
+    out = capsys.readouterr().out
+    assert "account alice:" in out and "account bob:" in out
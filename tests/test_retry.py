@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import pytest
+import requests
+
+from optimal_buy_cbpro.metrics import METRICS
+from optimal_buy_cbpro.retry import RetryingClient, get_backoff
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession:
+    def __init__(self):
+        self.hooks = {"response": []}
+
+    def respond(self, status_code, headers=None):
+        for hook in self.hooks["response"]:
+            hook(FakeResponse(status_code, headers))
+
+
+class FakeClient:
+    """Each call pops its next outcome: a (status, result) pair, or an
+    exception to raise."""
+
+    def __init__(self, outcomes):
+        self.session = FakeSession()
+        self.outcomes = outcomes
+        self.calls = []
+        self.orders = {}
+
+    def next(self, name):
+        self.calls.append(name)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        status, result = outcome
+        self.session.respond(status, {"Retry-After": "2"})
+        return result
+
+    def get_accounts(self):
+        return self.next("get_accounts")
+
+    def get_orders(self):
+        yield from self.next("get_orders")
+
+    def get_order(self, order_id):
+        self.calls.append("get_order")
+        return self.orders.get(order_id, {"message": "NotFound"})
+
+    def buy(self, **kwargs):
+        self.calls.append("buy")
+        # The order gets through, but its response is lost on the way back
+        self.orders["client:" + kwargs["client_oid"]] = {"id": "order1"}
+        raise requests.exceptions.ConnectionError()
+
+    def crypto_withdraw(self, amount, currency, crypto_address):
+        return self.next("crypto_withdraw")
+
+
+class FakeRateLimiter:
+    def __init__(self):
+        self.paused = []
+        self.acquired = 0
+
+    def pause(self, seconds):
+        self.paused.append(seconds)
+
+    def acquire(self):
+        self.acquired += 1
+
+
+def test_get_backoff():
+    for attempt in range(1, 10):
+        assert 0 <= get_backoff(attempt, 0.5) <= min(30, 0.5 * 2 ** (attempt - 1))
+
+
+def test_retry_status():
+    METRICS.reset()
+    sleeps = []
+    rate_limiter = FakeRateLimiter()
+    client = FakeClient([(503, {"message": "down"}), (429, {}), (200, [{"id": 1}])])
+    retrying = RetryingClient(client, 4, 0.01, rate_limiter, sleep=sleeps.append)
+    assert retrying.get_accounts() == [{"id": 1}]
+    assert client.calls == ["get_accounts"] * 3
+    # The 429 holds back everyone for at least its Retry-After
+    assert rate_limiter.paused == [sleeps[1]]
+    assert sleeps[1] >= 2
+    assert rate_limiter.acquired == 2
+    assert {(r["call"], r["reason"]) for r in METRICS.summary()["api_retries"]} == {
+        ("get_accounts", "503"),
+        ("get_accounts", "429"),
+    }
+
+    # Wrapping the same client again doesn't add a second hook
+    RetryingClient(client)
+    assert len(client.session.hooks["response"]) == 1
+
+
+def test_retry_gives_up():
+    client = FakeClient([(500, {"message": "error"})] * 2)
+    retrying = RetryingClient(client, 2, 0.01, sleep=lambda s: None)
+    assert retrying.get_accounts() == {"message": "error"}
+    assert len(client.calls) == 2
+
+    client = FakeClient([requests.exceptions.Timeout()] * 2)
+    retrying = RetryingClient(client, 2, 0.01, sleep=lambda s: None)
+    with pytest.raises(requests.exceptions.Timeout):
+        retrying.get_accounts()
+
+
+def test_retry_generator():
+    client = FakeClient([(502, ["message"]), (200, [{"id": "a"}, {"id": "b"}])])
+    retrying = RetryingClient(client, 4, 0.01, sleep=lambda s: None)
+    assert retrying.get_orders() == [{"id": "a"}, {"id": "b"}]
+
+
+def test_retry_buy():
+    client = FakeClient([])
+    retrying = RetryingClient(client, 4, 0.01, sleep=lambda s: None)
+    order = retrying.buy(
+        price="100.00",
+        size="1.0",
+        order_type="limit",
+        product_id="BTC-USD",
+        post_only=True,
+    )
+    # The order is found by its client_oid rather than placed twice
+    assert order == {"id": "order1"}
+    assert client.calls == ["buy", "get_order"]
+
+
+def test_no_retry_withdrawals():
+    client = FakeClient([requests.exceptions.ConnectionError()])
+    retrying = RetryingClient(client, 4, 0.01, sleep=lambda s: None)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        retrying.crypto_withdraw(1, "BTC", "address")
+    assert client.calls == ["crypto_withdraw"]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import subprocess
+import sys
+
+# Startup budget for the CLI module, in microseconds of cumulative import time
+# as reported by -X importtime. It takes ~25ms on a laptop, and took ~550ms
+# when cbpro, requests and SQLAlchemy were imported up front.
+IMPORT_BUDGET = 150000
+
+# Imported only by the modes that use them
+DEFERRED_MODULES = [
+    "cbpro",
+    "requests",
+    "dateutil",
+    "sqlalchemy",
+    "numpy",
+    "pymongo",
+    "pyarrow",
+]
+
+
+def get_import_times(code):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return result, times
+
+
+def test_import_time():
+    _, times = get_import_times("import optimal_buy_cbpro.optimal_buy_cbpro")
+    for module in DEFERRED_MODULES:
+        assert module not in times
+    assert times["optimal_buy_cbpro.optimal_buy_cbpro"] < IMPORT_BUDGET
+
+
+def test_help_import_time():
+    result, times = get_import_times(
+        "import sys; sys.argv = ['optimal-buy-cbpro', '--help'];"
+        "from optimal_buy_cbpro.optimal_buy_cbpro import main; main()"
+    )
+    assert "--mode" in result.stdout
+    for module in DEFERRED_MODULES:
+        assert module not in times
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import datetime
+import pytest
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.history import Fill, Order, SyncCursor, get_session
+from optimal_buy_cbpro.sync import sync
+
+
+class FakeFillsClient:
+    """Serves fills newest first, one page at a time when paging with
+    `before`, like the real API."""
+
+    def __init__(self):
+        self.fills = []
+        self.open_order_ids = set()
+        self.calls = []
+
+    def add_fill(self, order_id, price, size, product_id="BTC-USD"):
+        self.fills.append(
+            {
+                "trade_id": len(self.fills) + 1,
+                "product_id": product_id,
+                "order_id": order_id,
+                "side": "buy",
+                "price": str(price),
+                "size": str(size),
+                "fee": "0.0",
+                "liquidity": "M",
+                "settled": True,
+                "created_at": "2019-01-01T00:00:00.000000Z",
+            }
+        )
+
+    def get_fills(self, product_id=None, before=None, limit=100):
+        self.calls.append((product_id, before))
+        fills = [f for f in self.fills if f["product_id"] == product_id]
+        if before is not None:
+            fills = [f for f in fills if f["trade_id"] > int(before)][:limit]
+        return iter(sorted(fills, key=lambda f: -f["trade_id"]))
+
+    def get_orders(self):
+        return iter([{"id": i} for i in self.open_order_ids])
+
+
+@pytest.fixture
+def args():
+    args = optimal_buy_cbpro.get_parser().parse_args(
+        ["--mode", "sync", "--api-rate-limit", "0"]
+    )
+    return args
+
+
+def add_order(db_session, order_id, size):
+    db_session.add(
+        Order(
+            currency="BTC",
+            price=100.0,
+            size=size,
+            cbpro_order_id=order_id,
+            created_at=datetime.datetime(2019, 1, 1),
+        )
+    )
+    db_session.commit()
+
+
+def test_sync(args):
+    db_session = get_session("sqlite://")
+    cbpro_client = FakeFillsClient()
+    add_order(db_session, "filled", 1.0)
+    add_order(db_session, "partial", 1.0)
+    add_order(db_session, "open", 1.0)
+    cbpro_client.add_fill("filled", 100, 0.5)
+    cbpro_client.add_fill("filled", 100, 0.5)
+    cbpro_client.add_fill("partial", 100, 0.25)
+    cbpro_client.open_order_ids = {"open"}
+
+    summary = sync(args, {"BTC": {}}, cbpro_client, db_session)
+    assert summary["BTC-USD"]["fills"] == 3
+    assert summary["BTC-USD"]["size"] == 1.25
+    assert summary["BTC-USD"]["average_price"] == 100
+    statuses = {o.cbpro_order_id: o.status for o in db_session.query(Order)}
+    assert statuses == {"filled": "filled", "partial": "cancelled", "open": "open"}
+    assert db_session.query(SyncCursor).one().trade_id == 3
+
+
+def test_sync_incremental(args):
+    db_session = get_session("sqlite://")
+    cbpro_client = FakeFillsClient()
+    add_order(db_session, "open", 500.0)
+    cbpro_client.open_order_ids = {"open"}
+    cbpro_client.add_fill("open", 100, 1)
+    sync(args, {"BTC": {}}, cbpro_client, db_session)
+
+    # Enough new fills to need several pages past the cursor
+    for _ in range(250):
+        cbpro_client.add_fill("open", 100, 1)
+    cbpro_client.calls = []
+    sync(args, {"BTC": {}}, cbpro_client, db_session)
+    assert cbpro_client.calls == [
+        ("BTC-USD", 1),
+        ("BTC-USD", 101),
+        ("BTC-USD", 201),
+    ]
+    assert db_session.query(Fill).count() == 251
+    assert db_session.query(SyncCursor).one().trade_id == 251
+    order = db_session.query(Order).one()
+    assert order.status == "open"
+    assert order.filled_size == 251
+
+    # Nothing new, so one call and nothing stored
+    cbpro_client.calls = []
+    sync(args, {"BTC": {}}, cbpro_client, db_session)
+    assert cbpro_client.calls == [("BTC-USD", 251)]
+    assert db_session.query(Fill).count() == 251
+
+
+def test_sync_error(args):
+    db_session = get_session("sqlite://")
+
+    class ErrorClient(FakeFillsClient):
+        def get_fills(self, product_id=None, before=None, limit=100):
+            return iter({"message": "Invalid API Key"})
+
+    with pytest.raises(Exception):
+        sync(args, {"BTC": {}}, ErrorClient(), db_session)
+    assert db_session.query(SyncCursor).count() == 0
+
+
+def test_sync_order_filled_during_sync(args):
+    db_session = get_session("sqlite://")
+
+    class FillingClient(FakeFillsClient):
+        """The open order fills right after the sync's first call."""
+
+        def fill(self):
+            if "racing" in self.open_order_ids:
+                self.open_order_ids = set()
+                self.add_fill("racing", 100, 1.0)
+
+        def get_fills(self, product_id=None, before=None, limit=100):
+            fills = list(super().get_fills(product_id, before, limit))
+            self.fill()
+            return iter(fills)
+
+        def get_orders(self):
+            orders = list(super().get_orders())
+            self.fill()
+            return iter(orders)
+
+    cbpro_client = FillingClient()
+    add_order(db_session, "racing", 1.0)
+    cbpro_client.open_order_ids = {"racing"}
+
+    sync(args, {"BTC": {}}, cbpro_client, db_session)
+    # Never taken for cancelled, which no later sync would look at again
+    assert db_session.query(Order).one().status == "open"
+    sync(args, {"BTC": {}}, cbpro_client, db_session)
+    order = db_session.query(Order).one()
+    assert order.status == "filled"
+    assert order.filled_size == 1.0
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import time
+import threading
+
+import pytest
+
+from optimal_buy_cbpro import throttle
+
+
+class FakeClock:
+    """Stands in for the time module, recording sleeps rather than making
+    them."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter_burst(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, "time", clock)
+    limiter = throttle.RateLimiter(10, burst=5)
+    for _ in range(5):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+
+def test_rate_limiter_disabled(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, "time", clock)
+    limiter = throttle.RateLimiter(0)
+    for _ in range(1000):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+
+def test_run_concurrently_preserves_order():
+    threads = set()
+
+    def square(x):
+        threads.add(threading.get_ident())
+        time.sleep(0.01)
+        return x * x
+
+    results = throttle.run_concurrently(square, range(8), max_workers=4)
+    assert results == [x * x for x in range(8)]
+    assert len(threads) > 1
+
+
+def test_run_concurrently_serial():
+    threads = set()
+
+    def ident(x):
+        threads.add(threading.get_ident())
+        return x
+
+    assert throttle.run_concurrently(ident, [1, 2, 3]) == [1, 2, 3]
+    assert threads == {threading.get_ident()}
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import random
+import pytest
+from sqlalchemy import event
+
+from optimal_buy_cbpro import optimal_buy_cbpro
+from optimal_buy_cbpro.history import VolatilityStats, batch_commits, get_session
+from optimal_buy_cbpro.volatility import (
+    MAX_DISCOUNT,
+    AverageTrueRange,
+    get_discount_steps,
+)
+
+HOUR = 3600
+
+
+def get_candles(count, seed=0):
+    rng = random.Random(seed)
+    candles = []
+    close = 100.0
+    for i in range(count):
+        open_ = close
+        close = open_ * rng.uniform(0.98, 1.02)
+        low = min(open_, close) * rng.uniform(0.99, 1)
+        high = max(open_, close) * rng.uniform(1, 1.01)
+        candles.append([i * HOUR, low, high, open_, close, 1.0])
+    return candles
+
+
+def wilder_atr(candles, window):
+    true_ranges = []
+    prev_close = None
+    for _, low, high, _, close, _ in candles:
+        if prev_close is None:
+            true_ranges.append(high - low)
+        else:
+            true_ranges.append(
+                max(high - low, abs(high - prev_close), abs(low - prev_close))
+            )
+        prev_close = close
+    atr = sum(true_ranges[:window]) / window
+    for tr in true_ranges[window:]:
+        atr = (atr * (window - 1) + tr) / window
+    return atr
+
+
+class FakeCandleClient:
+    def __init__(self, candles):
+        self.candles = candles
+        self.calls = []
+
+    def get_product_historic_rates(
+        self, product_id, start=None, end=None, granularity=None
+    ):
+        self.calls.append(start)
+        candles = self.candles
+        if start is not None:
+            import dateutil.parser
+
+            start = dateutil.parser.parse(start).timestamp()
+            candles = [c for c in candles if c[0] >= start]
+        # Newest first, and at most 300, like the API
+        return sorted(candles, reverse=True)[:300]
+
+
+@pytest.fixture
+def args():
+    return optimal_buy_cbpro.get_parser().parse_args(
+        ["--mode", "buy", "--ladder-mode", "volatility", "--api-rate-limit", "0"]
+    )
+
+
+def test_average_true_range():
+    candles = get_candles(100)
+    atr = AverageTrueRange(14)
+    for t, low, high, _, close, _ in candles:
+        atr.update(t, low, high, close)
+        # Candles already seen are ignored
+        atr.update(t, low, high, close)
+    assert atr.ready
+    assert atr.atr == pytest.approx(wilder_atr(candles, 14))
+
+
+def test_get_discount_steps_incremental(args):
+    db_session = get_session("sqlite://")
+    candles = get_candles(200)
+    cbpro_client = FakeCandleClient(candles[:100])
+    coins = {"BTC": {}}
+
+    # The newest candle is still in progress, so isn't counted
+    now = 99 * HOUR + 1
+    steps = get_discount_steps(
+        args, coins, {"BTC": 100.0}, cbpro_client, db_session, now=now
+    )
+    assert cbpro_client.calls == [None]
+    stats = db_session.query(VolatilityStats).one()
+    assert stats.count == 99
+    assert steps["BTC"] == pytest.approx(0.5 * wilder_atr(candles[:99], 14) / 100)
+
+    # Later runs only fold in the candles since the last one
+    cbpro_client.candles = candles
+    now = 200 * HOUR
+    steps = get_discount_steps(
+        args, coins, {"BTC": 100.0}, cbpro_client, db_session, now=now
+    )
+    assert cbpro_client.calls[1] is not None
+    stats = db_session.query(VolatilityStats).one()
+    assert stats.count == 200
+    assert stats.last_time == 199 * HOUR
+    assert steps["BTC"] == pytest.approx(0.5 * wilder_atr(candles, 14) / 100)
+
+
+def test_get_discount_steps_not_ready(args):
+    db_session = get_session("sqlite://")
+    cbpro_client = FakeCandleClient(get_candles(5))
+    steps = get_discount_steps(
+        args, {"BTC": {}}, {"BTC": 100.0}, cbpro_client, db_session, now=5 * HOUR
+    )
+    assert steps == {"BTC": args.discount_step}
+
+
+def test_get_discount_steps_batch_commits(args):
+    db_session = get_session("sqlite://")
+    commits = []
+    event.listen(db_session, "after_commit", lambda s: commits.append(s))
+    cbpro_client = FakeCandleClient(get_candles(100))
+    with batch_commits(db_session):
+        for hour in [99, 100]:
+            get_discount_steps(
+                args,
+                {"BTC": {}},
+                {"BTC": 100.0},
+                cbpro_client,
+                db_session,
+                now=hour * HOUR + 1,
+            )
+    assert len(commits) == 1
+
+
+def test_get_discount_steps_capped(args):
+    db_session = get_session("sqlite://")
+    cbpro_client = FakeCandleClient(get_candles(100))
+    # An ATR of several times the price
+    steps = get_discount_steps(
+        args, {"BTC": {}}, {"BTC": 1.0}, cbpro_client, db_session, now=100 * HOUR
+    )
+    assert steps["BTC"] == pytest.approx(
+        (MAX_DISCOUNT - args.starting_discount) / (args.order_count - 1)
+    )
+    orders = optimal_buy_cbpro.generate_buy_orders(
+        {"BTC": {}}, "BTC", args, 10, 1.0, discount_step=steps["BTC"]
+    )
+    assert len(orders) == args.order_count
+    # Down to a cent of rounding below the deepest discount allowed
+    assert min(o["price"] for o in orders) >= 1.0 - MAX_DISCOUNT - 0.01
+    assert all(o["size"] > 0 for o in orders)
+
+
+def test_generate_orders_discount_step(args):
+    coins = {"BTC": {}}
+    orders = optimal_buy_cbpro.generate_buy_orders(
+        coins, "BTC", args, 500, 5000, discount_step=0.002
+    )
+    assert [o["price"] for o in orders] == [4975.0, 4965.0, 4955.0, 4945.0, 4935.0]